@@ -3,10 +3,10 @@ from rest_framework.response import Response
 from rest_framework import status
 from django.contrib.auth.models import User
 from .models import ImageProject
+from .pagination import KeysetPaginator
 from .permissions import IsAdminUser
-from django.db.models import Count, Q
-from django.utils import timezone
-from datetime import timedelta
+from django.db.models import Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 import os
 
 class EmergencyCreateAdmin(APIView):
@@ -50,42 +50,9 @@ class AdminDashboardStatsView(APIView):
     permission_classes = [IsAdminUser]
 
     def get(self, request):
-        # User Stats
-        total_users = User.objects.count()
-        new_users_24h = User.objects.filter(date_joined__gte=timezone.now() - timedelta(hours=24)).count()
-
-        # Job Stats
-        total_projects = ImageProject.objects.count()
-        active_jobs = ImageProject.objects.filter(status__in=['pending', 'processing']).count()
-        failed_jobs = ImageProject.objects.filter(status='failed').count()
-        completed_jobs = ImageProject.objects.filter(status='completed').count()
-        
-        # Determine strict processing jobs vs. just database entries
-        # Assuming 'processing' means it's actively being worked on or queued
-        gpu_queue_depth = ImageProject.objects.filter(status='pending').count()
-
-        # Storage Usage (Estimate based on count, as we don't scan disk)
-        # Assuming avg 2MB per project (original + processed)
-        est_storage_gb = round((total_projects * 2) / 1024, 2) 
-
-        return Response({
-            "users": {
-                "total": total_users,
-                "new_24h": new_users_24h
-            },
-            "jobs": {
-                "total": total_projects,
-                "active": active_jobs,
-                "failed": failed_jobs,
-                "completed": completed_jobs,
-                "success_rate": round((completed_jobs / total_projects * 100) if total_projects > 0 else 0, 1)
-            },
-            "system": {
-                "gpu_queue_depth": gpu_queue_depth,
-                "est_storage_gb": est_storage_gb,
-                "status": "healthy" if active_jobs < 50 else "high_load"
-            }
-        })
+        # Cached snapshot, refreshed in the background (see api/dashboard.py)
+        from .dashboard import get_dashboard_stats
+        return Response(get_dashboard_stats())
 
 class UserManagementView(APIView):
     """
@@ -95,7 +62,16 @@ class UserManagementView(APIView):
 
     def get(self, request):
         query = request.query_params.get('search', '')
-        users = User.objects.all().order_by('-date_joined')
+        users = User.objects.only(
+            'id', 'username', 'email', 'is_active', 'is_staff', 'date_joined'
+        ).annotate(
+            # Correlated subquery: counted for the rows of this page only,
+            # instead of joining and grouping every user's projects
+            job_count=Coalesce(Subquery(
+                ImageProject.objects.filter(user=OuterRef('pk'))
+                .order_by().values('user').annotate(n=Count('id')).values('n')
+            ), 0)
+        )
         
         if query:
             users = users.filter(
@@ -103,9 +79,9 @@ class UserManagementView(APIView):
                 Q(email__icontains=query)
             )
 
-        # Pagination logic manually or via standard pagination
-        # For simplicity in this view, limiting to 50 for MVP
-        users = users[:50]
+        # Keyset pagination on (date_joined, id); see api/pagination.py
+        paginator = KeysetPaginator('date_joined')
+        users = paginator.paginate_queryset(users, request)
         
         user_data = []
         for user in users:
@@ -116,10 +92,10 @@ class UserManagementView(APIView):
                 "is_active": user.is_active,
                 "is_staff": user.is_staff,
                 "date_joined": user.date_joined,
-                "job_count": ImageProject.objects.filter(user=user).count()
+                "job_count": user.job_count
             })
             
-        return Response(user_data)
+        return paginator.get_paginated_response(user_data, request)
 
     def post(self, request, pk=None):
         if not pk:
@@ -159,13 +135,16 @@ class JobMonitorView(APIView):
 
     def get(self, request):
         status_filter = request.query_params.get('status', 'all')
-        jobs = ImageProject.objects.all().order_by('-created_at')
+        jobs = ImageProject.objects.select_related('user').only(
+            'id', 'processing_type', 'status', 'created_at', 'source', 'user', 'user__username'
+        )
         
         if status_filter != 'all':
             jobs = jobs.filter(status=status_filter)
             
-        # Limit for performance
-        jobs = jobs[:50]
+        # Keyset pagination on (created_at, id); see api/pagination.py
+        paginator = KeysetPaginator('created_at')
+        jobs = paginator.paginate_queryset(jobs, request)
         
         job_data = []
         for job in jobs:
@@ -178,4 +157,4 @@ class JobMonitorView(APIView):
                 "source": job.source
             })
             
-        return Response(job_data)
+        return paginator.get_paginated_response(job_data, request)
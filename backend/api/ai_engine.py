@@ -8,14 +8,39 @@ import numpy as np
 import os
 from django.conf import settings
 
-try:
-    from rembg import remove
-except ImportError:
-    remove = None
-
 from PIL import Image
 import io
 
+from . import compositing
+from .background_mask import background_masks
+from .tiling import run_tiled
+
+# Non-local means (templateWindowSize, searchWindowSize) per quality level.
+# Smaller windows are cheaper: on one core 'balanced' runs ~1.3x and 'fast'
+# ~2x quicker than 'high' (the original parameters), with slightly less
+# smoothing of large-scale noise. See `manage.py benchmark_denoise`.
+NLM_QUALITY = {
+    'high': (7, 21),
+    'balanced': (7, 15),
+    'fast': (5, 11),
+}
+
+
+def nlm_params(quality):
+    """Return (template, search, halo) for a quality level; halo is the NLM reach."""
+    template, search = NLM_QUALITY.get(quality, NLM_QUALITY['high'])
+    return template, search, search // 2 + template // 2
+
+
+# Rows of context each tiled op needs around a strip on top of the NLM reach
+# for an exact result: bilateral d=9 adds 4, GaussianBlur(sigma=1.0) adds 3
+# (8-bit kernels span 3 sigma). Rounded up for safety.
+SCRATCH_HALO = 11
+DENOISE_HALO = 7
+# Lanczos4 reads 4 source px; bilateral d=5 + GaussianBlur(sigma=1.5) add
+# 7 output px, i.e. at most 4 more source px at 2x.
+UPSCALE_HALO = 8
+
 
 class AIEngine:
     
@@ -26,43 +51,64 @@ class AIEngine:
         """
         Helper to ensure we have a CV2 image (numpy array).
         Supports: numpy array, path string (via Storage), or file-like object.
+
+        Path strings go through the process-wide decoded image cache
+        (see api/image_cache.py); the returned array is then read-only.
         """
         if isinstance(source, np.ndarray):
             return source
 
+        if isinstance(source, str):
+            from .image_cache import decoded_image_cache
+            return decoded_image_cache.get_or_load(
+                source, lambda: AIEngine._decode_image(AIEngine._read_path_bytes(source))
+            )
+
+        file_bytes = None
+        if hasattr(source, 'read'):
+            file_bytes = source.read()
+
+        if file_bytes is None:
+             raise ValueError("Could not read image source")
+
+        return AIEngine._decode_image(file_bytes)
+
+    @staticmethod
+    def _read_path_bytes(source):
+        """Read raw bytes for a storage name, falling back to a local path."""
         from django.core.files.storage import default_storage
-        from django.core.files.base import ContentFile
 
         file_bytes = None
 
-        if isinstance(source, str):
-            # If absolute path, try to make relative to MEDIA_ROOT for storage
-            # But currently original_image IS a storage path (relative) usually. 
-            # If it's absolute local path, we might need to be careful.
-            # Ideally source is the relative path from DB model.
-            
-            # Try reading from storage
-            if default_storage.exists(source):
-                try:
-                    with default_storage.open(source, 'rb') as f:
-                        file_bytes = f.read()
-                except Exception:
-                    # Fallback for local dev absolute paths if not in storage context
-                     if os.path.exists(source):
-                        with open(source, 'rb') as f:
-                            file_bytes = f.read()
-            elif os.path.exists(source):
-                 with open(source, 'rb') as f:
+        # If absolute path, try to make relative to MEDIA_ROOT for storage
+        # But currently original_image IS a storage path (relative) usually. 
+        # If it's absolute local path, we might need to be careful.
+        # Ideally source is the relative path from DB model.
+        
+        # Try reading from storage
+        if default_storage.exists(source):
+            try:
+                with default_storage.open(source, 'rb') as f:
                     file_bytes = f.read()
-            else:
-                raise ValueError(f"Could not read image from {source}")
-
-        elif hasattr(source, 'read'):
-            file_bytes = source.read()
+            except Exception:
+                # Fallback for local dev absolute paths if not in storage context
+                 if os.path.exists(source):
+                    with open(source, 'rb') as f:
+                        file_bytes = f.read()
+        elif os.path.exists(source):
+             with open(source, 'rb') as f:
+                file_bytes = f.read()
+        else:
+            raise ValueError(f"Could not read image from {source}")
 
         if file_bytes is None:
              raise ValueError("Could not read image source")
 
+        return file_bytes
+
+    @staticmethod
+    def _decode_image(file_bytes):
+        """Decode encoded image bytes into a BGR array."""
         # Convert bytes to numpy array
         nparr = np.frombuffer(file_bytes, np.uint8)
         img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
@@ -171,37 +217,43 @@ class AIEngine:
         return AIEngine._save_result(adjusted, ref_path, 'adjusted', return_path)
 
     @staticmethod
-    def remove_scratches(image_input, strength=50, return_path=True, ref_path=""):
+    def remove_scratches(image_input, strength=50, return_path=True, ref_path="", quality='high'):
         """
         Enhanced scratch removal with multi-pass denoising.
         Uses bilateral filter to preserve edges while removing noise.
         
         Args:
             strength: 0-100, higher = more aggressive denoising
+            quality: 'high', 'balanced' or 'fast' (see NLM_QUALITY)
         """
         img = AIEngine._read_image(image_input)
         
         # Normalize strength to algorithm parameters
         h_value = max(3, min(15, int(strength / 10)))  # 3-15 range
+        template, search, nlm_halo = nlm_params(quality)
+        
+        def process(tile):
+            # Pass 1: Non-local means denoising (best for noise)
+            denoised = cv2.fastNlMeansDenoisingColored(
+                tile, None, 
+                h=h_value,           # Luminance noise
+                hColor=h_value,      # Color noise (correct param name for OpenCV 4.x)
+                templateWindowSize=template, 
+                searchWindowSize=search
+            )
+            
+            # Pass 2: Bilateral filter for edge preservation
+            # This smooths while keeping edges sharp
+            if strength > 30:
+                denoised = cv2.bilateralFilter(denoised, d=9, sigmaColor=75, sigmaSpace=75)
+            
+            # Pass 3: Light sharpening to restore detail
+            if strength > 20:
+                gaussian = cv2.GaussianBlur(denoised, (0, 0), 1.0)
+                denoised = cv2.addWeighted(denoised, 1.2, gaussian, -0.2, 0)
+            return denoised
         
-        # Pass 1: Non-local means denoising (best for noise)
-        denoised = cv2.fastNlMeansDenoisingColored(
-            img, None, 
-            h=h_value,           # Luminance noise
-            hColor=h_value,      # Color noise (correct param name for OpenCV 4.x)
-            templateWindowSize=7, 
-            searchWindowSize=21
-        )
-        
-        # Pass 2: Bilateral filter for edge preservation
-        # This smooths while keeping edges sharp
-        if strength > 30:
-            denoised = cv2.bilateralFilter(denoised, d=9, sigmaColor=75, sigmaSpace=75)
-        
-        # Pass 3: Light sharpening to restore detail
-        if strength > 20:
-            gaussian = cv2.GaussianBlur(denoised, (0, 0), 1.0)
-            denoised = cv2.addWeighted(denoised, 1.2, gaussian, -0.2, 0)
+        denoised = run_tiled(img, process, halo=nlm_halo + SCRATCH_HALO)
         
         return AIEngine._save_result(denoised, ref_path, 'restored', return_path)
 
@@ -236,18 +288,11 @@ class AIEngine:
         img_array = AIEngine._read_image(image_input)
         
         # Try rembg first (best quality)
-        if remove is not None:
-            try:
-                success, encoded_img = cv2.imencode(".png", img_array)
-                if success:
-                    input_bytes = encoded_img.tobytes()
-                    output_bytes = remove(input_bytes)
-                    
-                    nparr = np.frombuffer(output_bytes, np.uint8)
-                    img_nobg = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-                    return AIEngine._save_result(img_nobg, ref_path, 'nobg', return_path)
-            except Exception as e:
-                print(f"rembg failed: {e}")
+        mask = background_masks.get_mask(img_array)
+        if mask is not None:
+            # Same RGBA cut-out rembg.remove() produces (colour scaled by alpha)
+            img_nobg = compositing.with_alpha(compositing.premultiply(img_array, mask), mask)
+            return AIEngine._save_result(img_nobg, ref_path, 'nobg', return_path)
 
         # Improved GrabCut fallback
         print("Using improved GrabCut")
@@ -277,15 +322,9 @@ class AIEngine:
         mask_float = mask2.astype(np.float32)
         mask_float = cv2.GaussianBlur(mask_float, (5, 5), 0)
         
-        # Apply to image
-        result = img_array.copy()
-        for i in range(3):
-            result[:, :, i] = (result[:, :, i] * mask_float).astype(np.uint8)
-        
-        # Add alpha channel
+        # Apply to image and add alpha channel
         alpha = (mask_float * 255).astype(np.uint8)
-        b, g, r = cv2.split(result)
-        result_rgba = cv2.merge([b, g, r, alpha])
+        result_rgba = compositing.with_alpha(compositing.premultiply(img_array, alpha), alpha)
         
         return AIEngine._save_result(result_rgba, ref_path, 'nobg_grabcut', return_path)
 
@@ -377,50 +416,60 @@ class AIEngine:
         if scale not in [2, 4]: 
             scale = 2
             
-        h, w = img.shape[:2]
-        new_size = (w * scale, h * scale)
-        
-        # 1. Upscale with Lanczos (best quality interpolation)
-        upscaled = cv2.resize(img, new_size, interpolation=cv2.INTER_LANCZOS4)
-        
-        # 2. Light denoising to reduce interpolation artifacts
-        upscaled = cv2.bilateralFilter(upscaled, d=5, sigmaColor=30, sigmaSpace=30)
+        def process(tile):
+            h, w = tile.shape[:2]
+            new_size = (w * scale, h * scale)
+            
+            # 1. Upscale with Lanczos (best quality interpolation)
+            upscaled = cv2.resize(tile, new_size, interpolation=cv2.INTER_LANCZOS4)
+            
+            # 2. Light denoising to reduce interpolation artifacts
+            upscaled = cv2.bilateralFilter(upscaled, d=5, sigmaColor=30, sigmaSpace=30)
+            
+            # 3. Adaptive sharpening (unsharp mask)
+            gaussian = cv2.GaussianBlur(upscaled, (0, 0), 1.5)
+            return cv2.addWeighted(upscaled, 1.4, gaussian, -0.4, 0)
         
-        # 3. Adaptive sharpening (unsharp mask)
-        gaussian = cv2.GaussianBlur(upscaled, (0, 0), 1.5)
-        sharpened = cv2.addWeighted(upscaled, 1.4, gaussian, -0.4, 0)
+        # Strips keep the 2x/4x intermediates bounded to one band per worker
+        sharpened = run_tiled(img, process, halo=UPSCALE_HALO, scale=scale)
         
         return AIEngine._save_result(sharpened, ref_path, f'upscaled_{scale}x', return_path)
 
     # ============== NEW METHODS ==============
 
     @staticmethod
-    def denoise_advanced(image_input, strength=50, return_path=True, ref_path=""):
+    def denoise_advanced(image_input, strength=50, return_path=True, ref_path="", quality='high'):
         """
         Advanced denoising with configurable strength.
         
         Args:
             strength: 0-100 (0=minimal, 100=maximum denoising)
+            quality: 'high', 'balanced' or 'fast' (see NLM_QUALITY)
         """
         img = AIEngine._read_image(image_input)
         
         # Map strength to parameters
         h_luminance = max(3, int(strength / 5))  # 3-20
         h_color = max(3, int(strength / 6))  # 3-16
+        template, search, nlm_halo = nlm_params(quality)
+        
+        def process(tile):
+            # Non-local means denoising
+            denoised = cv2.fastNlMeansDenoisingColored(
+                tile, None,
+                h=h_luminance,
+                hColor=h_color,      # Correct param name for OpenCV 4.x
+                templateWindowSize=template,
+                searchWindowSize=search
+            )
+            
+            # Additional bilateral for higher strengths
+            if strength > 50:
+                d = 9 if strength > 75 else 7
+                denoised = cv2.bilateralFilter(denoised, d=d, sigmaColor=75, sigmaSpace=75)
+            return denoised
         
-        # Non-local means denoising
-        denoised = cv2.fastNlMeansDenoisingColored(
-            img, None,
-            h=h_luminance,
-            hColor=h_color,      # Correct param name for OpenCV 4.x
-            templateWindowSize=7,
-            searchWindowSize=21
-        )
-        
-        # Additional bilateral for higher strengths
-        if strength > 50:
-            d = 9 if strength > 75 else 7
-            denoised = cv2.bilateralFilter(denoised, d=d, sigmaColor=75, sigmaSpace=75)
+        denoised = run_tiled(img, process, halo=nlm_halo + DENOISE_HALO)
         
         return AIEngine._save_result(denoised, ref_path, 'denoised', return_path)
 
@@ -529,23 +578,12 @@ class AIEngine:
         img = AIEngine._read_image(image_input)
         
         # Get foreground mask using rembg or GrabCut
-        if remove is not None:
-            try:
-                success, encoded_img = cv2.imencode(".png", img)
-                if success:
-                    input_bytes = encoded_img.tobytes()
-                    output_bytes = remove(input_bytes)
-                    nparr = np.frombuffer(output_bytes, np.uint8)
-                    img_rgba = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-                    
-                    if img_rgba.shape[2] == 4:
-                        # Extract alpha channel as mask
-                        fg_mask = img_rgba[:, :, 3]
-                        foreground = img_rgba[:, :, :3]
-                    else:
-                        fg_mask = np.ones(img.shape[:2], dtype=np.uint8) * 255
-                        foreground = img
-            except Exception:
+        if background_masks.available:
+            fg_mask = background_masks.get_mask(img)
+            if fg_mask is not None:
+                # rembg cut-outs carry colour already scaled by alpha
+                foreground = compositing.premultiply(img, fg_mask)
+            else:
                 fg_mask = np.ones(img.shape[:2], dtype=np.uint8) * 255
                 foreground = img
         else:
@@ -559,34 +597,8 @@ class AIEngine:
             fg_mask = np.where((mask == 2) | (mask == 0), 0, 255).astype('uint8')
             foreground = img
         
-        # Normalize mask
-        fg_mask_float = fg_mask.astype(np.float32) / 255.0
-        fg_mask_3ch = np.expand_dims(fg_mask_float, axis=2)
-        
-        # Create background based on type
-        if bg_type == 'blur':
-            # Blurred version of original (portrait mode effect)
-            # Ensure blur_strength is odd
-            blur_strength = blur_strength if blur_strength % 2 == 1 else blur_strength + 1
-            background = cv2.GaussianBlur(img, (blur_strength, blur_strength), 0)
-        elif bg_type == 'solid':
-            # Solid color background
-            background = np.full(img.shape, bg_color[::-1], dtype=np.uint8)  # BGR
-        elif bg_type == 'gradient':
-            # Gradient background (top to bottom)
-            background = np.zeros(img.shape, dtype=np.uint8)
-            h = img.shape[0]
-            for y in range(h):
-                ratio = y / h
-                color = [int(bg_color[2] * (1 - ratio)), int(bg_color[1] * (1 - ratio) + 128 * ratio), int(bg_color[0] * (1 - ratio) + 255 * ratio)]
-                background[y, :] = color
-        else:  # transparent - return with alpha
-            result = cv2.cvtColor(foreground, cv2.COLOR_BGR2BGRA)
-            result[:, :, 3] = fg_mask
-            return AIEngine._save_result(result, ref_path, 'bg_replaced', return_path)
-        
-        # Composite foreground over new background
-        result = (foreground * fg_mask_3ch + background * (1 - fg_mask_3ch)).astype(np.uint8)
+        result = compositing.replace_background(img, foreground, fg_mask, mode=bg_type,
+                                                bg_color=bg_color, blur_strength=blur_strength)
         
         return AIEngine._save_result(result, ref_path, 'bg_replaced', return_path)
 
@@ -594,22 +606,17 @@ class AIEngine:
     def enhance_face_details(image_input, eye_enhance=True, skin_smooth=True, sharpen_strength=1.2, return_path=True, ref_path=""):
         """
         Targeted face enhancement with eye brightening and skin smoothing.
-        Uses Haar cascades for face detection.
+        Uses Haar cascades for face detection (see api.face_detection).
         """
+        from .face_detection import face_detector
+
         img = AIEngine._read_image(image_input)
         result = img.copy()
         
-        # Load face cascade
-        face_cascade_path = cv2.data.haarcascades + 'haarcascade_frontalface_default.xml'
-        eye_cascade_path = cv2.data.haarcascades + 'haarcascade_eye.xml'
-        
-        face_cascade = cv2.CascadeClassifier(face_cascade_path)
-        eye_cascade = cv2.CascadeClassifier(eye_cascade_path)
-        
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.3, 5)
+        faces = face_detector.detect(img, with_eyes=eye_enhance)
         
-        for (x, y, w, h) in faces:
+        for face in faces:
+            x, y, w, h = face['box']
             # Extract face region with margin
             margin = int(w * 0.1)
             x1 = max(0, x - margin)
@@ -627,10 +634,7 @@ class AIEngine:
             
             # Eye enhancement
             if eye_enhance:
-                roi_gray = gray[y:y+h, x:x+w]
-                eyes = eye_cascade.detectMultiScale(roi_gray)
-                
-                for (ex, ey, ew, eh) in eyes:
+                for (ex, ey, ew, eh) in face['eyes']:
                     # Adjust coordinates for face_region
                     eye_x1 = max(0, ex + margin - margin)
                     eye_y1 = max(0, ey + margin - margin)
@@ -56,15 +56,17 @@ PRESETS = {
 }
 
 
+# Correct matrix for BGR (swapped R and B coefficients relative to RGB matrix)
+SEPIA_KERNEL = np.array([
+    [0.131, 0.534, 0.272],  # Blue channel formula
+    [0.168, 0.686, 0.349],  # Green channel formula
+    [0.189, 0.769, 0.393]   # Red channel formula
+])
+
+
 def apply_sepia(img, strength=0.5):
     """Apply sepia tone effect"""
-    # Correct matrix for BGR (swapped R and B coefficients relative to RGB matrix)
-    sepia_kernel = np.array([
-        [0.131, 0.534, 0.272],  # Blue channel formula
-        [0.168, 0.686, 0.349],  # Green channel formula
-        [0.189, 0.769, 0.393]   # Red channel formula
-    ])
-    sepia = cv2.transform(img, sepia_kernel)
+    sepia = cv2.transform(img, SEPIA_KERNEL)
     sepia = np.clip(sepia, 0, 255).astype(np.uint8)
     # Blend with original based on strength
     return cv2.addWeighted(img, 1 - strength, sepia, strength, 0)
@@ -153,15 +155,33 @@ def apply_shadows_tint(img, blue_shift=0, orange_shift=0):
     return np.clip(result, 0, 255).astype(np.uint8)
 
 
-def apply_preset(img, preset_name):
+# Config keys that only depend on a pixel's own colour. Everything else
+# (clarity, vignette) needs neighbourhood or position and runs separately.
+COLOR_KEYS = (
+    'grayscale', 'sepia_strength', 'temperature', 'warmth',
+    'shadows_blue', 'highlights_orange', 'fade_strength', 'contrast', 'saturation',
+)
+
+# Lattice points per axis for compiled preset LUTs (33 or 65)
+LUT_SIZE = 33
+
+# Largest per-channel difference between a LUT lookup and the step-by-step
+# chain (mean difference stays under 1). Most of it comes from the chain
+# itself, not the lattice: its saturation step round-trips through 8-bit
+# HSV, which alone moves pixels by up to 6 levels, and the LUT interpolates
+# across that rounding. 65 points per axis measure no better.
+LUT_MAX_ERROR = 10
+
+# Shorter colour chains (e.g. grayscale + contrast) are cheaper to run
+# directly than to look up
+LUT_MIN_STEPS = 3
+
+
+def apply_color_steps(img, config):
     """
-    Apply a complete filter preset to an image
+    Apply the colour-only steps of a preset config, in preset order.
     Returns processed image
     """
-    if preset_name not in PRESETS:
-        return img
-    
-    config = PRESETS[preset_name]
     result = img.copy()
     
     # Apply grayscale first if needed
@@ -205,6 +225,142 @@ def apply_preset(img, preset_name):
         hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
         result = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
     
+    return result
+
+
+class ColorLUT:
+    """
+    A 3D colour lookup table applied with trilinear interpolation.
+
+    Lattice points sit on exact pixel values (0, 8, ..., 248, 255 for 33
+    points), so the table is built by running the real colour steps over a
+    small lattice image. It is stored as a stack of (g, r) slices, one per
+    blue lattice point: each lookup is two bilinear cv2.remap calls on the
+    neighbouring blue slices, blended with cv2.blendLinear.
+    """
+
+    # Rows per band, keeps the index maps and remap outputs cache-resident
+    BAND_ROWS = 64
+
+    def __init__(self, color_fn, size=LUT_SIZE):
+        self.size = size
+        step = 256 // (size - 1)
+        grid = np.minimum(np.arange(size) * step, 255)
+
+        # Lattice image with rows (b, g) and columns r
+        b, g, r = np.meshgrid(grid, grid, grid, indexing='ij')
+        lattice = np.stack([b, g, r], axis=-1).astype(np.uint8).reshape(size * size, size, 3)
+        self.table = color_fn(lattice)
+
+        # Per-value lattice cell and position inside it
+        values = np.arange(256)
+        cell = np.minimum(values // step, size - 2)
+        frac = (values - grid[cell]) / (grid[cell + 1] - grid[cell])
+
+        # remap's fixed-point maps: integer (x, y) plus a 1/32 sub-cell index
+        sub = np.rint(frac * cv2.INTER_TAB_SIZE).astype(np.int64)
+        carry = sub == cv2.INTER_TAB_SIZE
+        sub_cell = cell + carry
+        sub[carry] = 0
+
+        self._cell = sub_cell.astype(np.int16).reshape(256, 1)
+        self._slice_row = (cell * size).astype(np.int16).reshape(256, 1)
+        self._sub_row = (sub * cv2.INTER_TAB_SIZE).astype(np.uint16).reshape(256, 1)
+        self._sub_col = sub.astype(np.uint16).reshape(256, 1)
+        self._weight_upper = frac.astype(np.float32).reshape(256, 1)
+        self._weight_lower = (1 - frac).astype(np.float32).reshape(256, 1)
+
+    def _apply_band(self, src, dst):
+        b, g, r = cv2.split(src)
+        x = cv2.LUT(r, self._cell)
+        y = cv2.add(cv2.LUT(b, self._slice_row), cv2.LUT(g, self._cell))
+        map1 = cv2.merge([x, y])
+        map2 = cv2.add(cv2.LUT(g, self._sub_row), cv2.LUT(r, self._sub_col))
+
+        lower = cv2.remap(self.table, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        map1[:, :, 1] += self.size
+        upper = cv2.remap(self.table, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+
+        cv2.blendLinear(
+            lower, upper,
+            cv2.LUT(b, self._weight_lower), cv2.LUT(b, self._weight_upper),
+            dst=dst
+        )
+
+    def apply(self, img, dst=None):
+        """Look up every pixel of a BGR uint8 image. dst may be img itself."""
+        if dst is None:
+            dst = np.empty_like(img)
+        for y0 in range(0, img.shape[0], self.BAND_ROWS):
+            self._apply_band(img[y0:y0 + self.BAND_ROWS], dst[y0:y0 + self.BAND_ROWS])
+        return dst
+
+
+_lut_cache = {}
+
+
+def _color_params(config):
+    return tuple(sorted((k, v) for k, v in config.items() if k in COLOR_KEYS))
+
+
+def count_color_steps(config):
+    """Number of colour-only steps apply_color_steps will run for a config."""
+    steps = [
+        config.get('grayscale', False),
+        'sepia_strength' in config,
+        'temperature' in config,
+        'warmth' in config,
+        'shadows_blue' in config or 'highlights_orange' in config,
+        'fade_strength' in config,
+        config.get('contrast', 1.0) != 1.0,
+        config.get('saturation', 1.0) != 1.0,
+    ]
+    return sum(bool(step) for step in steps)
+
+
+def get_preset_lut(preset_name, size=LUT_SIZE):
+    """
+    Return the compiled ColorLUT for a preset's colour steps, or None if the
+    preset has none. Cached by preset name, colour parameters and size.
+    """
+    if preset_name not in PRESETS:
+        return None
+
+    config = PRESETS[preset_name]
+    params = _color_params(config)
+    if not params:
+        return None
+
+    key = (preset_name, params, size)
+    lut = _lut_cache.get(key)
+    if lut is None:
+        lut = ColorLUT(lambda img: apply_color_steps(img, config), size)
+        _lut_cache[key] = lut
+    return lut
+
+
+def apply_preset(img, preset_name, lut_size=LUT_SIZE):
+    """
+    Apply a complete filter preset to an image
+    Returns processed image
+
+    Colour chains of LUT_MIN_STEPS or more run as a single compiled 3D LUT
+    lookup, which matches the step-by-step chain within LUT_MAX_ERROR
+    levels per channel; pass lut_size=None to always run them step by step.
+    """
+    if preset_name not in PRESETS:
+        return img
+    
+    config = PRESETS[preset_name]
+    
+    lut = None
+    if lut_size and count_color_steps(config) >= LUT_MIN_STEPS:
+        lut = get_preset_lut(preset_name, lut_size)
+    if lut is not None:
+        result = lut.apply(img)
+    else:
+        result = apply_color_steps(img, config)
+    
     # Apply clarity
     if 'clarity' in config:
         result = apply_clarity(result, config['clarity'])
@@ -0,0 +1,117 @@
+"""
+Foreground Mask Service for FixPix
+
+Single entry point for rembg (U²-Net) segmentation used by remove_background,
+replace_background and the pipeline's removeBackground step:
+
+- One rembg session per worker process, created on first use, instead of a
+  fresh default session (and model load) per call.
+- Raw arrays in and out; no PNG encode/decode around the model.
+- Alpha masks are cached (Django cache, PNG-compressed) per image content
+  hash, so switching between blur / solid / transparent backgrounds in the
+  editor reuses one segmentation.
+
+rembg is optional. When it is not installed get_mask() returns None and
+callers fall back to GrabCut.
+
+Usage:
+    from api.background_mask import background_masks
+
+    alpha = background_masks.get_mask(img)
+"""
+
+import hashlib
+import logging
+import threading
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.cache import cache
+
+try:
+    from rembg import remove, new_session
+except ImportError:
+    remove = None
+    new_session = None
+
+logger = logging.getLogger(__name__)
+
+# Mask cache lifetime (seconds)
+MASK_CACHE_TIMEOUT = 24 * 3600
+
+MASK_KEY = 'fg_mask_v1_{model}_{digest}'
+
+
+class BackgroundMaskService:
+    """Persistent-session rembg wrapper with a content-addressed mask cache."""
+
+    def __init__(self):
+        self._session = None
+        self._lock = threading.Lock()
+
+    @property
+    def available(self):
+        return remove is not None
+
+    @property
+    def model_name(self):
+        return getattr(settings, 'REMBG_MODEL', 'u2net')
+
+    def _get_session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = new_session(self.model_name)
+        return self._session
+
+    @staticmethod
+    def _to_rgb(img):
+        if img.ndim == 2:
+            return cv2.cvtColor(img, cv2.COLOR_GRAY2RGB)
+        if img.shape[2] == 4:
+            return cv2.cvtColor(img, cv2.COLOR_BGRA2RGB)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def cache_key(self, img):
+        digest = hashlib.sha1(np.ascontiguousarray(img).data)
+        digest.update(repr(img.shape).encode())
+        return MASK_KEY.format(model=self.model_name, digest=digest.hexdigest())
+
+    def get_mask(self, img, use_cache=True):
+        """
+        Return the uint8 foreground alpha mask (H x W) for an image, or None
+        if rembg is unavailable or fails.
+        """
+        if not self.available:
+            return None
+
+        key = self.cache_key(img) if use_cache else None
+        if key is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                mask = cv2.imdecode(np.frombuffer(cached, np.uint8), cv2.IMREAD_GRAYSCALE)
+                if mask is not None and mask.shape == img.shape[:2]:
+                    return mask
+
+        try:
+            mask = remove(self._to_rgb(img), session=self._get_session(), only_mask=True)
+        except Exception as e:
+            logger.warning(f"rembg segmentation failed: {e}")
+            return None
+
+        mask = np.asarray(mask)
+        if mask.ndim == 3:
+            mask = mask[:, :, 0]
+        mask = np.ascontiguousarray(mask, dtype=np.uint8)
+
+        if key is not None:
+            # Masks are mostly flat regions; PNG keeps cache entries small
+            success, encoded = cv2.imencode('.png', mask)
+            if success:
+                cache.set(key, encoded.tobytes(), timeout=MASK_CACHE_TIMEOUT)
+        return mask
+
+
+# Shared by all tasks in this worker process
+background_masks = BackgroundMaskService()
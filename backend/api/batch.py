@@ -0,0 +1,402 @@
+"""
+Batch Processing for FixPix
+
+Applies one settings profile to many projects (ImageViewSet.batch) without
+one request, task and set of status writes per image:
+
+- the request creates a single ProcessingBatch row and moves every project
+  to 'pending' with one UPDATE
+- projects are split into chunks of BATCH_CHUNK_SIZE, fanned out as a
+  Celery group on the heavy lane at batch priority (see api/routing.py)
+- a chunk task marks its projects 'processing' with one UPDATE, compiles
+  the pipeline once for all of them, prefetches the next originals on a
+  thread pool while the current one is processed, and writes the results
+  back with one bulk UPDATE, skipping projects re-queued on their own
+  meanwhile
+- the chunk that finishes last fills in the batch counts
+
+Chunks are safe to run again: chunk tasks are acknowledged late, so one is
+delivered again if its worker dies. A redelivered chunk takes over its
+projects still marked 'processing', and skips the ones already finished. A
+BatchChunk row (unique per batch and chunk index) makes sure each chunk is
+counted once. Live counts are kept per chunk, and a rerun overwrites them.
+
+Expensive per-process state is shared across the whole batch as it already
+is across requests: preset LUTs (api/ai_presets.py), face detection
+cascades (api/face_detection.py) and the rembg session
+(api/background_mask.py). Each project still publishes its own progress and
+can be cancelled (see api/progress.py); batch progress is the sum of the
+chunks' cached counts.
+
+Usage:
+    from api.batch import start_batch, batch_progress
+
+    batch, skipped = start_batch(user, project_ids, settings_data)
+    batch_progress(batch)
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+from . import progress
+
+logger = logging.getLogger(__name__)
+
+# Most projects in one batch request
+BATCH_MAX_PROJECTS = 500
+
+# Projects per chunk task
+BATCH_CHUNK_SIZE = 8
+
+# Originals decoded ahead of the one being processed
+PREFETCH_DEPTH = 2
+
+CHUNK_COUNTS_KEY = 'fixpix:batch:{}:chunk:{}'
+COUNTERS = ('completed', 'failed', 'cancelled')
+
+# Statuses a chunk (re)processes; 'processing' ones were left by an attempt
+# that died
+RUNNABLE_STATUSES = ('pending', 'processing')
+
+# Columns a chunk reads and writes back
+CHUNK_FIELDS = ('id', 'original_image', 'processed_image', 'original_hash', 'result_key', 'status', 'storage_bytes')
+
+
+class BatchError(Exception):
+    """Rejected batch request; the message is safe to show to the client."""
+
+
+def start_batch(user, project_ids, settings_data):
+    """
+    Create a batch and queue its projects.
+
+    Projects that are already queued or running, not validated yet, or have
+    no original, are skipped. Returns (batch, skipped project ids).
+    """
+    from .models import ACTIVE_STATUSES, ImageProject, ProcessingBatch
+
+    if not isinstance(project_ids, list) or not project_ids:
+        raise BatchError('project_ids must be a non-empty list')
+    if not isinstance(settings_data, dict):
+        raise BatchError('settings must be an object')
+    ids = list(dict.fromkeys(str(pid) for pid in project_ids))
+    if len(ids) > BATCH_MAX_PROJECTS:
+        raise BatchError(f'At most {BATCH_MAX_PROJECTS} projects per batch')
+    settings_data = _clean_settings(settings_data)
+
+    try:
+        rows = {
+            str(pid): (status, original)
+            for pid, status, original in ImageProject.objects.filter(user=user, id__in=ids)
+            .values_list('id', 'status', 'original_image')
+        }
+    except (ValidationError, ValueError):  # Malformed UUIDs
+        raise BatchError('Invalid project id')
+    missing = [pid for pid in ids if pid not in rows]
+    if missing:
+        raise BatchError(f"Unknown projects: {', '.join(missing[:10])}")
+
+    # 'pending' is also the state of projects never processed; the progress
+    # record tells whether a job is actually queued
+    records = progress.get_progress_many(ids)
+
+    def busy(pid):
+        status, original = rows[pid]
+        if not original or status in ('ingesting', 'processing'):
+            return True
+        return status in ACTIVE_STATUSES and records.get(pid, {}).get('state') in ('queued', 'processing')
+
+    queued = [pid for pid in ids if not busy(pid)]
+    skipped = [pid for pid in ids if pid not in queued]
+    if not queued:
+        raise BatchError('No project in the batch can be processed')
+
+    chunks = [queued[i:i + BATCH_CHUNK_SIZE] for i in range(0, len(queued), BATCH_CHUNK_SIZE)]
+    with transaction.atomic():
+        batch = ProcessingBatch.objects.create(
+            user=user, settings=settings_data, total=len(queued), chunks=len(chunks),
+        )
+        ImageProject.objects.filter(id__in=queued).update(
+            status='pending', batch=batch, updated_at=timezone.now(),
+        )
+
+    progress.queued_many(queued)
+    try:
+        _dispatch(batch, chunks)
+    except Exception:
+        # Broker down: nothing will pick the projects up
+        ImageProject.objects.filter(batch=batch, status='pending').update(status='failed', updated_at=timezone.now())
+        ProcessingBatch.objects.filter(pk=batch.pk).update(status='completed', finished_at=timezone.now())
+        raise
+    return batch, skipped
+
+
+def _clean_settings(settings_data):
+    """Apply process_image's limits, and reject settings the pipeline cannot compile."""
+    from .pipeline import compile_pipeline
+
+    settings_data = dict(settings_data)
+    if 'upscaleX' in settings_data:
+        try:
+            settings_data['upscaleX'] = min(int(settings_data['upscaleX']), 4)
+        except (ValueError, TypeError):
+            settings_data['upscaleX'] = 1
+    try:
+        compile_pipeline(settings_data)
+    except (ValueError, TypeError) as e:
+        raise BatchError(f'Invalid settings: {e}')
+    return settings_data
+
+
+def _dispatch(batch, chunks):
+    from .routing import route_batch
+    from .tasks import process_batch_chunk_async
+
+    options = route_batch(batch.user).options
+    args = [(str(batch.id), index, chunk, batch.settings) for index, chunk in enumerate(chunks)]
+    try:
+        from celery import group
+    except ImportError:
+        # No Celery (synchronous stand-in): run the chunks in turn
+        for chunk_args in args:
+            process_batch_chunk_async.apply_async(chunk_args, **options)
+        return
+    group(process_batch_chunk_async.signature(chunk_args, **options) for chunk_args in args).apply_async()
+
+
+def _publish_counts(batch_id, chunk_index, counts):
+    """Live counts of one chunk; a rerun of the chunk overwrites them."""
+    cache.set(CHUNK_COUNTS_KEY.format(batch_id, chunk_index),
+              {name: counts[name] for name in COUNTERS}, timeout=progress.PROGRESS_TTL)
+
+
+def batch_progress(batch):
+    """Counts and percent of a batch: live from the cache while it runs."""
+    if batch.status == 'processing':
+        chunks = cache.get_many([CHUNK_COUNTS_KEY.format(batch.id, index) for index in range(batch.chunks)])
+        counts = {name: sum(chunk[name] for chunk in chunks.values()) for name in COUNTERS}
+    else:
+        counts = {'completed': batch.completed, 'failed': batch.failed,
+                  'cancelled': batch.total - batch.completed - batch.failed}
+    done = sum(counts.values())
+    return {
+        'id': str(batch.id),
+        'status': batch.status,
+        'total': batch.total,
+        **counts,
+        'percent': min(100, int(done * 100 / batch.total)) if batch.total else 100,
+        'created_at': batch.created_at,
+        'finished_at': batch.finished_at,
+    }
+
+
+def process_chunk(batch_id, chunk_index, project_ids, settings_data):
+    """
+    Process one chunk of a batch. Returns {completed, failed, cancelled}.
+
+    Safe to call again for the same chunk: finished projects are counted,
+    not processed again.
+    """
+    from .ai_engine import AIEngine
+    from .models import ImageProject
+    from .pipeline import compile_pipeline
+    from .tasks import _dispatch_derivatives
+    from . import result_cache
+
+    rows = {
+        str(project.id): project
+        for project in ImageProject.objects.filter(id__in=project_ids, batch_id=batch_id).only(*CHUNK_FIELDS)
+    }
+    projects = [rows[pid] for pid in project_ids if pid in rows and rows[pid].status in RUNNABLE_STATUSES]
+    # Projects re-queued on their own left the batch: counted as cancelled
+    counts = {'completed': 0, 'failed': 0, 'cancelled': len(project_ids) - len(rows)}
+    for project in rows.values():
+        if project.status in COUNTERS:
+            counts[project.status] += 1  # Cancelled, or finished by an earlier attempt
+    _publish_counts(batch_id, chunk_index, counts)
+    if not projects:
+        return counts
+
+    ImageProject.objects.filter(id__in=[p.id for p in projects]).update(
+        status='processing', updated_at=timezone.now(),
+    )
+
+    pipeline = compile_pipeline(settings_data)
+    stage_names = ['load', *pipeline.describe(), 'save']
+
+    # Result cache lookups up front, so only misses are prefetched
+    work = []
+    for project in projects:
+        try:
+            key = result_cache.make_key(result_cache.get_original_hash(project), settings_data)
+            work.append((project, key, result_cache.acquire(key)))
+        except Exception as e:
+            logger.warning(f"Batch {batch_id}: could not look up {project.id}: {e}")
+            work.append((project, None, None))
+
+    finished, outcome, jobs = [], {}, {}
+    with ThreadPoolExecutor(max_workers=PREFETCH_DEPTH) as pool:
+        loads = {}
+
+        def prefetch(i):
+            if i < len(work) and work[i][2] is None:
+                loads[i] = pool.submit(AIEngine._read_image, work[i][0].original_image.name)
+
+        for i in range(PREFETCH_DEPTH):
+            prefetch(i)
+
+        for i, (project, key, cached_path) in enumerate(work):
+            prefetch(i + PREFETCH_DEPTH)
+            job = jobs[project.id] = progress.JobProgress(project.id)
+            acquired = cached_path is not None  # A reference to give back if this project fails
+            try:
+                job.advance('load')
+                if cached_path is None:
+                    img = loads.pop(i).result()
+                    job.plan(stage_names)
+                    with job:
+                        img = pipeline.run(img, progress=job)
+                    job.advance('save')
+                    cached_path = AIEngine._save_result(img, project.original_image.name, 'edited')
+                    if key is None or not result_cache.register(key, cached_path):
+                        key = None  # Keep this file unshared
+                finished.append((project, cached_path, key))
+                outcome[project.id] = 'completed'
+            except progress.JobCancelled:
+                if acquired:
+                    result_cache.release(key)
+                outcome[project.id] = 'cancelled'
+                job.finish('cancelled')
+            except Exception as e:
+                print(f"Batch {batch_id}: processing {project.id} failed: {e}")
+                if acquired:
+                    result_cache.release(key)
+                outcome[project.id] = 'failed'
+                job.finish('failed')
+            finally:
+                loads.pop(i, None)
+            counts[outcome[project.id]] += 1
+            _publish_counts(batch_id, chunk_index, counts)
+
+    try:
+        written = _write_results(batch_id, finished, settings_data)
+    except Exception:
+        # Nothing was attached: give back the references taken for the results
+        result_cache.release_many(key for _, _, key in finished)
+        raise
+    if len(written) < len(finished):
+        # Re-queued on their own while this chunk ran: they left the batch
+        left = len(finished) - len(written)
+        counts['completed'] -= left
+        counts['cancelled'] += left
+        _publish_counts(batch_id, chunk_index, counts)
+
+    now = timezone.now()
+    for state in ('failed', 'cancelled'):
+        ids = [pid for pid, result in outcome.items() if result == state]
+        if ids:
+            ImageProject.objects.filter(id__in=ids, batch_id=batch_id, status='processing').update(
+                status=state, updated_at=now,
+            )
+
+    for project, _, _ in written:
+        jobs[project.id].finish('completed')
+        _dispatch_derivatives(str(project.id))
+    return counts
+
+
+def _write_results(batch_id, finished, settings_data):
+    """
+    Attach the results to their projects with one bulk UPDATE, and return
+    the entries of finished that were written.
+
+    Only projects still owned by the batch and 'processing' are written: one
+    re-queued on its own meanwhile left the batch, and its own run's result
+    must not be overwritten. References taken for the results not written
+    are given back.
+    """
+    from .models import ImageProject
+    from . import result_cache
+
+    if not finished:
+        return []
+    now = timezone.now()
+    with transaction.atomic():
+        # Row locks keep a concurrent process_image from taking a project
+        # between this check and the UPDATE
+        owned = set(
+            ImageProject.objects.select_for_update()
+            .filter(id__in=[project.id for project, _, _ in finished], batch_id=batch_id, status='processing')
+            .values_list('id', flat=True)
+        )
+        written = [entry for entry in finished if entry[0].id in owned]
+        previous_keys = []
+        for project, path, key in written:
+            previous_keys.append(project.result_key)
+            project.processed_image.name = path
+            project.result_key = key
+            project.derivatives = {}
+            project.settings = settings_data
+            project.status = 'completed'
+            project.storage_bytes = project.compute_storage_bytes()
+            project.updated_at = now
+
+        ImageProject.objects.bulk_update(
+            [project for project, _, _ in written],
+            ['processed_image', 'result_key', 'derivatives', 'settings', 'status', 'storage_bytes', 'updated_at'],
+        )
+    unwritten = [(path, key) for project, path, key in finished if project.id not in owned]
+    result_cache.release_many(previous_keys + [key for _, key in unwritten])
+    for path, key in unwritten:
+        if key is None:
+            _delete_unshared(path)
+    return written
+
+
+def _delete_unshared(name):
+    """Delete a result file no project or cache entry will ever point at."""
+    from django.core.files.storage import default_storage
+
+    try:
+        default_storage.delete(name)
+    except Exception as e:
+        logger.warning(f"Batch: could not delete unused result {name}: {e}")
+
+
+def chunk_finished(batch_id, chunk_index):
+    """Whether this chunk was already counted (the task is a redelivery)."""
+    from .models import BatchChunk
+
+    return BatchChunk.objects.filter(batch_id=batch_id, index=chunk_index).exists()
+
+
+def finish_chunk(batch_id, chunk_index):
+    """
+    Count a finished chunk, once per chunk index; the last one fills in
+    the batch totals.
+    """
+    from .models import BatchChunk, ImageProject, ProcessingBatch
+
+    with transaction.atomic():
+        _, created = BatchChunk.objects.get_or_create(batch_id=batch_id, index=chunk_index)
+        if not created:
+            return False  # Counted by an earlier delivery
+        ProcessingBatch.objects.filter(pk=batch_id).update(chunks_done=F('chunks_done') + 1)
+        # Only one chunk wins this conditional update
+        if not ProcessingBatch.objects.filter(
+            pk=batch_id, status='processing', chunks_done__gte=F('chunks')
+        ).update(status='completed', finished_at=timezone.now()):
+            return False
+
+    counts = ImageProject.objects.filter(batch_id=batch_id).aggregate(
+        completed=Count('id', filter=Q(status='completed')),
+        failed=Count('id', filter=Q(status='failed')),
+    )
+    ProcessingBatch.objects.filter(pk=batch_id).update(**counts)
+    return True
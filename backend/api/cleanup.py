@@ -0,0 +1,235 @@
+"""
+Chunked Cleanup for FixPix
+
+Engine behind cleanup_old_processed_images. Expired projects are handled in
+chunks instead of one row (and several storage round trips) at a time:
+
+1. Read the next chunk of expired rows (keyset on (updated_at, id), served
+   by project_updated_idx), only the columns that name files.
+2. In one transaction: delete the rows with a single DELETE (re-checking
+   the cutoff, so a project touched meanwhile survives) and release their
+   shared cached results with a single UPDATE.
+3. Once that transaction has committed, delete the files of the rows that
+   were actually deleted. Storage deletes are batched: S3 DeleteObjects
+   with up to 1000 keys per request, otherwise a thread pool. Missing files
+   are not checked first.
+
+Files are only deleted after their rows are gone for good, so a failed
+COMMIT never leaves rows pointing at deleted files. A file whose delete
+fails is recorded as a PendingFileDelete and retried at the start of the
+next run, so it is never orphaned. If a run dies between the commit and
+the file deletes, those files are orphaned; that window is one chunk.
+
+Rows are deleted without the per-instance post_delete handler (which would
+re-delete the same files with exists() round trips). A time budget stops a
+run between chunks.
+
+Usage:
+    from api.cleanup import cleanup_expired_projects
+
+    stats = cleanup_expired_projects(cutoff)
+    stats.projects, stats.files, stats.rate
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F, Q
+
+logger = logging.getLogger(__name__)
+
+# Expired projects per chunk (rows per DELETE)
+CLEANUP_CHUNK_SIZE = 500
+
+# Keys per S3 DeleteObjects request (S3 maximum)
+S3_DELETE_BATCH = 1000
+
+# Parallel deletes for storages without a bulk API (local, Cloudinary)
+DELETE_WORKERS = 8
+
+FILE_FIELDS = ('id', 'updated_at', 'original_image', 'processed_image', 'result_key')
+
+
+@dataclass
+class CleanupStats:
+    projects: int = 0
+    files: int = 0
+    failed_files: int = 0  # Recorded for retry by the next run (0 inside an outer transaction)
+    retried_files: int = 0  # Earlier failures deleted by this run
+    chunks: int = 0
+    seconds: float = 0.0
+    complete: bool = True  # False if the time budget ran out
+
+    @property
+    def rate(self):
+        """Projects deleted per second."""
+        return self.projects / self.seconds if self.seconds else 0.0
+
+
+def _bulk_delete_s3(names):
+    """Returns the names S3 did not delete."""
+    bucket = default_storage.bucket
+    location = getattr(default_storage, 'location', '').rstrip('/')
+    keys = {f"{location}/{name}" if location else name: name for name in names}
+
+    failed = []
+    key_list = list(keys)
+    for i in range(0, len(key_list), S3_DELETE_BATCH):
+        batch = key_list[i:i + S3_DELETE_BATCH]
+        try:
+            response = bucket.meta.client.delete_objects(
+                Bucket=bucket.name,
+                Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True},
+            )
+        except Exception as e:
+            logger.warning(f"Cleanup: DeleteObjects failed for {len(batch)} keys: {e}")
+            failed.extend(keys[key] for key in batch)
+            continue
+        for error in response.get('Errors', []):
+            logger.warning(f"Cleanup: could not delete {error.get('Key')}: {error.get('Message')}")
+            if error.get('Key') in keys:
+                failed.append(keys[error['Key']])
+    return failed
+
+
+def _delete_one(name):
+    """Returns the name if the delete failed, else None."""
+    try:
+        default_storage.delete(name)
+    except Exception as e:
+        logger.warning(f"Cleanup: could not delete {name}: {e}")
+        return name
+    return None
+
+
+def bulk_delete_files(names):
+    """
+    Delete stored files, ignoring ones that are already gone.
+
+    Returns the names that could not be deleted.
+    """
+    names = sorted(set(filter(None, names)))
+    if not names:
+        return []
+
+    if getattr(settings, 'STORAGE_PROVIDER', 'local') == 's3':
+        return _bulk_delete_s3(names)
+    workers = getattr(settings, 'CLEANUP_DELETE_WORKERS', DELETE_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return [name for name in pool.map(_delete_one, names) if name]
+
+
+def record_failed_deletes(names):
+    """Queue files whose delete failed for the next cleanup run."""
+    from .models import PendingFileDelete
+
+    names = sorted(set(names))
+    if not names:
+        return
+    PendingFileDelete.objects.filter(name__in=names).update(attempts=F('attempts') + 1)
+    PendingFileDelete.objects.bulk_create(
+        [PendingFileDelete(name=name) for name in names], ignore_conflicts=True,
+    )
+
+
+def retry_failed_deletes(limit=None):
+    """
+    Delete files recorded by earlier runs. Returns (deleted, still failing).
+    """
+    from .models import PendingFileDelete
+
+    limit = limit or getattr(settings, 'CLEANUP_CHUNK_SIZE', CLEANUP_CHUNK_SIZE)
+    names = list(PendingFileDelete.objects.order_by('failed_at').values_list('name', flat=True)[:limit])
+    if not names:
+        return 0, 0
+    failed = set(bulk_delete_files(names))
+    PendingFileDelete.objects.filter(name__in=[name for name in names if name not in failed]).delete()
+    record_failed_deletes(failed)
+    return len(names) - len(failed), len(failed)
+
+
+def _project_files(row):
+    from .derivatives import all_derivative_names
+
+    names = [row['original_image']]
+    # Shared cached results are reference-counted (see api/result_cache.py)
+    if row['processed_image'] and not row['result_key']:
+        names.append(row['processed_image'])
+        names.extend(all_derivative_names(row['processed_image']))
+    return names
+
+
+def _delete_chunk(rows, cutoff):
+    """
+    Delete one chunk of rows, then their files once the rows are committed.
+    Returns (projects, files, failed files).
+    """
+    from . import result_cache
+    from .models import ImageProject
+
+    ids = [row['id'] for row in rows]
+    with transaction.atomic():
+        expired = ImageProject.objects.filter(id__in=ids, updated_at__lt=cutoff)
+        # Single DELETE without per-row signals (their file work is done here)
+        deleted = expired._raw_delete(expired.db)
+        if deleted < len(ids):
+            # Some projects were touched after they were read; keep them
+            kept = set(ImageProject.objects.filter(id__in=ids).values_list('id', flat=True))
+            rows = [row for row in rows if row['id'] not in kept]
+
+        result_cache.release_many(row['result_key'] for row in rows)
+
+        names = sorted({name for row in rows for name in _project_files(row) if name})
+        failed = []
+
+        def delete_files():
+            failed.extend(bulk_delete_files(names))
+            record_failed_deletes(failed)
+
+        # Files go only once the rows are gone for good
+        transaction.on_commit(delete_files)
+    return len(rows), len(names), len(failed)
+
+
+def cleanup_expired_projects(cutoff, chunk_size=None, max_seconds=None):
+    """
+    Delete projects not updated since cutoff, with their files.
+
+    Returns CleanupStats; stats.complete is False if max_seconds ran out
+    before every expired project was handled.
+    """
+    from .models import ImageProject
+
+    chunk_size = chunk_size or getattr(settings, 'CLEANUP_CHUNK_SIZE', CLEANUP_CHUNK_SIZE)
+    stats = CleanupStats()
+    start = time.monotonic()
+
+    stats.retried_files, _ = retry_failed_deletes()
+
+    expired = ImageProject.objects.filter(updated_at__lt=cutoff).order_by('updated_at', 'id')
+    remaining = expired
+    while True:
+        rows = list(remaining.values(*FILE_FIELDS)[:chunk_size])
+        if not rows:
+            break
+        # Keyset: the next chunk starts after this one, whatever was kept
+        last_updated, last_id = rows[-1]['updated_at'], rows[-1]['id']
+        remaining = expired.filter(Q(updated_at__gt=last_updated) | Q(updated_at=last_updated, id__gt=last_id))
+
+        projects, files, failed = _delete_chunk(rows, cutoff)
+        stats.projects += projects
+        stats.files += files
+        stats.failed_files += failed
+        stats.chunks += 1
+
+        if max_seconds and time.monotonic() - start >= max_seconds:
+            stats.complete = not remaining.exists()
+            break
+
+    stats.seconds = time.monotonic() - start
+    return stats
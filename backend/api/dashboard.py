@@ -0,0 +1,119 @@
+"""
+Admin Dashboard Stats for FixPix
+
+Stats for AdminDashboardStatsView, computed with one conditional-aggregation
+query per table instead of a count() per figure, and served from a cached
+snapshot:
+
+- fresh (< DASHBOARD_STATS_TTL): returned as is
+- stale: returned as is while refresh_dashboard_stats_async recomputes it
+- missing: computed inline
+
+Storage is the sum of the tracked file sizes (ImageProject.storage_bytes and
+ProcessedResult.size_bytes) rather than an estimate per project.
+
+Usage:
+    from api.dashboard import get_dashboard_stats
+
+    stats = get_dashboard_stats()
+"""
+
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models import Count, Q, Sum
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_KEY = 'admin_dashboard_stats_v1'
+REFRESH_LOCK_KEY = 'admin_dashboard_stats_refreshing'
+
+# Snapshot age before a background refresh is triggered (seconds)
+DASHBOARD_STATS_TTL = 30
+
+# How long a stale snapshot may still be served (seconds)
+SNAPSHOT_MAX_AGE = 15 * 60
+
+# Above this many active jobs the system reports high load
+HIGH_LOAD_ACTIVE_JOBS = 50
+
+
+def _ttl():
+    return getattr(settings, 'DASHBOARD_STATS_TTL', DASHBOARD_STATS_TTL)
+
+
+def compute_dashboard_stats():
+    """Compute the dashboard stats from the database (three queries)."""
+    from .models import ACTIVE_STATUSES, ImageProject, ProcessedResult
+
+    users = User.objects.aggregate(
+        total=Count('id'),
+        new_24h=Count('id', filter=Q(date_joined__gte=timezone.now() - timedelta(hours=24))),
+    )
+
+    jobs = ImageProject.objects.aggregate(
+        total=Count('id'),
+        active=Count('id', filter=Q(status__in=ACTIVE_STATUSES)),
+        pending=Count('id', filter=Q(status='pending')),
+        failed=Count('id', filter=Q(status='failed')),
+        completed=Count('id', filter=Q(status='completed')),
+        storage_bytes=Sum('storage_bytes'),
+    )
+
+    results = ProcessedResult.objects.aggregate(storage_bytes=Sum('size_bytes'))
+
+    total = jobs['total']
+    storage_bytes = (jobs['storage_bytes'] or 0) + (results['storage_bytes'] or 0)
+
+    return {
+        "users": {
+            "total": users['total'],
+            "new_24h": users['new_24h'],
+        },
+        "jobs": {
+            "total": total,
+            "active": jobs['active'],
+            "failed": jobs['failed'],
+            "completed": jobs['completed'],
+            "success_rate": round((jobs['completed'] / total * 100) if total > 0 else 0, 1),
+        },
+        "system": {
+            "gpu_queue_depth": jobs['pending'],
+            "storage_bytes": storage_bytes,
+            "est_storage_gb": round(storage_bytes / 1024 ** 3, 2),
+            "status": "healthy" if jobs['active'] < HIGH_LOAD_ACTIVE_JOBS else "high_load",
+        },
+    }
+
+
+def refresh_dashboard_stats():
+    """Recompute and store the snapshot. Returns the stats."""
+    try:
+        stats = compute_dashboard_stats()
+        cache.set(SNAPSHOT_KEY, {'stats': stats, 'computed_at': time.time()}, timeout=SNAPSHOT_MAX_AGE)
+        return stats
+    finally:
+        cache.delete(REFRESH_LOCK_KEY)
+
+
+def get_dashboard_stats():
+    """Return the cached stats, refreshing them in the background when stale."""
+    snapshot = cache.get(SNAPSHOT_KEY)
+    if snapshot is None:
+        return refresh_dashboard_stats()
+
+    if time.time() - snapshot['computed_at'] > _ttl():
+        # One refresh at a time; other pollers keep getting the snapshot
+        if cache.add(REFRESH_LOCK_KEY, 1, timeout=60):
+            try:
+                from .tasks import refresh_dashboard_stats_async
+                refresh_dashboard_stats_async.delay()
+            except Exception as e:
+                logger.warning(f"Could not queue dashboard refresh: {e}")
+                cache.delete(REFRESH_LOCK_KEY)
+    return snapshot['stats']
@@ -2,7 +2,10 @@
 DeepFloyd IF Service for FixPix
 
 Provides AI image generation using DeepFloyd IF text-to-image model.
-Supports mock mode for development without GPU.
+Supports mock mode for development without GPU (DEEPFLOYD_MOCK): a
+placeholder gradient is rendered with numpy and the generation time is
+simulated from DEEPFLOYD_MOCK_LATENCY* settings, so staging and load tests
+measure queueing and limits rather than the mock itself.
 
 Usage:
     from api.deepfloyd_service import DeepFloydService
@@ -35,6 +38,47 @@ _model_cache = {
 }
 
 
+# Mock gradients by style: (top colour, change from top to bottom) per channel
+MOCK_GRADIENTS = {
+    'photorealistic': ((50, 100, 180), (100, 100, 75)),   # Blue
+    'artistic': ((200, 100, 50), (55, 50, 50)),           # Orange/red
+    'anime': ((180, 100, 200), (75, 50, 55)),             # Purple/pink
+}
+
+# Simulated mock generation time: base seconds, seconds per inference step,
+# and random spread as a fraction of the total (see settings.py)
+MOCK_LATENCY = 2.0
+MOCK_STEP_LATENCY = 0.0
+MOCK_LATENCY_JITTER = 0.0
+
+
+def render_mock_gradient(style, width=1024, height=1024):
+    """Vertical gradient placeholder for a style, as an RGB uint8 array."""
+    import numpy as np
+    
+    top, delta = MOCK_GRADIENTS.get(style, MOCK_GRADIENTS['anime'])
+    # One row of colour per y, truncated like int(top + y / height * delta)
+    ramp = np.arange(height, dtype=np.float64)[:, None] / height
+    rows = (np.array(top, dtype=np.float64) + ramp * np.array(delta, dtype=np.float64)).astype(np.uint8)
+    return np.ascontiguousarray(np.broadcast_to(rows[:, None, :], (height, width, 3)))
+
+
+def mock_latency(seed, steps):
+    """
+    Seconds a mock generation takes: base + per-step time, spread by the
+    jitter fraction. The spread is drawn from the seed, so a load test
+    replaying the same seeds sees the same timings.
+    """
+    base = getattr(settings, 'DEEPFLOYD_MOCK_LATENCY', MOCK_LATENCY)
+    per_step = getattr(settings, 'DEEPFLOYD_MOCK_STEP_LATENCY', MOCK_STEP_LATENCY)
+    jitter = getattr(settings, 'DEEPFLOYD_MOCK_LATENCY_JITTER', MOCK_LATENCY_JITTER)
+    
+    seconds = base + per_step * (steps or 0)
+    if jitter:
+        seconds *= 1 + random.Random(seed).uniform(-jitter, jitter)
+    return max(0.0, seconds)
+
+
 class DeepFloydService:
     """
     DeepFloyd IF text-to-image generation service.
@@ -205,41 +249,14 @@ class DeepFloydService:
     ) -> dict:
         """Generate a placeholder image for testing without GPU."""
         import io
-        from PIL import Image, ImageDraw, ImageFont
+        from PIL import Image, ImageDraw
         
         # Simulate processing time
-        time.sleep(2)
+        time.sleep(mock_latency(seed, steps))
         
         # Create a placeholder image
         width, height = 1024, 1024
-        
-        # Create gradient background based on style
-        img = Image.new('RGB', (width, height))
-        
-        if style == 'photorealistic':
-            # Blue gradient
-            for y in range(height):
-                r = int(50 + (y / height) * 100)
-                g = int(100 + (y / height) * 100)
-                b = int(180 + (y / height) * 75)
-                for x in range(width):
-                    img.putpixel((x, y), (r, g, b))
-        elif style == 'artistic':
-            # Orange/red gradient
-            for y in range(height):
-                r = int(200 + (y / height) * 55)
-                g = int(100 + (y / height) * 50)
-                b = int(50 + (y / height) * 50)
-                for x in range(width):
-                    img.putpixel((x, y), (r, g, b))
-        else:  # anime
-            # Purple/pink gradient
-            for y in range(height):
-                r = int(180 + (y / height) * 75)
-                g = int(100 + (y / height) * 50)
-                b = int(200 + (y / height) * 55)
-                for x in range(width):
-                    img.putpixel((x, y), (r, g, b))
+        img = Image.fromarray(render_mock_gradient(style, width, height), 'RGB')
         
         # Add text overlay
         draw = ImageDraw.Draw(img)
@@ -263,9 +280,9 @@ class DeepFloydService:
             draw.text((x_position, y_position), line, fill=(255, 255, 255))
             y_position += 30
         
-        # Save to storage
+        # Save to storage (a placeholder needs no strong compression)
         buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
+        img.save(buffer, format='PNG', compress_level=1)
         buffer.seek(0)
         
         filename = f"generated/mock_{seed}_{int(time.time())}.png"
@@ -0,0 +1,135 @@
+"""
+Image Derivatives for FixPix
+
+Fixed set of downscaled renditions generated once a processed or generated
+image is ready, so gallery grids and project cards do not download the
+full-size result:
+
+- full:    original resolution, compressed (WebP by default)
+- preview: 1024 px long edge
+- thumb:   256 px long edge
+
+All sizes come from a single decode; each level is resized from the one
+above it (INTER_AREA), so the small sizes cost a fraction of a resize from
+full resolution. Files are stored next to processed_image as
+<name>_<size>.<ext>.
+
+Usage:
+    from api.derivatives import build_derivatives
+
+    project.derivatives = build_derivatives(project.processed_image.name)
+"""
+
+import logging
+import os
+
+import cv2
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+logger = logging.getLogger(__name__)
+
+# (size name, long edge or None for full resolution, quality); largest first
+DERIVATIVE_SIZES = (
+    ('full', None, 90),
+    ('preview', 1024, 82),
+    ('thumb', 256, 75),
+)
+
+FORMATS = {
+    'webp': ('webp', cv2.IMWRITE_WEBP_QUALITY),
+    'jpeg': ('jpg', cv2.IMWRITE_JPEG_QUALITY),
+}
+
+
+def derivative_format():
+    fmt = getattr(settings, 'DERIVATIVE_FORMAT', 'webp')
+    return fmt if fmt in FORMATS else 'webp'
+
+
+def derivative_name(source_name, size, fmt=None):
+    ext = FORMATS[fmt or derivative_format()][0]
+    stem = os.path.splitext(source_name)[0]
+    return f'{stem}_{size}.{ext}'
+
+
+def _resize_to(img, long_edge):
+    h, w = img.shape[:2]
+    scale = long_edge / max(h, w)
+    if scale >= 1:
+        return img
+    return cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                      interpolation=cv2.INTER_AREA)
+
+
+def build_derivatives(source_name):
+    """
+    Generate (or reuse) every derivative of a stored image.
+
+    Returns:
+        {size: {'name': storage name, 'width': int, 'height': int}}
+    """
+    from .ai_engine import AIEngine
+
+    fmt = derivative_format()
+    ext, quality_flag = FORMATS[fmt]
+
+    names = {size: derivative_name(source_name, size, fmt) for size, _, _ in DERIVATIVE_SIZES}
+
+    # Shared cached results already have their derivatives: read the sizes
+    # from the file headers instead of decoding the full image
+    if all(default_storage.exists(name) for name in names.values()):
+        return {size: _stored_info(name) for size, name in names.items()}
+
+    # Single decode; keep alpha (background removal results) for WebP
+    nparr = np.frombuffer(AIEngine._read_path_bytes(source_name), np.uint8)
+    img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError(f"Could not decode {source_name}")
+    if img.ndim == 3 and img.shape[2] == 4 and fmt == 'jpeg':
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+
+    derivatives = {}
+    for size, long_edge, quality in DERIVATIVE_SIZES:
+        if long_edge:
+            img = _resize_to(img, long_edge)  # from the previous (larger) level
+
+        name = names[size]
+        if not default_storage.exists(name):
+            success, encoded = cv2.imencode(f'.{ext}', img, [quality_flag, quality])
+            if not success:
+                raise ValueError(f"Could not encode {size} derivative")
+            saved = default_storage.save(name, ContentFile(encoded.tobytes()))
+            if saved != name:
+                # Another worker stored it first
+                default_storage.delete(saved)
+
+        derivatives[size] = {'name': name, 'width': img.shape[1], 'height': img.shape[0]}
+
+    return derivatives
+
+
+def _stored_info(name):
+    from PIL import Image
+
+    with default_storage.open(name, 'rb') as f, Image.open(f) as img:
+        width, height = img.size
+    return {'name': name, 'width': width, 'height': height}
+
+
+def all_derivative_names(source_name):
+    """Every name a derivative of source_name can have (all sizes and formats)."""
+    return [derivative_name(source_name, size, fmt)
+            for size, _, _ in DERIVATIVE_SIZES for fmt in FORMATS]
+
+
+def delete_derivatives(source_name):
+    """Delete every derivative of a stored image (any format)."""
+    for name in all_derivative_names(source_name):
+        try:
+            if default_storage.exists(name):
+                default_storage.delete(name)
+        except Exception as e:
+            logger.warning(f"Could not delete derivative {name}: {e}")
@@ -4,19 +4,25 @@ Generation Limits Service for FixPix
 Tracks and enforces daily generation limits per user.
 Logs GPU usage for billing and monitoring.
 
+Quota state lives in the quota engine (api/quota.py): the check and the
+reservation happen in one atomic operation, daily counts use a sliding 24h
+window, and concurrency slots are leases that expire if a worker dies.
+
 Usage:
     from api.generation_limits import GenerationLimits
     
     limits = GenerationLimits(user)
-    if limits.can_generate():
-        limits.record_generation(gpu_time_seconds=120)
+    reservation = limits.reserve(lease_id=str(project_id))
+    if reservation['allowed']:
+        ...
+        limits.record_generation(gpu_time_seconds=120, lease_id=str(project_id))
 """
 
-from django.core.cache import cache
-from django.utils import timezone
-from datetime import timedelta
+from django.conf import settings
 import logging
 
+from .quota import quota_store, DAILY_LIMIT, LEASE_SECONDS
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,7 +30,7 @@ class GenerationLimits:
     """
     Manages generation rate limits per user.
     
-    Uses Django cache for tracking daily counts.
+    Uses the quota engine for tracking daily counts and concurrent leases.
     Supports different limits for free vs premium users.
     """
     
@@ -42,11 +48,6 @@ class GenerationLimits:
         },
     }
     
-    # Cache key patterns
-    DAILY_COUNT_KEY = 'gen_daily_{user_id}'
-    CONCURRENT_KEY = 'gen_concurrent_{user_id}'
-    GPU_TIME_KEY = 'gen_gpu_time_{user_id}'
-    
     def __init__(self, user):
         self.user = user
         self.user_id = user.id if user else 'anonymous'
@@ -55,39 +56,35 @@ class GenerationLimits:
     
     def _get_user_tier(self) -> str:
         """
-        Determine user's subscription tier.
+        Determine user's generation tier from their plan (api/tiers.py).
         
-        TODO: Integrate with actual subscription system when available.
-        For now, returns 'free' for all users.
+        Any paid plan gets the premium generation limits.
         """
-        # Check if user has premium flag
-        # This can be extended to check Stripe subscription, etc.
-        if self.user and hasattr(self.user, 'profile'):
-            if hasattr(self.user.profile, 'is_premium') and self.user.profile.is_premium:
-                return 'premium'
-        return 'free'
+        from .tiers import resolve_tier
+        return 'free' if resolve_tier(self.user) == 'free' else 'premium'
     
-    def _get_cache_key(self, pattern: str) -> str:
-        """Generate cache key for this user."""
-        return pattern.format(user_id=self.user_id)
+    @property
+    def lease_seconds(self) -> int:
+        return getattr(settings, 'GENERATION_LEASE_SECONDS', LEASE_SECONDS)
     
     def get_daily_count(self) -> int:
-        """Get number of generations today."""
-        key = self._get_cache_key(self.DAILY_COUNT_KEY)
-        return cache.get(key, 0)
+        """Get number of generations in the last 24 hours."""
+        return quota_store.status(self.user_id).used
     
     def get_remaining(self) -> int:
-        """Get remaining generations for today."""
+        """Get remaining generations for the current 24 hour window."""
         return max(0, self.limits['daily_generations'] - self.get_daily_count())
     
     def get_concurrent_count(self) -> int:
         """Get number of currently processing generations."""
-        key = self._get_cache_key(self.CONCURRENT_KEY)
-        return cache.get(key, 0)
+        return quota_store.status(self.user_id).active
     
     def can_generate(self) -> dict:
         """
-        Check if user can start a new generation.
+        Check if user could start a new generation (read-only preview).
+        
+        Use reserve() to actually claim a slot; this check alone is not
+        safe against concurrent requests.
         
         Returns:
             dict with keys:
@@ -96,32 +93,73 @@ class GenerationLimits:
                 - 'remaining': int (generations remaining today)
                 - 'daily_limit': int
         """
-        daily_count = self.get_daily_count()
-        concurrent_count = self.get_concurrent_count()
+        status = quota_store.status(self.user_id)
         daily_limit = self.limits['daily_generations']
         
         result = {
             'allowed': True,
             'reason': None,
-            'remaining': max(0, daily_limit - daily_count),
+            'remaining': max(0, daily_limit - status.used),
             'daily_limit': daily_limit,
             'tier': self.tier,
         }
         
         # Check daily limit
-        if daily_count >= daily_limit:
+        if status.used >= daily_limit:
             result['allowed'] = False
-            result['reason'] = f'Daily limit reached ({daily_limit} generations). Resets at midnight UTC.'
+            result['reason'] = f'Daily limit reached ({daily_limit} generations per 24 hours).'
             return result
         
         # Check concurrent limit
-        if concurrent_count >= self.limits['max_concurrent']:
+        if status.active >= self.limits['max_concurrent']:
             result['allowed'] = False
             result['reason'] = f'Maximum concurrent generations reached ({self.limits["max_concurrent"]}). Please wait for current generation to complete.'
             return result
         
         return result
     
+    def reserve(self, lease_id: str) -> dict:
+        """
+        Atomically check the limits and claim a generation slot.
+        
+        The generation counts against the daily limit and holds a
+        concurrency lease until record_generation() (or lease expiry).
+        
+        Returns:
+            can_generate() dict, plus 'retry_after' (seconds) when denied.
+        """
+        daily_limit = self.limits['daily_generations']
+        reservation = quota_store.reserve(
+            self.user_id, lease_id,
+            daily_limit=daily_limit,
+            max_concurrent=self.limits['max_concurrent'],
+            lease_seconds=self.lease_seconds,
+        )
+        
+        result = {
+            'allowed': reservation.allowed,
+            'reason': None,
+            'remaining': max(0, daily_limit - reservation.used),
+            'daily_limit': daily_limit,
+            'tier': self.tier,
+            'retry_after': reservation.retry_after,
+        }
+        
+        if reservation.outcome == DAILY_LIMIT:
+            hours, minutes = divmod(reservation.retry_after // 60, 60)
+            result['reason'] = (
+                f'Daily limit reached ({daily_limit} generations per 24 hours). '
+                f'Next generation available in {hours}h {minutes}m.'
+            )
+        elif not reservation.allowed:
+            result['reason'] = f'Maximum concurrent generations reached ({self.limits["max_concurrent"]}). Please wait for current generation to complete.'
+        
+        return result
+    
+    def renew(self, lease_id: str) -> bool:
+        """Extend a running generation's lease. False if it already expired."""
+        return quota_store.renew(self.user_id, lease_id, lease_seconds=self.lease_seconds)
+    
     def validate_prompt(self, prompt: str) -> dict:
         """
         Validate generation prompt.
@@ -159,55 +197,28 @@ class GenerationLimits:
             'sanitized': sanitized
         }
     
-    def increment_concurrent(self):
-        """Mark a new generation as started (concurrent count +1)."""
-        key = self._get_cache_key(self.CONCURRENT_KEY)
-        try:
-            cache.incr(key)
-        except ValueError:
-            # Key doesn't exist, set it
-            cache.set(key, 1, timeout=3600)  # 1 hour timeout for safety
-    
-    def decrement_concurrent(self):
-        """Mark a generation as finished (concurrent count -1)."""
-        key = self._get_cache_key(self.CONCURRENT_KEY)
-        try:
-            val = cache.decr(key)
-            if val < 0:
-                cache.set(key, 0, timeout=3600)
-        except ValueError:
-            cache.set(key, 0, timeout=3600)
-    
-    def record_generation(self, gpu_time_seconds: float = 0, success: bool = True):
+    def release(self, lease_id: str):
+        """Give back a reserved slot that never ran (no quota consumed)."""
+        quota_store.finish(self.user_id, lease_id, success=False)
+    
+    def record_generation(self, lease_id: str, gpu_time_seconds: float = 0,
+                          success: bool = True):
         """
-        Record a completed generation.
+        Record a finished generation and release its concurrency lease.
         
         Args:
+            lease_id: Id passed to reserve()
             gpu_time_seconds: GPU time used for this generation
             success: Whether generation completed successfully
         """
-        # Only count successful generations against limit
-        # (Failed ones don't consume the user's quota)
-        if success:
-            # Increment daily count
-            daily_key = self._get_cache_key(self.DAILY_COUNT_KEY)
-            try:
-                cache.incr(daily_key)
-            except ValueError:
-                # Calculate seconds until midnight UTC
-                now = timezone.now()
-                midnight = (now + timedelta(days=1)).replace(
-                    hour=0, minute=0, second=0, microsecond=0
-                )
-                timeout = int((midnight - now).total_seconds())
-                cache.set(daily_key, 1, timeout=timeout)
-        
-        # Always decrement concurrent count
-        self.decrement_concurrent()
-        
-        # Log GPU time
-        if gpu_time_seconds > 0:
-            self._log_gpu_time(gpu_time_seconds)
+        # Only successful generations keep their place in the daily window
+        # (failed ones don't consume the user's quota). The lease release,
+        # refund and GPU time are one atomic update.
+        quota_store.finish(
+            self.user_id, lease_id,
+            success=success,
+            gpu_seconds=max(0, gpu_time_seconds),
+        )
         
         logger.info(
             f"Generation recorded for user {self.user_id}: "
@@ -215,24 +226,15 @@ class GenerationLimits:
             f"remaining={self.get_remaining()}"
         )
     
-    def _log_gpu_time(self, seconds: float):
-        """Track cumulative GPU time for billing/monitoring."""
-        key = self._get_cache_key(self.GPU_TIME_KEY)
-        try:
-            # Add to existing time
-            current = cache.get(key, 0)
-            cache.set(key, current + seconds, timeout=86400 * 30)  # 30 day retention
-        except Exception as e:
-            logger.error(f"Failed to log GPU time: {e}")
-    
     def get_status(self) -> dict:
         """Get full status for API response."""
+        status = quota_store.status(self.user_id)
         return {
             'tier': self.tier,
             'daily_limit': self.limits['daily_generations'],
-            'used_today': self.get_daily_count(),
-            'remaining': self.get_remaining(),
-            'concurrent': self.get_concurrent_count(),
+            'used_today': status.used,
+            'remaining': max(0, self.limits['daily_generations'] - status.used),
+            'concurrent': status.active,
             'max_concurrent': self.limits['max_concurrent'],
             'max_prompt_length': self.limits['max_prompt_length'],
         }
@@ -0,0 +1,297 @@
+"""
+Decoded Image Cache for FixPix
+
+Process-wide, byte-budgeted LRU cache of decoded images used by
+AIEngine._read_image, so re-processing the same original with different
+settings skips the storage fetch and the JPEG/PNG decode.
+
+Entries are keyed by storage name plus size and modification time, so a
+replaced file is not served stale. The (name, size, mtime) fingerprint is
+itself remembered per name for IMAGE_CACHE_FINGERPRINT_SECONDS, so hot
+lookups skip the storage metadata calls; stored files are written once
+under fresh names, so this only delays noticing a file replaced in place.
+Callers that already know a fingerprint can pass it in. Cached arrays are
+read-only; every AIEngine operation returns a new array, so callers never
+need to copy.
+
+When IMAGE_CACHE_SPILL_DIR is set, decoded images are also written there
+as .npy files and loaded back memory-mapped. The OS page cache then shares
+one copy between all Celery prefork children on the host.
+
+Usage:
+    from api.image_cache import decoded_image_cache
+
+    img = decoded_image_cache.get_or_load(name, loader)
+    decoded_image_cache.stats()
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Defaults when not configured in Django settings
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_SPILL_MAX_BYTES = 2 * 1024 * 1024 * 1024
+DEFAULT_FINGERPRINT_SECONDS = 10
+
+
+class FingerprintMemo:
+    """Thread-safe {name: (fingerprint, expires_at)} with a short TTL."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'IMAGE_CACHE_FINGERPRINT_SECONDS', DEFAULT_FINGERPRINT_SECONDS)
+
+    def get(self, name):
+        entry = self._entries.get(name)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, name, fingerprint):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[name] = (fingerprint, time.monotonic() + self.ttl)
+            # Bound memory: drop expired entries once the map grows
+            if len(self._entries) > 10000:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+
+    def forget(self, name=None):
+        with self._lock:
+            if name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(name, None)
+
+
+fingerprint_memo = FingerprintMemo()
+
+
+class DecodedImageCache:
+    """
+    Thread-safe LRU of decoded ndarrays bounded by total bytes.
+
+    Only storage names / local paths are cached. Sources that cannot be
+    fingerprinted (size + mtime) bypass the cache.
+    """
+
+    def __init__(self, max_bytes=None, spill_dir=None, spill_max_bytes=None):
+        self._max_bytes = max_bytes
+        self._spill_dir = spill_dir
+        self._spill_max_bytes = spill_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._counters = {
+            'hits': 0,
+            'spill_hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'bypassed': 0,
+        }
+
+    # ---- configuration (read lazily so settings overrides apply) ----
+
+    @property
+    def max_bytes(self):
+        if self._max_bytes is not None:
+            return self._max_bytes
+        return getattr(settings, 'IMAGE_CACHE_MAX_BYTES', DEFAULT_MAX_BYTES)
+
+    @property
+    def spill_dir(self):
+        if self._spill_dir is not None:
+            return self._spill_dir
+        return getattr(settings, 'IMAGE_CACHE_SPILL_DIR', '') or None
+
+    @property
+    def spill_max_bytes(self):
+        if self._spill_max_bytes is not None:
+            return self._spill_max_bytes
+        return getattr(settings, 'IMAGE_CACHE_SPILL_MAX_BYTES', DEFAULT_SPILL_MAX_BYTES)
+
+    # ---- keys ----
+
+    @staticmethod
+    def fingerprint(name):
+        """
+        Return (name, size, mtime) for a storage name or local path, or None
+        if the source cannot be identified cheaply. Remembered per name for
+        a few seconds (see FingerprintMemo).
+        """
+        fingerprint = fingerprint_memo.get(name)
+        if fingerprint is None:
+            fingerprint = DecodedImageCache._stat(name)
+            if fingerprint is not None:
+                fingerprint_memo.set(name, fingerprint)
+        return fingerprint
+
+    @staticmethod
+    def _stat(name):
+        from django.core.files.storage import default_storage
+
+        try:
+            # size() raises for a missing file, so no separate exists() call
+            size = default_storage.size(name)
+            try:
+                mtime = default_storage.get_modified_time(name).timestamp()
+            except (NotImplementedError, AttributeError):
+                mtime = None
+            return (name, size, mtime)
+        except Exception:
+            pass
+
+        try:
+            stat = os.stat(name)
+            return (name, stat.st_size, stat.st_mtime)
+        except OSError:
+            return None
+
+    # ---- lookup ----
+
+    def get_or_load(self, name, loader, fingerprint=None):
+        """
+        Return the decoded image for name, calling loader() on a miss.
+
+        loader must return a freshly decoded ndarray. fingerprint is name's
+        fingerprint(), if the caller already has it.
+        """
+        key = fingerprint or self.fingerprint(name)
+        if key is None or self.max_bytes <= 0:
+            with self._lock:
+                self._counters['bypassed'] += 1
+            return loader()
+
+        with self._lock:
+            img = self._entries.get(key)
+            if img is not None:
+                self._entries.move_to_end(key)
+                self._counters['hits'] += 1
+                return img
+
+        img = self._load_spill(key)
+        if img is not None:
+            with self._lock:
+                self._counters['spill_hits'] += 1
+            self._insert(key, img)
+            return img
+
+        with self._lock:
+            self._counters['misses'] += 1
+
+        img = loader()
+        img.flags.writeable = False
+        self._insert(key, img)
+        self._store_spill(key, img)
+        return img
+
+    def _insert(self, key, img):
+        size = img.nbytes
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old.nbytes
+            self._entries[key] = img
+            self._bytes += size
+            while self._bytes > self.max_bytes and self._entries:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.nbytes
+                self._counters['evictions'] += 1
+
+    # ---- memory-mapped spill area ----
+
+    def _spill_path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.spill_dir, f'{digest}.npy')
+
+    def _load_spill(self, key):
+        if not self.spill_dir:
+            return None
+        path = self._spill_path(key)
+        try:
+            # Plain read-only view onto the page-cache-backed mapping
+            return np.asarray(np.load(path, mmap_mode='r'))
+        except (OSError, ValueError):
+            return None
+
+    def _store_spill(self, key, img):
+        if not self.spill_dir:
+            return
+        path = self._spill_path(key)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        try:
+            os.makedirs(self.spill_dir, exist_ok=True)
+            with open(tmp_path, 'wb') as f:
+                np.save(f, img)
+            os.replace(tmp_path, path)  # atomic for concurrent readers
+            self._trim_spill()
+        except OSError as e:
+            logger.warning(f"Image cache spill failed: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def _trim_spill(self):
+        """Delete least recently used spill files until under budget."""
+        entries = []
+        total = 0
+        with os.scandir(self.spill_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.npy'):
+                    stat = entry.stat()
+                    entries.append((stat.st_atime, stat.st_size, entry.path))
+                    total += stat.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.spill_max_bytes:
+                break
+            try:
+                # Existing mappings stay valid after unlink
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+
+    # ---- maintenance / metrics ----
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+        fingerprint_memo.forget()
+
+    def stats(self):
+        """Return hit/miss counters and current usage."""
+        with self._lock:
+            lookups = self._counters['hits'] + self._counters['spill_hits'] + self._counters['misses']
+            hits = self._counters['hits'] + self._counters['spill_hits']
+            return {
+                **self._counters,
+                'hit_rate': round(hits / lookups, 3) if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'spill_dir': self.spill_dir,
+            }
+
+
+# Shared by all tasks in this worker process
+decoded_image_cache = DecodedImageCache()
@@ -0,0 +1,65 @@
+"""
+Fill ImageProject.storage_bytes and ProcessedResult.size_bytes for rows
+created before storage sizes were tracked.
+
+New and updated rows maintain the columns themselves; this only needs to run
+once after the migration (it is safe to re-run).
+
+Usage:
+    python manage.py backfill_storage_bytes
+    python manage.py backfill_storage_bytes --all --batch-size 500
+"""
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+
+from api.models import ImageProject, ProcessedResult
+
+
+class Command(BaseCommand):
+    help = 'Backfill tracked storage sizes of projects and cached results'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--all', action='store_true',
+                            help='Recompute every row, not only rows still at 0')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+
+        projects = ImageProject.objects.only('id', 'original_image', 'processed_image', 'result_key')
+        if not options['all']:
+            projects = projects.filter(storage_bytes=0)
+        updated = self._backfill(projects, 'storage_bytes', lambda p: p.compute_storage_bytes(), batch_size)
+        self.stdout.write(f'Projects updated: {updated}')
+
+        results = ProcessedResult.objects.only('key', 'image')
+        if not options['all']:
+            results = results.filter(size_bytes=0)
+        updated = self._backfill(results, 'size_bytes', lambda r: _size(r.image.name), batch_size)
+        self.stdout.write(f'Cached results updated: {updated}')
+
+    def _backfill(self, queryset, field, measure, batch_size):
+        model = queryset.model
+        batch = []
+        updated = 0
+        for obj in queryset.iterator(chunk_size=batch_size):
+            size = measure(obj)
+            if size:
+                setattr(obj, field, size)
+                batch.append(obj)
+            if len(batch) >= batch_size:
+                model.objects.bulk_update(batch, [field])
+                updated += len(batch)
+                batch = []
+        if batch:
+            model.objects.bulk_update(batch, [field])
+            updated += len(batch)
+        return updated
+
+
+def _size(name):
+    try:
+        return default_storage.size(name)
+    except Exception:
+        return 0
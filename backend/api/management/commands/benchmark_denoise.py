@@ -0,0 +1,99 @@
+"""
+Benchmark the NLM denoise paths.
+
+Compares the original single-call cv2.fastNlMeansDenoisingColored with the
+tiled AIEngine path at several worker counts and quality levels.
+
+Usage:
+    python manage.py benchmark_denoise
+    python manage.py benchmark_denoise --image photo.jpg --workers 1 2 4
+"""
+
+import time
+
+import cv2
+import numpy as np
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = 'Benchmark single-call vs tiled/parallel NLM denoise'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--image', help='Image file (default: synthetic noisy photo)')
+        parser.add_argument('--megapixels', type=float, default=12.0,
+                            help='Size of the synthetic image')
+        parser.add_argument('--strength', type=int, default=50)
+        parser.add_argument('--workers', type=int, nargs='+', default=None,
+                            help='Worker counts to try (default: 1 and the auto value)')
+        parser.add_argument('--quality', nargs='+', default=['high', 'balanced', 'fast'])
+        parser.add_argument('--repeat', type=int, default=1)
+
+    def handle(self, *args, **options):
+        from api import tiling
+        from api.ai_engine import AIEngine, NLM_QUALITY
+
+        img = self._load_image(options)
+        strength = options['strength']
+        h, w = img.shape[:2]
+        self.stdout.write(f"Image: {w}x{h} ({w * h / 1e6:.1f} MP), strength={strength}, "
+                          f"cores={tiling.available_cores()}")
+
+        def baseline():
+            h_luminance = max(3, int(strength / 5))
+            h_color = max(3, int(strength / 6))
+            return cv2.fastNlMeansDenoisingColored(img, None, h=h_luminance, hColor=h_color,
+                                                   templateWindowSize=7, searchWindowSize=21)
+
+        reference, base_time = self._time(baseline, options['repeat'])
+        self.stdout.write(f"{'single call':<28}{base_time:8.2f}s")
+
+        workers_list = options['workers'] or sorted({1, tiling.default_workers()})
+        for quality in options['quality']:
+            if quality not in NLM_QUALITY:
+                raise CommandError(f"Unknown quality '{quality}'")
+            for workers in workers_list:
+                original = tiling.default_workers
+                tiling.default_workers = lambda: workers
+                try:
+                    result, elapsed = self._time(
+                        lambda: AIEngine.denoise_advanced(img, strength=strength, quality=quality,
+                                                          return_path=False),
+                        options['repeat'],
+                    )
+                finally:
+                    tiling.default_workers = original
+
+                diff = np.abs(result.astype(np.int16) - reference.astype(np.int16))
+                label = f"tiled {quality} x{workers}"
+                self.stdout.write(f"{label:<28}{elapsed:8.2f}s  {base_time / elapsed:5.2f}x  "
+                                  f"max diff {diff.max()}, mean diff {diff.mean():.3f}")
+
+    @staticmethod
+    def _time(fn, repeat):
+        best = None
+        result = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            result = fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return result, best
+
+    @staticmethod
+    def _load_image(options):
+        if options['image']:
+            img = cv2.imread(options['image'], cv2.IMREAD_COLOR)
+            if img is None:
+                raise CommandError(f"Could not read {options['image']}")
+            return img
+
+        # Smooth random "scene" plus sensor-like noise
+        rng = np.random.default_rng(0)
+        pixels = options['megapixels'] * 1e6
+        w = int((pixels * 4 / 3) ** 0.5)
+        h = int(pixels / w)
+        scene = cv2.resize(rng.integers(0, 256, (h // 16, w // 16, 3), dtype=np.uint8), (w, h),
+                           interpolation=cv2.INTER_CUBIC)
+        noise = rng.normal(0, 12, scene.shape)
+        return np.clip(scene + noise, 0, 255).astype(np.uint8)
@@ -0,0 +1,34 @@
+# Generated by Django 6.0 on 2026-10-17 21:09
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_imageproject_gen_seed_imageproject_gen_steps_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessedResult',
+            fields=[
+                ('key', models.CharField(help_text='SHA-256 of original hash + normalized settings + mask hash', max_length=64, primary_key=True, serialize=False)),
+                ('image', models.ImageField(upload_to='processed/')),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='imageproject',
+            name='original_hash',
+            field=models.CharField(blank=True, db_index=True, help_text='SHA-256 of the original image content', max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='imageproject',
+            name='result_key',
+            field=models.CharField(blank=True, help_text='ProcessedResult key if processed_image is a shared cached result', max_length=64, null=True),
+        ),
+    ]
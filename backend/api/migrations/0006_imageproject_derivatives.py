@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 21:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_result_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageproject',
+            name='derivatives',
+            field=models.JSONField(blank=True, default=dict, help_text='{size: {name, width, height}} for thumb/preview/full'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 21:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_imageproject_derivatives'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='imageproject',
+            name='status',
+            field=models.CharField(choices=[('ingesting', 'Ingesting'), ('pending', 'Pending'), ('processing', 'Processing'), ('completed', 'Completed'), ('failed', 'Failed')], default='pending', max_length=20),
+        ),
+    ]
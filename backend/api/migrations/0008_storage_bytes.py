@@ -0,0 +1,23 @@
+# Generated by Django 6.0 on 2026-10-17 21:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_imageproject_ingesting_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageproject',
+            name='storage_bytes',
+            field=models.BigIntegerField(default=0, help_text='Size of original_image, plus processed_image unless it is a shared ProcessedResult'),
+        ),
+        migrations.AddField(
+            model_name='processedresult',
+            name='size_bytes',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 6.0 on 2026-10-17 21:33
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0008_storage_bytes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        # Admin user list: keyset pages on (date_joined, id). auth.User is
+        # not ours to declare indexes on, so this one is plain SQL.
+        migrations.RunSQL(
+            'CREATE INDEX api_user_joined_id_idx ON auth_user (date_joined DESC, id DESC)',
+            reverse_sql='DROP INDEX api_user_joined_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='imageproject',
+            index=models.Index(fields=['-created_at', '-id'], name='project_created_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageproject',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='project_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,48 @@
+# Generated by Django 6.0 on 2026-10-17 21:34
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_updated_at(apps, schema_editor):
+    # Existing rows: last known change is their creation
+    ImageProject = apps.get_model('api', 'ImageProject')
+    ImageProject.objects.update(updated_at=F('created_at'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_admin_keyset_indexes'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='imageproject',
+            name='project_status_created_idx',
+        ),
+        migrations.AddField(
+            model_name='imageproject',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.RunPython(backfill_updated_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='imageproject',
+            index=models.Index(fields=['user', '-created_at', '-id'], name='project_user_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageproject',
+            index=models.Index(fields=['status', '-created_at', '-id'], include=('processing_type', 'source', 'user'), name='project_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageproject',
+            index=models.Index(condition=models.Q(('status__in', ('pending', 'processing'))), fields=['-created_at'], name='project_active_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='imageproject',
+            index=models.Index(fields=['updated_at'], name='project_updated_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-17 23:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0012_processing_batch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingFileDelete',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('attempts', models.PositiveIntegerField(default=1)),
+                ('failed_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 6.0 on 2026-10-17 23:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0013_pending_file_delete'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BatchChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('index', models.PositiveIntegerField()),
+                ('finished_at', models.DateTimeField(auto_now_add=True)),
+                ('batch', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='finished_chunks', to='api.processingbatch')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('batch', 'index'), name='batch_chunk_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-17 23:40
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0014_batch_chunk'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddConstraint(
+            model_name='imageproject',
+            constraint=models.UniqueConstraint(condition=models.Q(('original_image', ''), _negated=True), fields=('original_image',), name='project_original_unique'),
+        ),
+    ]
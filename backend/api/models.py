@@ -1,7 +1,11 @@
 from django.db import models
 from django.contrib.auth.models import User
+from django.utils import timezone
 import uuid
 
+# Jobs queued or running
+ACTIVE_STATUSES = ('pending', 'processing')
+
 class ImageProject(models.Model):
     PROCESSING_TYPES = [
         ('colorize', 'Colorize'),
@@ -9,10 +13,12 @@ class ImageProject(models.Model):
         ('upscale', 'Upscale'),
     ]
     STATUS_CHOICES = [
+        ('ingesting', 'Ingesting'),
         ('pending', 'Pending'),
         ('processing', 'Processing'),
         ('completed', 'Completed'),
         ('failed', 'Failed'),
+        ('cancelled', 'Cancelled'),
     ]
     SOURCE_CHOICES = [
         ('uploaded', 'Uploaded'),
@@ -31,6 +37,7 @@ class ImageProject(models.Model):
     processing_type = models.CharField(max_length=20, choices=PROCESSING_TYPES, default='restore')
     settings = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
     
     # AI Generation fields
@@ -40,8 +47,174 @@ class ImageProject(models.Model):
     gen_steps = models.IntegerField(null=True, blank=True, help_text='Number of inference steps')
     gen_seed = models.IntegerField(null=True, blank=True, help_text='Random seed for reproducibility')
 
+    # Result cache fields
+    original_hash = models.CharField(max_length=64, null=True, blank=True, db_index=True, help_text='SHA-256 of the original image content')
+    result_key = models.CharField(max_length=64, null=True, blank=True, help_text='ProcessedResult key if processed_image is a shared cached result')
+
+    # Downscaled renditions of processed_image (see api/derivatives.py)
+    derivatives = models.JSONField(default=dict, blank=True, help_text='{size: {name, width, height}} for thumb/preview/full')
+
+    # Batch run that last processed this project (see api/batch.py)
+    batch = models.ForeignKey('ProcessingBatch', on_delete=models.SET_NULL, null=True, blank=True, related_name='projects')
+
+    # Bytes of the files this project owns, kept current by save()
+    storage_bytes = models.BigIntegerField(default=0, help_text='Size of original_image, plus processed_image unless it is a shared ProcessedResult')
+
+    class Meta:
+        indexes = [
+            # ImageViewSet list: a user's projects, newest first
+            models.Index(fields=['user', '-created_at', '-id'], name='project_user_created_idx'),
+            # Admin job monitor: keyset pages, all jobs or one status
+            models.Index(fields=['-created_at', '-id'], name='project_created_id_idx'),
+            # (INCLUDE carries the other columns it reads: index-only on Postgres)
+            models.Index(fields=['status', '-created_at', '-id'], name='project_status_created_idx',
+                         include=['processing_type', 'source', 'user']),
+            # In-flight jobs only: a small index that stays hot however
+            # large the finished history grows
+            models.Index(fields=['-created_at'], name='project_active_idx',
+                         condition=models.Q(status__in=ACTIVE_STATUSES)),
+            # Cleanup task: projects untouched since the cutoff
+            models.Index(fields=['updated_at'], name='project_updated_idx'),
+        ]
+        constraints = [
+            # One project per stored original: deleting a project deletes
+            # its original, so sharing one would delete another's file
+            models.UniqueConstraint(fields=['original_image'], name='project_original_unique',
+                                    condition=~models.Q(original_image='')),
+        ]
+
+    # Fields whose change means storage_bytes must be recomputed
+    STORAGE_FIELDS = ('original_image', 'processed_image', 'result_key')
+
     def __str__(self):
         if self.source == 'generated':
             return f"Generated - {self.id}"
         return f"{self.processing_type} - {self.id}"
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._stored_files = instance._file_state()
+        return instance
+
+    def _file_state(self):
+        # Loaded fields only, so deferred fields are never fetched here
+        state = {}
+        for name in self.STORAGE_FIELDS:
+            if name in self.__dict__:
+                value = self.__dict__[name]
+                state[name] = getattr(value, 'name', value) or ''
+        return state
+
+    def compute_storage_bytes(self):
+        files = [self.original_image]
+        if not self.result_key:
+            files.append(self.processed_image)  # Shared results are counted on ProcessedResult
+
+        total = 0
+        for f in files:
+            if not f:
+                continue
+            try:
+                total += f.size  # Uncommitted uploads report their own size
+            except Exception:
+                pass  # Missing from storage
+        return total
+
+    def save(self, *args, **kwargs):
+        if self._file_state() != getattr(self, '_stored_files', None):
+            self.storage_bytes = self.compute_storage_bytes()
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'storage_bytes'}
+        if kwargs.get('update_fields') is not None:
+            # auto_now is only written when listed
+            kwargs['update_fields'] = {*kwargs['update_fields'], 'updated_at'}
+        super().save(*args, **kwargs)
+        self._stored_files = self._file_state()
+
+
+class ProcessedResult(models.Model):
+    """
+    Content-addressed processing result, shared by every project that asked
+    for the same settings on the same original content.
+
+    ref_count is the number of projects whose processed_image points at this
+    file. Unreferenced results are kept for reuse until evicted by
+    cleanup_old_processed_images.
+    """
+    key = models.CharField(max_length=64, primary_key=True, help_text='SHA-256 of original hash + normalized settings + mask hash')
+    image = models.ImageField(upload_to='processed/')
+    ref_count = models.PositiveIntegerField(default=0)
+    size_bytes = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return f"{self.key[:12]} ({self.ref_count} refs)"
+
+
+
+class PendingFileDelete(models.Model):
+    """
+    Stored file whose delete failed after its project row was deleted.
+
+    Retried at the start of every cleanup_old_processed_images run (see
+    api/cleanup.py) until storage confirms the delete.
+    """
+    name = models.CharField(max_length=255, unique=True)
+    attempts = models.PositiveIntegerField(default=1)
+    failed_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.attempts} attempts)"
+
+
+class ProcessingBatch(models.Model):
+    """
+    One settings profile applied to many projects (ImageViewSet.batch).
+
+    Projects are processed in chunks by process_batch_chunk_async; the
+    counts are filled in when the last chunk finishes. Live progress is
+    kept in the cache (see api/batch.py).
+    """
+    STATUS_CHOICES = [
+        ('processing', 'Processing'),
+        ('completed', 'Completed'),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='processing_batches')
+    settings = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='processing')
+    total = models.PositiveIntegerField(default=0)
+    completed = models.PositiveIntegerField(default=0)
+    failed = models.PositiveIntegerField(default=0)
+    chunks = models.PositiveIntegerField(default=0)
+    chunks_done = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Batch {self.id} ({self.total} projects, {self.status})"
+
+
+class BatchChunk(models.Model):
+    """
+    A finished chunk of a ProcessingBatch.
+
+    Chunk tasks are acknowledged late and can be delivered again after a
+    worker dies; the unique (batch, index) row makes counting a chunk
+    idempotent.
+    """
+    batch = models.ForeignKey(ProcessingBatch, on_delete=models.CASCADE, related_name='finished_chunks')
+    index = models.PositiveIntegerField()
+    finished_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['batch', 'index'], name='batch_chunk_unique'),
+        ]
+
+    def __str__(self):
+        return f"Batch {self.batch_id} chunk {self.index}"
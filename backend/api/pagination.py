@@ -0,0 +1,96 @@
+"""
+Keyset Pagination for FixPix
+
+Cursor ("seek") pagination over a (timestamp, id) ordering for the admin
+lists. Each page starts right after the last row of the previous one with
+an index range scan, so paging through the whole table costs the same per
+page as the first page (no OFFSET).
+
+The response body stays a plain list, as the admin UI expects; the cursor of
+the next page is returned in X-Next-Cursor and a Link header (rel="next").
+
+Usage:
+    from api.pagination import KeysetPaginator
+
+    paginator = KeysetPaginator('created_at')
+    rows = paginator.paginate_queryset(queryset, request)
+    return paginator.get_paginated_response(data, request)
+"""
+
+import base64
+from datetime import datetime
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.db.models import Q
+from rest_framework.exceptions import ValidationError
+from rest_framework.response import Response
+
+
+class KeysetPaginator:
+    """Newest-first pages over (field, pk), addressed by an opaque cursor."""
+
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    default_limit = 50
+    max_limit = 200
+
+    def __init__(self, field):
+        self.field = field
+        self.next_cursor = None
+
+    @staticmethod
+    def encode_cursor(value, pk):
+        raw = f'{value.isoformat()}|{pk}'.encode()
+        return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+    @staticmethod
+    def decode_cursor(cursor, model=None):
+        """(timestamp, pk) of a cursor; the pk is converted to model's pk type."""
+        try:
+            raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+            value, pk = raw.split('|', 1)
+            if model is not None:
+                pk = model._meta.pk.to_python(pk)
+            return datetime.fromisoformat(value), pk
+        except (ValueError, UnicodeDecodeError, DjangoValidationError):
+            raise ValidationError({'cursor': 'Invalid cursor'})
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params.get(self.limit_query_param, self.default_limit))
+        except ValueError:
+            return self.default_limit
+        return max(1, min(limit, self.max_limit))
+
+    def paginate_queryset(self, queryset, request):
+        limit = self.get_limit(request)
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            value, pk = self.decode_cursor(cursor, queryset.model)
+            # Rows strictly after the cursor in (field DESC, pk DESC) order
+            queryset = queryset.filter(
+                Q(**{f'{self.field}__lt': value}) | Q(**{self.field: value, 'pk__lt': pk})
+            )
+
+        # One extra row tells whether there is a next page
+        rows = list(queryset.order_by(f'-{self.field}', '-pk')[:limit + 1])
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last = rows[-1]
+            self.next_cursor = self.encode_cursor(getattr(last, self.field), last.pk)
+        return rows
+
+    def get_next_link(self, request):
+        if self.next_cursor is None:
+            return None
+        params = request.query_params.copy()
+        params[self.cursor_query_param] = self.next_cursor
+        return request.build_absolute_uri(f'{request.path}?{params.urlencode()}')
+
+    def get_paginated_response(self, data, request):
+        response = Response(data)
+        if self.next_cursor is not None:
+            response['X-Next-Cursor'] = self.next_cursor
+            response['Link'] = f'<{self.get_next_link(request)}>; rel="next"'
+        return response
@@ -0,0 +1,569 @@
+"""
+Fused Processing Pipeline for FixPix
+
+Compiles a process_image settings dict into an ordered stage graph and
+executes it. Neighbouring pointwise adjustments (brightness/contrast,
+saturation, white balance, sepia, temperature, fade, ...) are fused into a
+single banded pass over one reused working buffer instead of each allocating
+its own full-frame float32 copies.
+
+Every fused op reproduces the arithmetic of the AIEngine / ai_presets function
+it replaces, so the result matches the stage-by-stage path.
+
+Usage:
+    from api.pipeline import compile_pipeline
+
+    pipeline = compile_pipeline(settings_data)
+    result = pipeline.run(img)
+"""
+
+import logging
+import time
+
+import cv2
+import numpy as np
+
+from .ai_presets import (
+    PRESETS, LUT_SIZE, LUT_MIN_STEPS, SEPIA_KERNEL,
+    apply_clarity, count_color_steps, get_preset_lut,
+)
+from .progress import JobCancelled, checkpoint
+
+logger = logging.getLogger(__name__)
+
+# Rows processed per band in a fused pass. Keeps band temporaries in cache
+# (~3 MB for a 4000px wide frame) while amortising per-call overhead.
+BAND_ROWS = 256
+
+# Stages left out of live previews: model inference (which would also load
+# the model into the web process) and NLM denoising can each run well past
+# the preview budget on their own, and the deadline is only checked between
+# stages. They are reported in Pipeline.skipped.
+PREVIEW_OMITTED_STAGES = ('remove_scratches', 'restore_faces', 'colorize', 'denoise', 'remove_background')
+
+
+# ============== POINTWISE OPS ==============
+
+class PointOp:
+    """
+    A pixel-local operation that can run on a horizontal band of the image.
+
+    Subclasses implement apply() and modify the band in place. prepare() is
+    called with the full buffer before any band is processed; ops whose
+    prepare() reads pixel values (frame statistics) set needs_stats so the
+    compiler starts a new fused pass in front of them.
+    """
+
+    name = 'point'
+    needs_stats = False
+
+    def prepare(self, img):
+        pass
+
+    def apply(self, band, y0, workspace):
+        raise NotImplementedError
+
+
+class ChannelLUT(PointOp):
+    """Independent per-channel uint8 -> uint8 mapping, stored as a (256, 1, 3) table."""
+
+    def __init__(self, name, lut=None):
+        self.name = name
+        self.lut = lut
+
+    @staticmethod
+    def from_function(name, fn):
+        """Build a table by evaluating fn on every possible BGR channel value."""
+        values = np.repeat(np.arange(256, dtype=np.uint8), 3).reshape(256, 1, 3)
+        return ChannelLUT(name, np.ascontiguousarray(fn(values), dtype=np.uint8))
+
+    def compose(self, other):
+        """Return a single table equivalent to applying self, then other."""
+        lut = np.empty_like(self.lut)
+        for c in range(3):
+            lut[:, 0, c] = other.lut[self.lut[:, 0, c], 0, c]
+        return ChannelLUT(f'{self.name}+{other.name}', lut)
+
+    def apply(self, band, y0, workspace):
+        cv2.LUT(band, self.lut, dst=band)
+
+
+class ScaleAbsOp(ChannelLUT):
+    """cv2.convertScaleAbs(img, alpha, beta) as used by adjust_image and preset contrast."""
+
+    def __init__(self, name, alpha, beta=0):
+        lut = ChannelLUT.from_function(
+            name, lambda v: cv2.convertScaleAbs(v, alpha=alpha, beta=beta)
+        ).lut
+        super().__init__(name, lut)
+
+
+class TemperatureOp(ChannelLUT):
+    """ai_presets.adjust_temperature."""
+
+    def __init__(self, temperature, name='temperature'):
+        def fn(values):
+            result = values.astype(np.float32)
+            if temperature > 0:
+                result[:, :, 2] = np.clip(result[:, :, 2] + temperature, 0, 255)
+                result[:, :, 0] = np.clip(result[:, :, 0] - temperature * 0.5, 0, 255)
+            else:
+                result[:, :, 0] = np.clip(result[:, :, 0] - temperature, 0, 255)
+                result[:, :, 2] = np.clip(result[:, :, 2] + temperature * 0.5, 0, 255)
+            return result.astype(np.uint8)
+
+        super().__init__(name, ChannelLUT.from_function(name, fn).lut)
+
+
+class FadeOp(ChannelLUT):
+    """ai_presets.apply_fade."""
+
+    def __init__(self, strength):
+        lift = strength * 255
+        lut = ChannelLUT.from_function(
+            'fade', lambda v: np.clip(v.astype(np.float32) + lift, 0, 255).astype(np.uint8)
+        ).lut
+        super().__init__('fade', lut)
+
+
+class WhiteBalanceOp(ChannelLUT):
+    """
+    AIEngine.correct_white_balance (Gray World).
+
+    The channel gains depend on the frame means at this point in the chain,
+    so the table is built in prepare().
+    """
+
+    needs_stats = True
+
+    def __init__(self):
+        super().__init__('white_balance')
+
+    def prepare(self, img):
+        # Same float32 reduction as np.mean(img.astype(np.float32)[:, :, c]),
+        # without materialising the float copy.
+        avgs = [np.mean(img[:, :, c], dtype=np.float32) for c in range(3)]
+        avg_gray = (avgs[0] + avgs[1] + avgs[2]) / 3
+
+        values = np.arange(256, dtype=np.float32)
+        lut = np.empty((256, 1, 3), dtype=np.uint8)
+        for c in range(3):
+            if avgs[c] > 0:
+                lut[:, 0, c] = np.clip(values * (avg_gray / avgs[c]), 0, 255).astype(np.uint8)
+            else:
+                lut[:, 0, c] = np.arange(256, dtype=np.uint8)
+        self.lut = lut
+
+
+class SaturationOp(PointOp):
+    """HSV saturation scale used by adjust_image and presets."""
+
+    name = 'saturation'
+
+    def __init__(self, saturation):
+        s_values = np.clip(np.arange(256, dtype=np.float32) * saturation, 0, 255).astype(np.uint8)
+        identity = np.arange(256, dtype=np.uint8)
+        self.lut = np.ascontiguousarray(np.stack([identity, s_values, identity], axis=1).reshape(256, 1, 3))
+
+    def apply(self, band, y0, workspace):
+        hsv = workspace.get('hsv', band.shape, np.uint8)
+        cv2.cvtColor(band, cv2.COLOR_BGR2HSV, dst=hsv)
+        cv2.LUT(hsv, self.lut, dst=hsv)
+        cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=band)
+
+
+class GrayscaleOp(PointOp):
+    """BGR -> gray -> BGR, as in grayscale presets."""
+
+    name = 'grayscale'
+
+    def apply(self, band, y0, workspace):
+        gray = workspace.get('gray', band.shape[:2], np.uint8)
+        cv2.cvtColor(band, cv2.COLOR_BGR2GRAY, dst=gray)
+        cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=band)
+
+
+class SepiaOp(PointOp):
+    """ai_presets.apply_sepia."""
+
+    name = 'sepia'
+
+    def __init__(self, strength):
+        self.kernel = SEPIA_KERNEL
+        self.strength = strength
+
+    def apply(self, band, y0, workspace):
+        sepia = workspace.get('sepia', band.shape, np.uint8)
+        cv2.transform(band, self.kernel, dst=sepia)
+        cv2.addWeighted(band, 1 - self.strength, sepia, self.strength, 0, dst=band)
+
+
+class ShadowsTintOp(PointOp):
+    """ai_presets.apply_shadows_tint."""
+
+    name = 'shadows_tint'
+
+    def __init__(self, blue_shift=0, orange_shift=0):
+        self.blue_shift = blue_shift
+        self.orange_shift = orange_shift
+
+    def apply(self, band, y0, workspace):
+        result = band.astype(np.float32)
+        gray = cv2.cvtColor(band, cv2.COLOR_BGR2GRAY).astype(np.float32)
+        shadow_mask = 1 - (gray / 255)
+        shadow_mask = shadow_mask ** 2
+
+        if self.blue_shift > 0:
+            result[:, :, 0] = result[:, :, 0] + shadow_mask * self.blue_shift
+
+        if self.orange_shift > 0:
+            highlight_mask = 1 - shadow_mask
+            result[:, :, 2] = result[:, :, 2] + highlight_mask * self.orange_shift
+            result[:, :, 1] = result[:, :, 1] + highlight_mask * (self.orange_shift * 0.3)
+
+        band[...] = np.clip(result, 0, 255)
+
+
+class ColorLUTOp(PointOp):
+    """A compiled preset colour chain (ai_presets.ColorLUT)."""
+
+    def __init__(self, name, lut):
+        self.name = name
+        self.lut = lut
+
+    def apply(self, band, y0, workspace):
+        self.lut.apply(band, dst=band)
+
+
+class VignetteOp(PointOp):
+    """
+    ai_presets.apply_vignette.
+
+    The Gaussian mask is separable, so each band only builds its own rows of it.
+    """
+
+    name = 'vignette'
+
+    def __init__(self, strength=0.6):
+        self.strength = strength
+
+    def prepare(self, img):
+        rows, cols = img.shape[:2]
+        self.X = cv2.getGaussianKernel(cols, cols * 0.5)
+        self.Y = cv2.getGaussianKernel(rows, rows * 0.5)
+        # max of the outer product Y * X.T, without building it
+        self.kernel_max = self.Y.max() * self.X.max()
+
+    def apply(self, band, y0, workspace):
+        kernel = self.Y[y0:y0 + band.shape[0]] * self.X.T
+        mask = kernel / self.kernel_max
+        mask = mask ** (1 - self.strength * 0.5)
+
+        result = band.astype(np.float32)
+        for i in range(3):
+            result[:, :, i] = result[:, :, i] * mask
+        band[...] = np.clip(result, 0, 255)
+
+
+# ============== STAGES ==============
+
+class _Workspace:
+    """Band-sized scratch buffers, allocated once per fused pass and reused."""
+
+    def __init__(self):
+        self._buffers = {}
+
+    def get(self, key, shape, dtype):
+        buf = self._buffers.get(key)
+        if buf is None or buf.shape[1:] != tuple(shape[1:]) or buf.shape[0] < shape[0]:
+            buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+        return buf[:shape[0]]
+
+
+class Stage:
+    """
+    A whole-frame operation (neighbourhood filters, detection, resizing...).
+
+    If on_error is set, failures are logged and the input image passed
+    through unchanged, matching the best-effort steps of the old pipeline.
+    Cancellation is never swallowed.
+    """
+
+    fused = False
+
+    def __init__(self, name, fn, on_error=None):
+        self.name = name
+        self.fn = fn
+        self.on_error = on_error
+
+    def run(self, img):
+        if self.on_error is None:
+            return self.fn(img)
+        try:
+            return self.fn(img)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"{self.on_error}: {e}")
+            return img
+
+
+class FusedStage:
+    """A run of PointOps executed as a single banded pass over one buffer."""
+
+    fused = True
+
+    def __init__(self, ops):
+        self.ops = list(ops)
+
+    @property
+    def name(self):
+        return 'fused(' + ', '.join(op.name for op in self.ops) + ')'
+
+    def _compiled_ops(self):
+        """Collapse consecutive per-channel tables into one lookup."""
+        compiled = []
+        for op in self.ops:
+            if compiled and isinstance(op, ChannelLUT) and isinstance(compiled[-1], ChannelLUT):
+                compiled[-1] = compiled[-1].compose(op)
+            else:
+                compiled.append(op)
+        return compiled
+
+    def run(self, img):
+        if img.ndim != 3 or img.shape[2] != 3:
+            raise ValueError("Fused stages expect a 3-channel BGR image")
+
+        # Work in place on a private copy so callers' arrays are never mutated
+        buf = np.ascontiguousarray(img).copy()
+
+        for op in self.ops:
+            op.prepare(buf)
+        ops = self._compiled_ops()
+
+        workspace = _Workspace()
+        height = buf.shape[0]
+        for y0 in range(0, height, BAND_ROWS):
+            band = buf[y0:y0 + BAND_ROWS]
+            for op in ops:
+                op.apply(band, y0, workspace)
+            checkpoint(min(height, y0 + BAND_ROWS), height)
+        return buf
+
+
+class Pipeline:
+    """An ordered list of Stage / FusedStage objects."""
+
+    def __init__(self, stages, omitted=()):
+        self.stages = stages
+        self.omitted = list(omitted)  # Left out when compiled (previews)
+        self.skipped = []
+
+    def describe(self):
+        return [stage.name for stage in self.stages]
+
+    def run(self, img, deadline=None, progress=None):
+        """
+        Run all stages in order.
+
+        Args:
+            img: BGR uint8 image
+            deadline: Optional time.monotonic() value. Once passed, remaining
+                whole-frame stages are skipped (recorded in self.skipped,
+                after the omitted ones); fused stages are cheap and always
+                run.
+            progress: Optional api.progress.JobProgress, advanced before
+                each stage (raises JobCancelled if the job was cancelled)
+        """
+        self.skipped = list(self.omitted)
+        for stage in self.stages:
+            if progress is not None:
+                progress.advance(stage.name)
+            if deadline is not None and not stage.fused and time.monotonic() > deadline:
+                self.skipped.append(stage.name)
+                continue
+            img = stage.run(img)
+        return img
+
+
+# ============== COMPILER ==============
+
+def preset_ops(preset_name, lut_size=LUT_SIZE):
+    """
+    Translate a filter preset into (kind, payload) steps in apply_preset order.
+
+    kind is 'op' for a PointOp or 'stage' for a whole-frame function. The
+    colour steps use the preset's compiled 3D LUT whenever apply_preset would.
+    """
+    if preset_name not in PRESETS:
+        return []
+
+    config = PRESETS[preset_name]
+    steps = []
+
+    lut = None
+    if lut_size and count_color_steps(config) >= LUT_MIN_STEPS:
+        lut = get_preset_lut(preset_name, lut_size)
+
+    if lut is not None:
+        steps.append(('op', ColorLUTOp(f'{preset_name}_lut', lut)))
+    else:
+        steps.extend(('op', op) for op in _preset_color_ops(config))
+
+    if 'clarity' in config:
+        strength = config['clarity']
+        steps.append(('stage', Stage('clarity', lambda img: apply_clarity(img, strength))))
+    if config.get('vignette', False):
+        steps.append(('op', VignetteOp(0.6)))
+
+    return steps
+
+
+def _preset_color_ops(config):
+    """Step-by-step PointOps for a preset's colour chain."""
+    steps = []
+
+    if config.get('grayscale', False):
+        steps.append(GrayscaleOp())
+    if 'sepia_strength' in config:
+        steps.append(SepiaOp(config['sepia_strength']))
+    if 'temperature' in config:
+        steps.append(TemperatureOp(config['temperature']))
+    if 'warmth' in config:
+        steps.append(TemperatureOp(config['warmth'], name='warmth'))
+    if 'shadows_blue' in config or 'highlights_orange' in config:
+        steps.append(ShadowsTintOp(
+            blue_shift=config.get('shadows_blue', 0),
+            orange_shift=config.get('highlights_orange', 0),
+        ))
+    if 'fade_strength' in config:
+        steps.append(FadeOp(config['fade_strength']))
+    if 'contrast' in config and config['contrast'] != 1.0:
+        steps.append(ScaleAbsOp('contrast', alpha=config['contrast']))
+    if 'saturation' in config and config['saturation'] != 1.0:
+        steps.append(SaturationOp(config['saturation']))
+
+    return steps
+
+
+def _build_steps(settings_data, mask_img=None, preview=False):
+    """Translate settings into (kind, payload) steps in process_image_async order."""
+    from .ai_engine import AIEngine
+
+    steps = []
+
+    denoise_quality = settings_data.get('denoiseQuality', 'high')
+
+    def stage(name, fn, on_error=None):
+        if preview and name in PREVIEW_OMITTED_STAGES:
+            steps.append(('omitted', name))
+        else:
+            steps.append(('stage', Stage(name, fn, on_error)))
+
+    # 1. Restoration (Scratches)
+    if settings_data.get('removeScratches', False):
+        stage('remove_scratches', lambda img: AIEngine.remove_scratches(img, return_path=False, quality=denoise_quality))
+
+    # 2. Face Restoration
+    if settings_data.get('faceRestoration', False):
+        stage('restore_faces', lambda img: AIEngine.restore_faces(img, return_path=False))
+
+    # 3. Colorization
+    if settings_data.get('colorize', False):
+        stage('colorize', lambda img: AIEngine.colorize_image(img, return_path=False))
+
+    # 4. Adjustments
+    b = float(settings_data.get('brightness', 1.0))
+    c = float(settings_data.get('contrast', 1.0))
+    s = float(settings_data.get('saturation', 1.0))
+    if b != 1.0 or c != 1.0 or s != 1.0:
+        steps.append(('op', ScaleAbsOp('brightness_contrast', alpha=c, beta=(b - 1.0) * 100)))
+        if s != 1.0:
+            steps.append(('op', SaturationOp(s)))
+
+    # 5. Upscaling (previews stay at proxy resolution)
+    upscale_x = int(settings_data.get('upscaleX', 1))
+    if upscale_x > 4:
+        upscale_x = 4
+    if upscale_x > 1 and not preview:
+        stage('upscale_2x', lambda img: AIEngine.upscale_image(img, scale=2, return_path=False))
+        if upscale_x >= 4:
+            stage('upscale_2x', lambda img: AIEngine.upscale_image(img, scale=2, return_path=False))
+
+    # 6. Auto-Enhance
+    if settings_data.get('autoEnhance', False):
+        stage('auto_enhance', lambda img: AIEngine.auto_enhance(img, return_path=False))
+
+    # 7. White Balance
+    if settings_data.get('whiteBalance', False):
+        steps.append(('op', WhiteBalanceOp()))
+
+    # 8. Advanced Denoising
+    denoise_strength = int(settings_data.get('denoiseStrength', 0))
+    if denoise_strength > 0:
+        stage('denoise', lambda img: AIEngine.denoise_advanced(img, strength=denoise_strength, return_path=False,
+                                                              quality=denoise_quality))
+
+    # 9. Filter Preset
+    filter_preset = settings_data.get('filterPreset', '')
+    if filter_preset and filter_preset != 'none':
+        steps.extend(preset_ops(filter_preset))
+
+    # 10. Background Removal
+    if settings_data.get('removeBackground', False):
+        stage('remove_background', lambda img: AIEngine.remove_background(img, return_path=False),
+              on_error='BG Removal Failed')
+
+    # 11. Object Removal (Inpainting)
+    if mask_img is not None:
+        stage('inpaint', lambda img: AIEngine.inpaint_object(img, mask_img, return_path=False),
+              on_error='Inpainting failed')
+
+    # 12. Upscaling
+    upscale_x = int(settings_data.get('upscaleX', 1))
+    if upscale_x > 1 and not preview:
+        stage(f'upscale_{upscale_x}x', lambda img: AIEngine.upscale_image(img, scale=upscale_x, return_path=False),
+              on_error='Upscaling failed')
+
+    return steps
+
+
+def compile_pipeline(settings_data, mask_img=None, preview=False):
+    """
+    Build a Pipeline for the given process_image settings.
+
+    Args:
+        settings_data: Dict of processing settings (same keys as SettingsSerializer)
+        mask_img: Decoded inpainting mask, or None
+        preview: Drop upscaling stages (live previews render at proxy size)
+            and PREVIEW_OMITTED_STAGES
+
+    Returns:
+        Pipeline whose neighbouring pointwise ops are grouped into FusedStages
+    """
+    stages = []
+    pending = []
+    omitted = []
+
+    def flush():
+        if pending:
+            stages.append(FusedStage(pending[:]))
+            pending.clear()
+
+    for kind, payload in _build_steps(settings_data, mask_img, preview):
+        if kind == 'omitted':
+            omitted.append(payload)
+        elif kind == 'stage':
+            flush()
+            stages.append(payload)
+        else:
+            # Ops that need frame statistics must see the output of everything
+            # before them, so they start a new fused pass.
+            if payload.needs_stats:
+                flush()
+            pending.append(payload)
+    flush()
+
+    logger.debug(f"Compiled pipeline: {[stage.name for stage in stages]}")
+    return Pipeline(stages, omitted)
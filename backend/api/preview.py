@@ -0,0 +1,122 @@
+"""
+Live Preview Rendering for FixPix
+
+Runs the processing pipeline of process_image_async on a cached, downscaled
+proxy of the original so the editor can show slider changes synchronously.
+Model-backed stages and NLM denoising are left out (see
+api.pipeline.PREVIEW_OMITTED_STAGES) and reported as skipped. Nothing is
+written to the database or to storage; only the final "apply" goes through
+Celery at full resolution.
+
+Usage:
+    from api.preview import render_preview
+
+    content, content_type, info = render_preview(project, settings_data)
+"""
+
+import base64
+import time
+
+import cv2
+import numpy as np
+from django.core.cache import cache
+
+# Long edge of the preview proxy in pixels
+PREVIEW_MAX_EDGE = 1024
+
+# Soft latency budget per preview (seconds). Once spent, remaining
+# whole-frame stages are skipped; colour adjustments always run.
+PREVIEW_TIME_BUDGET = 1.5
+
+# Proxy cache lifetime (seconds)
+PROXY_CACHE_TIMEOUT = 3600
+
+# Proxies are cached JPEG-encoded: a 1024px BGR array is ~2.3 MB, over
+# memcached's default 1 MB item limit, while q95 is a few hundred KB and
+# visually lossless at preview size.
+PROXY_JPEG_QUALITY = 95
+
+PREVIEW_FORMATS = {
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY),
+}
+
+PROXY_KEY = 'preview_proxy_{project_id}_{name}'
+
+
+def get_preview_proxy(project):
+    """
+    Return the downscaled BGR proxy of a project's original image.
+
+    Proxies are cached per original file (as JPEG bytes), so only the first
+    preview after an upload pays for the storage fetch, full-size decode and
+    resize; later ones decode ~1 MP from memory.
+    """
+    from .ai_engine import AIEngine
+
+    name = project.original_image.name
+    key = PROXY_KEY.format(project_id=project.id, name=name)
+
+    encoded = cache.get(key)
+    if encoded is not None:
+        return cv2.imdecode(np.frombuffer(encoded, np.uint8), cv2.IMREAD_COLOR)
+
+    img = AIEngine._read_image(name)
+    h, w = img.shape[:2]
+    scale = PREVIEW_MAX_EDGE / max(h, w)
+    if scale < 1:
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                         interpolation=cv2.INTER_AREA)
+
+    success, encoded = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, PROXY_JPEG_QUALITY])
+    if success:
+        cache.set(key, encoded.tobytes(), timeout=PROXY_CACHE_TIMEOUT)
+    return img
+
+
+def decode_mask(mask_data):
+    """Decode a base64 (optionally data-URL) mask into an ndarray, or None."""
+    if 'base64,' in mask_data:
+        mask_data = mask_data.split('base64,')[1]
+    nparr = np.frombuffer(base64.b64decode(mask_data), np.uint8)
+    return cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
+
+
+def render_preview(project, settings_data, mask_img=None, fmt='jpeg', quality=80):
+    """
+    Render a preview of settings_data applied to a project.
+
+    Args:
+        project: ImageProject with an original_image
+        settings_data: Dict of processing settings (same keys as process_image)
+        mask_img: Decoded inpainting mask, or None
+        fmt: 'jpeg' or 'webp'
+        quality: Encoder quality 1-100
+
+    Returns:
+        (encoded bytes, content type, info dict with timing and skipped stages)
+    """
+    from .pipeline import compile_pipeline
+
+    start = time.monotonic()
+    ext, content_type, quality_flag = PREVIEW_FORMATS.get(fmt, PREVIEW_FORMATS['jpeg'])
+
+    proxy = get_preview_proxy(project)
+    pipeline = compile_pipeline(settings_data, mask_img=mask_img, preview=True)
+    result = pipeline.run(proxy, deadline=start + PREVIEW_TIME_BUDGET)
+
+    # JPEG has no alpha channel
+    if result.ndim == 3 and result.shape[2] == 4 and ext == '.jpg':
+        result = cv2.cvtColor(result, cv2.COLOR_BGRA2BGR)
+
+    success, encoded = cv2.imencode(ext, result, [quality_flag, quality])
+    if not success:
+        raise ValueError("Could not encode preview")
+
+    info = {
+        'width': result.shape[1],
+        'height': result.shape[0],
+        'elapsed_ms': int((time.monotonic() - start) * 1000),
+        'skipped': pipeline.skipped,
+    }
+    return encoded.tobytes(), content_type, info
@@ -0,0 +1,260 @@
+"""
+Job Progress and Cancellation for FixPix
+
+process_image_async publishes where it is (stage name, percent, elapsed
+time) to the Django cache, and checks a cancel flag there between stages
+and between tiles. Clients follow a job by polling ImageViewSet.progress,
+which reads only the cache, so following a job costs one ownership query
+instead of a status query every poll.
+
+The endpoint answers at once with the current snapshot and a Retry-After
+hint while the job is active; it never holds a (sync) web worker waiting
+for the next update. Records are versioned with a millisecond clock, which
+doubles as the ETag, so an unchanged poll is a 304.
+
+Web and workers must share the cache backend (e.g. Redis) for progress to
+cross processes; with eager tasks (development) any backend works.
+
+Usage:
+    from api import progress
+
+    progress.queued(project.id)                    # view, before .delay()
+
+    job = progress.JobProgress(project_id)         # task
+    job.advance('load')
+    job.plan(['load', *pipeline.describe(), 'save'])
+    with job:
+        img = pipeline.run(img, progress=job)
+    job.finish('completed')
+
+    progress.checkpoint(done, total)               # inside a long stage
+    progress.request_cancel(project.id)            # cancel endpoint
+
+    record = progress.current_progress(project)
+    progress.retry_after(record)                   # polling hint, None when done
+"""
+
+import contextvars
+import time
+
+from django.core.cache import cache
+
+PROGRESS_KEY = 'fixpix:progress:{}'
+CANCEL_KEY = 'fixpix:cancel:{}'
+
+# How long records and cancel flags outlive the last update (seconds)
+PROGRESS_TTL = 60 * 60
+
+# Minimum spacing of in-stage (tile) updates; stage changes always publish
+PUBLISH_INTERVAL = 0.25
+
+# Minimum spacing of cancel-flag reads between tiles
+CANCEL_CHECK_INTERVAL = 0.5
+
+# Suggested polling interval by state (Retry-After, seconds)
+RETRY_AFTER_SECONDS = {
+    'queued': 2,
+    'processing': 1,
+}
+
+TERMINAL_STATES = ('completed', 'failed', 'cancelled')
+
+# ImageProject.status -> progress state, for projects without a record
+_STATUS_STATES = {
+    'ingesting': 'queued',
+    'pending': 'queued',
+    'processing': 'processing',
+    'completed': 'completed',
+    'failed': 'failed',
+    'cancelled': 'cancelled',
+}
+
+_active = contextvars.ContextVar('fixpix_job_progress', default=None)
+
+
+class JobCancelled(Exception):
+    """Raised at a checkpoint once the job's cancel flag is set."""
+
+
+def _version(after=0):
+    return max(int(time.time() * 1000), after + 1)
+
+
+def get_progress(project_id):
+    """Latest progress record of a project, or None."""
+    return cache.get(PROGRESS_KEY.format(project_id))
+
+
+def current_progress(project):
+    """
+    The project's progress record, or one derived from its status when the
+    cache has none (never processed here, or expired).
+    """
+    record = get_progress(project.pk)
+    if record is not None:
+        return record
+    state = _STATUS_STATES.get(project.status, project.status)
+    return {
+        'state': state,
+        'stage': None,
+        'stage_index': 0,
+        'stage_count': 0,
+        'percent': 100 if state == 'completed' else 0,
+        'elapsed': None,
+        'version': 0,
+    }
+
+
+def retry_after(record):
+    """Seconds a client should wait before polling again, or None once the job ended."""
+    return RETRY_AFTER_SECONDS.get(record['state'])
+
+
+def get_progress_many(project_ids):
+    """{project_id: record} for the projects that have one."""
+    records = cache.get_many([PROGRESS_KEY.format(pid) for pid in project_ids])
+    return {pid: records[PROGRESS_KEY.format(pid)] for pid in project_ids if PROGRESS_KEY.format(pid) in records}
+
+
+def publish(project_id, record):
+    cache.set(PROGRESS_KEY.format(project_id), record, timeout=PROGRESS_TTL)
+
+
+def queued(project_id):
+    """Start a new run: clear any old cancel flag and report it as queued."""
+    queued_many([project_id])
+
+
+def queued_many(project_ids):
+    """queued() for many projects, in two cache round trips."""
+    version = _version()
+    cache.delete_many([CANCEL_KEY.format(pid) for pid in project_ids])
+    cache.set_many({
+        PROGRESS_KEY.format(pid): {
+            'state': 'queued',
+            'stage': None,
+            'stage_index': 0,
+            'stage_count': 0,
+            'percent': 0,
+            'elapsed': 0.0,
+            'version': version,
+        }
+        for pid in project_ids
+    }, timeout=PROGRESS_TTL)
+
+
+def request_cancel(project_id):
+    cache.set(CANCEL_KEY.format(project_id), 1, timeout=PROGRESS_TTL)
+
+
+def is_cancelled(project_id):
+    return bool(cache.get(CANCEL_KEY.format(project_id)))
+
+
+def mark_finished(project_id, state):
+    """Publish a terminal state for a job that never ran (cancelled while queued, not dispatched)."""
+    record = get_progress(project_id) or {}
+    publish(project_id, {
+        **record,
+        'state': state,
+        'version': _version(record.get('version', 0)),
+    })
+
+
+def checkpoint(done=None, total=None):
+    """
+    Report in-stage progress (done of total units) of the job running in
+    this context and raise JobCancelled if it was cancelled. A no-op
+    outside a job (previews, management commands).
+    """
+    job = _active.get()
+    if job is not None:
+        job.step(done, total)
+
+
+class JobProgress:
+    """
+    Progress of one process_image_async run.
+
+    Used as a context manager, it becomes the job that checkpoint() (called
+    from run_tiled and fused passes) reports to.
+    """
+
+    def __init__(self, project_id):
+        self.project_id = str(project_id)
+        self.stages = []
+        self.index = -1
+        self.fraction = 0.0
+        self.started = time.monotonic()
+        self.version = 0
+        self._published_at = 0.0
+        self._checked_at = 0.0
+        self._token = None
+
+    def __enter__(self):
+        self._token = _active.set(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        _active.reset(self._token)
+        return False
+
+    @property
+    def percent(self):
+        if not self.stages:
+            return 0
+        done = max(self.index, 0) + self.fraction
+        return min(100, int(done * 100 / len(self.stages)))
+
+    def plan(self, stages):
+        """
+        Set the stage names this run goes through, in order. Can be called
+        mid-run (once the pipeline is compiled); the current stage keeps
+        its position.
+        """
+        self.stages = list(stages)
+
+    def advance(self, name):
+        """Enter the next stage. Checks for cancellation first."""
+        self.check(force=True)
+        self.index += 1
+        if self.index >= len(self.stages):
+            self.stages.append(name)
+        self.fraction = 0.0
+        self._publish('processing')
+
+    def step(self, done=None, total=None):
+        """Progress within the current stage; see checkpoint()."""
+        self.check()
+        if done is not None and total:
+            self.fraction = min(1.0, done / total)
+        if time.monotonic() - self._published_at >= PUBLISH_INTERVAL:
+            self._publish('processing')
+
+    def check(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._checked_at < CANCEL_CHECK_INTERVAL:
+            return
+        self._checked_at = now
+        if is_cancelled(self.project_id):
+            raise JobCancelled(self.project_id)
+
+    def finish(self, state):
+        """Publish the terminal state ('completed', 'failed' or 'cancelled')."""
+        if state == 'completed':
+            self.index, self.fraction = len(self.stages) - 1, 1.0
+        self._publish(state)
+
+    def _publish(self, state):
+        self._published_at = time.monotonic()
+        self.version = _version(self.version)
+        stage = self.stages[self.index] if 0 <= self.index < len(self.stages) else None
+        publish(self.project_id, {
+            'state': state,
+            'stage': stage,
+            'stage_index': self.index + 1,
+            'stage_count': len(self.stages),
+            'percent': 100 if state == 'completed' else self.percent,
+            'elapsed': round(self._published_at - self.started, 2),
+            'version': self.version,
+        })
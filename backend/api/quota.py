@@ -0,0 +1,309 @@
+"""
+Quota Engine for FixPix
+
+Atomic check-and-reserve for generation quotas. Each operation is a single
+round trip (one Lua script on Redis), so concurrent requests cannot both
+pass the check before either records its usage.
+
+Per user:
+- gens:   sorted set of generation ids scored by start time (ms). Counted
+          over a sliding 24h window instead of a counter reset at midnight.
+- leases: sorted set of in-flight generation ids scored by lease expiry.
+          A lease that is not finished or renewed before it expires is
+          dropped (and its generation refunded) on the next reserve, so a
+          crashed worker cannot hold a concurrency slot.
+- gpu:    cumulative GPU seconds (INCRBYFLOAT).
+
+Backends:
+- RedisQuotaStore: used when QUOTA_REDIS_URL is set and redis-py is installed.
+- LocalQuotaStore: in-process stand-in with the same semantics, made atomic
+  with a lock. Used for development and eager Celery.
+
+api/tests.py runs RedisQuotaStore (the Lua scripts) against fakeredis when
+fakeredis[lua] is installed.
+
+Usage:
+    from api.quota import quota_store
+
+    result = quota_store.reserve(user_id, lease_id, daily_limit=5, max_concurrent=1)
+    if result.allowed:
+        ...
+        quota_store.finish(user_id, lease_id, success=True, gpu_seconds=42.0)
+"""
+
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+# Sliding window for daily generation counts (seconds)
+DAILY_WINDOW = 24 * 3600
+
+# Concurrency lease lifetime (seconds). Generation tasks renew their lease
+# when they start, so this bounds queue wait + run time of a single attempt.
+LEASE_SECONDS = 15 * 60
+
+# GPU time retention (seconds)
+GPU_TIME_RETENTION = 30 * 24 * 3600
+
+# Reserve outcomes
+RESERVED = 'reserved'
+DAILY_LIMIT = 'daily_limit'
+CONCURRENT_LIMIT = 'concurrent_limit'
+
+_OUTCOMES = {0: DAILY_LIMIT, 1: CONCURRENT_LIMIT, 2: RESERVED}
+
+
+@dataclass
+class Reservation:
+    outcome: str
+    used: int  # Generations in the current window, including this one
+    active: int  # In-flight generations, including this one
+    retry_after: int = 0  # Seconds until the oldest generation leaves the window
+
+    @property
+    def allowed(self):
+        return self.outcome == RESERVED
+
+
+@dataclass
+class QuotaStatus:
+    used: int
+    active: int
+    gpu_seconds: float
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+# KEYS: gens, leases
+# ARGV: now_ms, window_ms, daily_limit, max_concurrent, lease_id, lease_ms
+RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+
+-- Leases whose worker died: free the slot and refund the generation
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', now)
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[1], id)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+
+local used = redis.call('ZCARD', KEYS[1])
+local active = redis.call('ZCARD', KEYS[2])
+if used >= tonumber(ARGV[3]) then
+    -- Nothing to wait for when the limit is 0: retry after a full window
+    local retry = window
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    if oldest[2] then
+        retry = tonumber(oldest[2]) + window - now
+    end
+    return {0, used, active, retry}
+end
+if active >= tonumber(ARGV[4]) then
+    return {1, used, active, 0}
+end
+
+redis.call('ZADD', KEYS[1], now, ARGV[5])
+redis.call('ZADD', KEYS[2], now + tonumber(ARGV[6]), ARGV[5])
+redis.call('PEXPIRE', KEYS[1], window)
+redis.call('PEXPIRE', KEYS[2], tonumber(ARGV[6]))
+return {2, used + 1, active + 1, 0}
+"""
+
+# KEYS: leases
+# ARGV: now_ms, lease_id, lease_ms
+RENEW_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[2]) then
+    return 0
+end
+local expiry = tonumber(ARGV[1]) + tonumber(ARGV[3])
+redis.call('ZADD', KEYS[1], 'XX', expiry, ARGV[2])
+if redis.call('PTTL', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('PEXPIRE', KEYS[1], tonumber(ARGV[3]))
+end
+return 1
+"""
+
+# KEYS: gens, leases, gpu
+# ARGV: lease_id, success (1/0), gpu_seconds, gpu_retention_s
+FINISH_SCRIPT = """
+local held = redis.call('ZREM', KEYS[2], ARGV[1])
+if ARGV[2] == '0' then
+    redis.call('ZREM', KEYS[1], ARGV[1])
+end
+if tonumber(ARGV[3]) > 0 then
+    redis.call('INCRBYFLOAT', KEYS[3], ARGV[3])
+    redis.call('EXPIRE', KEYS[3], ARGV[4])
+end
+return held
+"""
+
+# KEYS: gens, leases, gpu
+# ARGV: now_ms, window_ms
+STATUS_SCRIPT = """
+local now = tonumber(ARGV[1])
+local used = redis.call('ZCOUNT', KEYS[1], '(' .. (now - tonumber(ARGV[2])), '+inf')
+local active = redis.call('ZCOUNT', KEYS[2], '(' .. now, '+inf')
+return {used, active, redis.call('GET', KEYS[3]) or '0'}
+"""
+
+
+class RedisQuotaStore:
+    """Quota operations as Lua scripts; each call is one atomic round trip."""
+
+    # {user_id} is a hash tag: a user's keys share one Redis Cluster slot
+    KEY_PREFIX = 'fixpix:quota:{{{user_id}}}:'
+
+    def __init__(self, client):
+        self.client = client
+        self._reserve = client.register_script(RESERVE_SCRIPT)
+        self._renew = client.register_script(RENEW_SCRIPT)
+        self._finish = client.register_script(FINISH_SCRIPT)
+        self._status = client.register_script(STATUS_SCRIPT)
+
+    def _keys(self, user_id, *names):
+        prefix = self.KEY_PREFIX.format(user_id=user_id)
+        return [prefix + name for name in names]
+
+    def reserve(self, user_id, lease_id, daily_limit, max_concurrent,
+                lease_seconds=LEASE_SECONDS, window=DAILY_WINDOW):
+        code, used, active, retry_ms = self._reserve(
+            keys=self._keys(user_id, 'gens', 'leases'),
+            args=[_now_ms(), window * 1000, daily_limit, max_concurrent,
+                  lease_id, lease_seconds * 1000],
+        )
+        return Reservation(_OUTCOMES[int(code)], int(used), int(active),
+                           max(0, -(-int(retry_ms) // 1000)))
+
+    def renew(self, user_id, lease_id, lease_seconds=LEASE_SECONDS):
+        return bool(self._renew(
+            keys=self._keys(user_id, 'leases'),
+            args=[_now_ms(), lease_id, lease_seconds * 1000],
+        ))
+
+    def finish(self, user_id, lease_id, success=True, gpu_seconds=0):
+        return bool(self._finish(
+            keys=self._keys(user_id, 'gens', 'leases', 'gpu'),
+            args=[lease_id, 1 if success else 0, float(gpu_seconds), GPU_TIME_RETENTION],
+        ))
+
+    def status(self, user_id, window=DAILY_WINDOW):
+        used, active, gpu = self._status(
+            keys=self._keys(user_id, 'gens', 'leases', 'gpu'),
+            args=[_now_ms(), window * 1000],
+        )
+        return QuotaStatus(int(used), int(active), float(gpu))
+
+
+class LocalQuotaStore:
+    """
+    In-process stand-in for RedisQuotaStore (same operations and results).
+
+    Sorted sets are {member: score} dicts; a lock makes each operation atomic
+    the way a Lua script is on Redis. State is per process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._gens = {}
+        self._leases = {}
+        self._gpu = {}
+
+    def reserve(self, user_id, lease_id, daily_limit, max_concurrent,
+                lease_seconds=LEASE_SECONDS, window=DAILY_WINDOW):
+        now = _now_ms()
+        with self._lock:
+            gens = self._gens.setdefault(user_id, {})
+            leases = self._leases.setdefault(user_id, {})
+
+            for id, expiry in list(leases.items()):
+                if expiry <= now:
+                    del leases[id]
+                    gens.pop(id, None)
+            for id, started in list(gens.items()):
+                if started <= now - window * 1000:
+                    del gens[id]
+
+            if len(gens) >= daily_limit:
+                oldest = min(gens.values()) if gens else now
+                retry_ms = oldest + window * 1000 - now
+                return Reservation(DAILY_LIMIT, len(gens), len(leases),
+                                   max(0, -(-retry_ms // 1000)))
+            if len(leases) >= max_concurrent:
+                return Reservation(CONCURRENT_LIMIT, len(gens), len(leases))
+
+            gens[lease_id] = now
+            leases[lease_id] = now + lease_seconds * 1000
+            return Reservation(RESERVED, len(gens), len(leases))
+
+    def renew(self, user_id, lease_id, lease_seconds=LEASE_SECONDS):
+        with self._lock:
+            leases = self._leases.get(user_id, {})
+            if lease_id not in leases:
+                return False
+            leases[lease_id] = _now_ms() + lease_seconds * 1000
+            return True
+
+    def finish(self, user_id, lease_id, success=True, gpu_seconds=0):
+        with self._lock:
+            held = self._leases.get(user_id, {}).pop(lease_id, None) is not None
+            if not success:
+                self._gens.get(user_id, {}).pop(lease_id, None)
+            if gpu_seconds > 0:
+                self._gpu[user_id] = self._gpu.get(user_id, 0.0) + float(gpu_seconds)
+            return held
+
+    def status(self, user_id, window=DAILY_WINDOW):
+        now = _now_ms()
+        with self._lock:
+            gens = self._gens.get(user_id, {})
+            leases = self._leases.get(user_id, {})
+            return QuotaStatus(
+                used=sum(1 for started in gens.values() if started > now - window * 1000),
+                active=sum(1 for expiry in leases.values() if expiry > now),
+                gpu_seconds=self._gpu.get(user_id, 0.0),
+            )
+
+
+def create_quota_store():
+    url = getattr(settings, 'QUOTA_REDIS_URL', '')
+    if url and redis is not None:
+        return RedisQuotaStore(redis.Redis.from_url(url))
+    if url:
+        logger.warning("QUOTA_REDIS_URL is set but redis-py is not installed; "
+                       "generation quotas are per process")
+    return LocalQuotaStore()
+
+
+class _LazyQuotaStore:
+    """Creates the configured store on first use (after settings are loaded)."""
+
+    def __init__(self):
+        self._store = None
+        self._lock = threading.Lock()
+
+    def _get(self):
+        if self._store is None:
+            with self._lock:
+                if self._store is None:
+                    self._store = create_quota_store()
+        return self._store
+
+    def __getattr__(self, name):
+        return getattr(self._get(), name)
+
+
+# Shared by all requests and tasks in this process
+quota_store = _LazyQuotaStore()
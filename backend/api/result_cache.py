@@ -0,0 +1,234 @@
+"""
+Content-Addressed Result Cache for FixPix
+
+Lets process_image_async skip work when the same settings are requested on
+the same original content again (retries, double-clicks, clients re-posting
+after a resume, or the same photo uploaded twice).
+
+The cache key is a SHA-256 over the original's content hash, the normalized
+settings and the inpainting mask hash. Results are ProcessedResult rows with
+a reference count of the projects using them:
+
+- acquire() on a hit, register() after a miss: +1
+- release() when a project is deleted or re-processed: -1 (release_many()
+  for many projects at once)
+- evict_unreferenced() (run by cleanup_old_processed_images) deletes results
+  with no references that have not been used since the cutoff, along with
+  their derivatives.
+
+Usage:
+    from api import result_cache
+
+    key = result_cache.make_key(original_hash, settings_data, mask_hash)
+    cached_path = result_cache.acquire(key)
+"""
+
+import hashlib
+import json
+import logging
+from collections import Counter
+
+import numpy as np
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Bump when pipeline output changes so stale results stop matching
+RESULT_CACHE_VERSION = 1
+
+# Settings that affect output, with their no-op defaults and the coercion
+# the pipeline applies when reading them
+SETTING_DEFAULTS = {
+    'removeScratches': (False, bool),
+    'faceRestoration': (False, bool),
+    'colorize': (False, bool),
+    'brightness': (1.0, float),
+    'contrast': (1.0, float),
+    'saturation': (1.0, float),
+    'upscaleX': (1, int),
+    'autoEnhance': (False, bool),
+    'whiteBalance': (False, bool),
+    'denoiseStrength': (0, int),
+    'denoiseQuality': ('high', str),
+    'filterPreset': ('', str),
+    'removeBackground': (False, bool),
+}
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def hash_array(array):
+    """Content hash of a decoded image (shape and dtype included)."""
+    digest = hashlib.sha256(f'{array.shape}{array.dtype.str}'.encode())
+    digest.update(memoryview(np.ascontiguousarray(array)).cast('B'))
+    return digest.hexdigest()
+
+
+def hash_file(file):
+    """SHA-256 of a file-like object, read in chunks. Rewinds it afterwards."""
+    digest = hashlib.sha256()
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    if hasattr(file, 'chunks'):
+        chunks = file.chunks(HASH_CHUNK_SIZE)
+    else:
+        chunks = iter(lambda: file.read(HASH_CHUNK_SIZE), b'')
+    for chunk in chunks:
+        digest.update(chunk)
+    if hasattr(file, 'seek'):
+        file.seek(0)
+    return digest.hexdigest()
+
+
+def get_original_hash(project):
+    """Return the project's original content hash, computing and saving it once."""
+    from django.core.files.storage import default_storage
+
+    if project.original_hash:
+        return project.original_hash
+
+    with default_storage.open(project.original_image.name, 'rb') as f:
+        project.original_hash = hash_file(f)
+    project.save(update_fields=['original_hash'])
+    return project.original_hash
+
+
+def normalize_settings(settings_data):
+    """
+    Canonical form of a settings dict: unknown keys dropped, values coerced
+    the way the pipeline reads them, and no-op values removed.
+    """
+    normalized = {}
+    for key, (default, coerce) in SETTING_DEFAULTS.items():
+        if key not in settings_data:
+            continue
+        value = coerce(settings_data[key])
+        if key == 'filterPreset' and value == 'none':
+            value = ''
+        if key == 'upscaleX' and value <= 1:
+            value = default
+        if key == 'denoiseStrength' and value <= 0:
+            value = default
+        if value != default:
+            normalized[key] = value
+    return normalized
+
+
+def make_key(original_hash, settings_data, mask_hash=None):
+    payload = json.dumps({
+        'v': RESULT_CACHE_VERSION,
+        'original': original_hash,
+        'settings': normalize_settings(settings_data),
+        'mask': mask_hash,
+    }, sort_keys=True, separators=(',', ':'))
+    return hash_bytes(payload.encode())
+
+
+def acquire(key):
+    """
+    Take a reference on a cached result.
+
+    Returns the storage name of the result, or None on a miss.
+    """
+    from django.core.files.storage import default_storage
+    from .models import ProcessedResult
+
+    # Increment first: eviction only deletes rows with ref_count=0, so a
+    # row we managed to increment cannot disappear underneath us.
+    updated = ProcessedResult.objects.filter(key=key).update(
+        ref_count=F('ref_count') + 1, last_used_at=timezone.now()
+    )
+    if not updated:
+        return None
+
+    result = ProcessedResult.objects.get(key=key)
+    if not default_storage.exists(result.image.name):
+        # Artifact lost from storage: drop the entry and treat as a miss
+        logger.warning(f"Result cache: artifact missing for {key[:12]}")
+        ProcessedResult.objects.filter(key=key).delete()
+        return None
+
+    return result.image.name
+
+
+def register(key, image_name):
+    """
+    Record a freshly processed result with one reference.
+
+    Returns False if another worker registered the same key first; the
+    caller then keeps its own file unmanaged.
+    """
+    from django.core.files.storage import default_storage
+    from .models import ProcessedResult
+
+    try:
+        size = default_storage.size(image_name)
+    except Exception:
+        size = 0
+
+    try:
+        # Savepoint, so a lost race leaves an enclosing transaction usable
+        with transaction.atomic():
+            ProcessedResult.objects.create(key=key, image=image_name, ref_count=1, size_bytes=size)
+        return True
+    except IntegrityError:
+        return False
+
+
+def release(key):
+    """Drop one reference. Unreferenced results stay until evicted."""
+    from .models import ProcessedResult
+
+    ProcessedResult.objects.filter(key=key, ref_count__gt=0).update(
+        ref_count=F('ref_count') - 1
+    )
+
+
+def release_many(keys):
+    """Drop one reference per entry of keys (repeats allowed), in one UPDATE."""
+    from .models import ProcessedResult
+
+    counts = Counter(filter(None, keys))
+    if not counts:
+        return
+    decrement = Case(
+        *[When(key=key, then=Value(n)) for key, n in counts.items()],
+        output_field=IntegerField(),
+    )
+    ProcessedResult.objects.filter(key__in=counts).update(
+        ref_count=Greatest(F('ref_count') - decrement, Value(0))
+    )
+
+
+def evict_unreferenced(cutoff):
+    """
+    Delete unreferenced results last used before cutoff, and their files.
+
+    Returns the number of results evicted.
+    """
+    from django.core.files.storage import default_storage
+    from .derivatives import delete_derivatives
+    from .models import ProcessedResult
+
+    evicted = 0
+    stale = ProcessedResult.objects.filter(ref_count=0, last_used_at__lt=cutoff)
+    for result in stale.only('key', 'image'):
+        # Re-check ref_count in the DELETE itself in case of a concurrent hit
+        deleted, _ = ProcessedResult.objects.filter(key=result.key, ref_count=0).delete()
+        if not deleted:
+            continue
+        try:
+            default_storage.delete(result.image.name)
+        except Exception as e:
+            logger.warning(f"Result cache: could not delete {result.image.name}: {e}")
+        delete_derivatives(result.image.name)
+        evicted += 1
+    return evicted
@@ -0,0 +1,188 @@
+"""
+Job Routing for FixPix
+
+Picks the Celery lane (queue) and priority of a job (queues are configured
+in backend/celery.py).
+
+A processing job's cost is estimated from the original's megapixels and the
+stages its settings compile to: each stage costs a per-megapixel weight
+(roughly core-seconds per megapixel), upscales multiply the megapixels the
+stages after them see. Jobs above LIGHT_MAX_COST go to the heavy lane.
+
+Priority ("urgency", higher runs sooner) starts from the user's plan tier;
+light jobs get a bonus and very expensive ones a penalty, so small
+interactive edits go first within a lane. It is converted to the broker's
+scale when dispatched (Redis pops priority 0 first, RabbitMQ 9).
+
+Usage:
+    from api.routing import route_processing
+
+    route = route_processing(project, settings_data, has_mask=True)
+    process_image_async.apply_async(args, **route.options)
+
+Batch chunks (api/batch.py) always run on the heavy lane, one step below
+the user's single jobs.
+"""
+
+import logging
+import re
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger(__name__)
+
+LIGHT_QUEUE = 'light'
+HEAVY_QUEUE = 'heavy'
+GENERATION_QUEUE = 'generation'
+
+MAX_PRIORITY = 9
+
+# Estimated cost above which a processing job runs on the heavy lane
+LIGHT_MAX_COST = 4.0
+
+# Cost above which a job counts as batch work (priority penalty)
+BATCH_COST = 60.0
+
+# Cost of a stage per megapixel of its input (~core-seconds per MP)
+STAGE_COSTS = {
+    'remove_scratches': 6.0,
+    'denoise': 6.0,
+    'remove_background': 4.0,
+    'inpaint': 1.5,
+    'restore_faces': 0.5,
+    'auto_enhance': 0.4,
+    'clarity': 0.4,
+    'colorize': 0.3,
+    'upscale': 1.0,  # per output megapixel
+}
+# One fused pointwise pass (see api/pipeline.py)
+FUSED_COST = 0.05
+# Decode, encode and store, per megapixel of the result
+IO_COST = 0.2
+# NLM stages with denoiseQuality='fast'
+FAST_NLM_FACTOR = 0.5
+
+# Urgency by plan tier (see api/tiers.py)
+TIER_PRIORITY = {
+    'free': 3,
+    'pro': 6,
+    'enterprise': 8,
+}
+
+# Assumed size when the original's header cannot be read
+DEFAULT_MEGAPIXELS = 12.0
+
+MEGAPIXELS_CACHE_TIMEOUT = 24 * 60 * 60
+
+_UPSCALE_RE = re.compile(r'^upscale_(\d+)x$')
+
+
+@dataclass
+class Route:
+    queue: str
+    priority: int  # urgency, 0-9, higher runs sooner
+    cost: float = 0.0
+    megapixels: float = 0.0
+
+    @property
+    def options(self):
+        """apply_async() options."""
+        return {'queue': self.queue, 'priority': broker_priority(self.priority)}
+
+
+def broker_priority(urgency):
+    """Message priority for the configured broker (Redis serves 0 first)."""
+    broker = getattr(settings, 'CELERY_BROKER_URL', '') or ''
+    if broker.startswith(('redis://', 'rediss://')):
+        return MAX_PRIORITY - urgency
+    return urgency
+
+
+def image_megapixels(name):
+    """Megapixels of a stored image from its header (cached per name)."""
+    from django.core.files.storage import default_storage
+    from .security import HEADER_WINDOW, InvalidImageHeader, file_reader, parse_image_header
+
+    key = f'fixpix:megapixels:{name}'
+    megapixels = cache.get(key)
+    if megapixels is not None:
+        return megapixels
+
+    try:
+        with default_storage.open(name, 'rb') as f:
+            _, width, height = parse_image_header(file_reader(f, f.read(HEADER_WINDOW)))
+    except (OSError, InvalidImageHeader) as e:
+        logger.warning(f"Routing: could not read the size of {name}: {e}")
+        return DEFAULT_MEGAPIXELS
+
+    megapixels = width * height / 1e6
+    cache.set(key, megapixels, timeout=MEGAPIXELS_CACHE_TIMEOUT)
+    return megapixels
+
+
+def estimate_cost(stage_names, megapixels, fast_nlm=False):
+    """Estimated cost of running the named pipeline stages on an image."""
+    cost = 0.0
+    for name in stage_names:
+        if name.startswith('fused('):
+            cost += FUSED_COST * megapixels
+            continue
+        upscale = _UPSCALE_RE.match(name)
+        if upscale:
+            factor = int(upscale.group(1))
+            megapixels *= factor * factor
+            cost += STAGE_COSTS['upscale'] * megapixels
+            continue
+        weight = STAGE_COSTS.get(name, 0.0)
+        if fast_nlm and name in ('remove_scratches', 'denoise'):
+            weight *= FAST_NLM_FACTOR
+        cost += weight * megapixels
+    return cost + IO_COST * megapixels
+
+
+def tier_priority(user, cost=0.0, light=False):
+    """Urgency of a job for this user's tier, adjusted for its cost."""
+    from .tiers import DEFAULT_TIER, resolve_tier
+
+    tier = resolve_tier(user) if user is not None else DEFAULT_TIER
+    urgency = TIER_PRIORITY.get(tier, TIER_PRIORITY[DEFAULT_TIER])
+    if light:
+        urgency += 1
+    if cost > getattr(settings, 'ROUTING_BATCH_COST', BATCH_COST):
+        urgency -= 1
+    return max(0, min(MAX_PRIORITY, urgency))
+
+
+def route_processing(project, settings_data, has_mask=False):
+    """Lane and priority of a process_image_async job."""
+    import numpy as np
+    from .pipeline import compile_pipeline
+
+    megapixels = image_megapixels(project.original_image.name) if project.original_image else 0.0
+    # Only stage names are needed; any mask compiles the inpaint stage
+    mask = np.zeros((1, 1), dtype=np.uint8) if has_mask else None
+    try:
+        stages = compile_pipeline(settings_data, mask_img=mask).describe()
+    except (ValueError, TypeError):
+        stages = []  # Invalid settings fail fast in the task itself
+    cost = estimate_cost(stages, megapixels, fast_nlm=settings_data.get('denoiseQuality') == 'fast')
+
+    light = cost <= getattr(settings, 'ROUTING_LIGHT_MAX_COST', LIGHT_MAX_COST)
+    return Route(
+        queue=LIGHT_QUEUE if light else HEAVY_QUEUE,
+        priority=tier_priority(project.user, cost, light),
+        cost=round(cost, 2),
+        megapixels=round(megapixels, 2),
+    )
+
+
+def route_generation(user):
+    """Lane and priority of a generate_image_async job."""
+    return Route(queue=GENERATION_QUEUE, priority=tier_priority(user))
+
+
+def route_batch(user):
+    """Lane and priority of process_batch_chunk_async jobs: batch work, behind single edits."""
+    return Route(queue=HEAVY_QUEUE, priority=max(0, tier_priority(user) - 1))
@@ -0,0 +1,177 @@
+"""
+Scratch Artifacts for FixPix
+
+Hands intermediate images (masks, partial pipeline results) from one task
+or request to another on the same host by reference instead of encoding
+them to PNG and round-tripping through storage.
+
+An artifact is a raw .npy file in SCRATCH_DIR, passed around as a handle
+string ('scratch://<host>/<file>'). Loading it memory-maps the file, so
+there is no decode and no copy: every process that loads it shares the same
+page-cache pages. The default directory lives on /dev/shm when the host has
+it, which makes artifacts shared memory between the web process and the
+Celery prefork children.
+
+Artifacts expire after a TTL (the expiry time is part of the file name).
+Expired files are removed by cleanup_scratch_artifacts and, at most once per
+SWEEP_INTERVAL, by put() itself. Handles only resolve on the host that made
+them; callers fall back to storage when ScratchMissing is raised.
+
+Usage:
+    from api.scratch import scratch_store
+
+    handle = scratch_store.put(img)
+    img = scratch_store.load(handle)   # read-only, memory-mapped
+    scratch_store.delete(handle)
+"""
+
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+import uuid
+
+import numpy as np
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+HANDLE_PREFIX = 'scratch://'
+
+# Default lifetime of an artifact (seconds)
+SCRATCH_TTL = 60 * 60
+
+# Minimum spacing of the expiry sweep done by put()
+SWEEP_INTERVAL = 5 * 60
+
+_HANDLE_RE = re.compile(r'^scratch://([^/]+)/(\d+-[0-9a-f]{32}\.npy)$')
+
+
+class ScratchMissing(Exception):
+    """The artifact expired, was deleted, or lives on another host."""
+
+
+def default_scratch_dir():
+    """Shared memory (tmpfs) when available, else the system temp directory."""
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        return '/dev/shm/fixpix-scratch'
+    return os.path.join(tempfile.gettempdir(), 'fixpix-scratch')
+
+
+class ScratchStore:
+    """TTL'd .npy artifacts in a host-local directory, addressed by handle."""
+
+    def __init__(self, directory=None, ttl=None):
+        self._directory = directory
+        self._ttl = ttl
+        self._host = socket.gethostname()
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self):
+        if self._directory is not None:
+            return self._directory
+        return getattr(settings, 'SCRATCH_DIR', '') or default_scratch_dir()
+
+    @property
+    def ttl(self):
+        if self._ttl is not None:
+            return self._ttl
+        return getattr(settings, 'SCRATCH_TTL', SCRATCH_TTL)
+
+    @staticmethod
+    def is_handle(value):
+        return isinstance(value, str) and value.startswith(HANDLE_PREFIX)
+
+    def _path(self, handle):
+        match = _HANDLE_RE.match(handle or '')
+        if not match:
+            raise ScratchMissing(f"Not a scratch handle: {handle!r}")
+        host, name = match.groups()
+        if host != self._host:
+            raise ScratchMissing(f"Scratch artifact lives on {host}")
+        return os.path.join(self.directory, name), int(name.split('-', 1)[0])
+
+    def put(self, array, ttl=None):
+        """Store an ndarray and return its handle."""
+        expires = int(time.time() + (ttl or self.ttl))
+        name = f'{expires}-{uuid.uuid4().hex}.npy'
+        path = os.path.join(self.directory, name)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.ascontiguousarray(array), allow_pickle=False)
+            os.replace(tmp_path, path)  # Readers never see a partial file
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            raise
+
+        self._maybe_sweep()
+        return f'{HANDLE_PREFIX}{self._host}/{name}'
+
+    def load(self, handle):
+        """Return the artifact as a read-only memory-mapped ndarray."""
+        path, expires = self._path(handle)
+        if expires < time.time():
+            raise ScratchMissing("Scratch artifact expired")
+        try:
+            return np.asarray(np.load(path, mmap_mode='r', allow_pickle=False))
+        except (OSError, ValueError) as e:
+            raise ScratchMissing(str(e))
+
+    def delete(self, handle):
+        """Remove an artifact. Mappings already loaded stay valid."""
+        try:
+            path, _ = self._path(handle)
+            os.remove(path)
+        except (ScratchMissing, OSError):
+            pass
+
+    def cleanup_expired(self):
+        """Delete expired artifacts (and stale temp files). Returns the count."""
+        now = time.time()
+        removed = 0
+        try:
+            entries = list(os.scandir(self.directory))
+        except OSError:
+            return 0
+
+        for entry in entries:
+            try:
+                if entry.name.endswith('.npy'):
+                    expired = int(entry.name.split('-', 1)[0]) < now
+                else:
+                    # Left behind by a writer that died mid-put
+                    expired = entry.stat().st_mtime < now - self.ttl
+            except (ValueError, OSError):
+                continue
+            if expired:
+                try:
+                    os.remove(entry.path)
+                    removed += 1
+                except OSError:
+                    pass
+        return removed
+
+    def _maybe_sweep(self):
+        with self._lock:
+            if time.monotonic() - self._last_sweep < SWEEP_INTERVAL and self._last_sweep:
+                return
+            self._last_sweep = time.monotonic()
+        try:
+            self.cleanup_expired()
+        except Exception as e:
+            logger.warning(f"Scratch sweep failed: {e}")
+
+
+# Shared by all tasks and requests in this process
+scratch_store = ScratchStore()
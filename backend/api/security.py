@@ -2,12 +2,15 @@
 Security Utilities for FixPix
 
 File validation, sanitization, and security checks for uploaded images.
+
+Validation never decodes pixels: format and dimensions are parsed straight
+from the JPEG/PNG/WebP/GIF/BMP/TIFF headers, so CPU and memory cost depend on
+the header size, not the file size.
 """
 
 import os
-import magic
 import hashlib
-from PIL import Image
+import struct
 from django.core.exceptions import ValidationError
 
 
@@ -27,6 +30,234 @@ MAX_FILE_SIZE = 20 * 1024 * 1024
 # Maximum image dimensions
 MAX_DIMENSION = 10000  # 10k pixels
 
+# Maximum declared pixel count. Checked from the header before anything is
+# decoded, so decompression bombs are rejected without allocating.
+MAX_PIXELS = 50 * 1000 * 1000
+
+# Leading bytes read for type sniffing, header parsing and the pattern scan.
+# Headers extending past it (large EXIF blocks, TIFF IFDs at the end of the
+# file) are followed with small seeks, never full reads.
+HEADER_WINDOW = 64 * 1024
+
+# Magic-byte signatures of the allowed types: (offset, bytes, mime)
+IMAGE_SIGNATURES = [
+    (0, b'\xff\xd8\xff', 'image/jpeg'),
+    (0, b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (0, b'GIF87a', 'image/gif'),
+    (0, b'GIF89a', 'image/gif'),
+    (0, b'BM', 'image/bmp'),
+    (0, b'II*\x00', 'image/tiff'),
+    (0, b'MM\x00*', 'image/tiff'),
+]
+
+# Suspicious byte patterns (see check_image_for_malware)
+SUSPICIOUS_PATTERNS = [
+    b'<?php',
+    b'<?=',
+    b'<script',
+    b'javascript:',
+]
+
+# Executable headers, matched at the start of the file only: two-byte 'MZ'
+# turns up by chance in ~15% of 10KB windows of ordinary JPEG data.
+EXECUTABLE_SIGNATURES = [
+    b'MZ',  # Windows executable
+    b'\x7fELF',  # Linux executable
+]
+
+# Leading bytes scanned for SUSPICIOUS_PATTERNS
+MALWARE_SCAN_BYTES = 10000
+
+
+def has_suspicious_content(head):
+    """True if the leading bytes of a file look like a script or executable."""
+    if any(head.startswith(signature) for signature in EXECUTABLE_SIGNATURES):
+        return True
+    window = head[:MALWARE_SCAN_BYTES]
+    return any(pattern in window for pattern in SUSPICIOUS_PATTERNS)
+
+
+def sniff_mime(header):
+    """Identify an allowed image type from its first bytes, or None."""
+    if len(header) >= 12 and header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    for offset, signature, mime in IMAGE_SIGNATURES:
+        if header[offset:offset + len(signature)] == signature:
+            return mime
+    return None
+
+
+class HeaderIncomplete(Exception):
+    """The header needs `length` bytes at `offset`, beyond the bytes available."""
+
+    def __init__(self, offset, length):
+        super().__init__(f"Header continues at byte {offset}")
+        self.offset = offset
+        self.length = length
+
+
+class InvalidImageHeader(ValueError):
+    pass
+
+
+def _u16(data, offset, order='>'):
+    return struct.unpack_from(f'{order}H', data, offset)[0]
+
+
+def _u32(data, offset, order='>'):
+    return struct.unpack_from(f'{order}I', data, offset)[0]
+
+
+def _parse_jpeg(read):
+    # Walk marker segments by their lengths until a Start Of Frame
+    pos = 2
+    for _ in range(4096):
+        marker = read(pos, 2)
+        if marker[0] != 0xFF:
+            raise InvalidImageHeader("Bad JPEG marker")
+        code = marker[1]
+        if code == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if code in (0x01,) or 0xD0 <= code <= 0xD7:  # Standalone markers
+            pos += 2
+            continue
+        if code in (0xD9, 0xDA):
+            raise InvalidImageHeader("No JPEG frame header before image data")
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            frame = read(pos + 5, 4)
+            return _u16(frame, 2), _u16(frame, 0)
+        pos += 2 + _u16(read(pos + 2, 2), 0)
+    raise InvalidImageHeader("Too many JPEG segments")
+
+
+def _parse_png(read):
+    ihdr = read(8, 16)
+    if ihdr[4:8] != b'IHDR':
+        raise InvalidImageHeader("Missing PNG IHDR")
+    return _u32(ihdr, 8), _u32(ihdr, 12)
+
+
+def _parse_gif(read):
+    screen = read(6, 4)
+    return _u16(screen, 0, '<'), _u16(screen, 2, '<')
+
+
+def _parse_bmp(read):
+    dib_size = _u32(read(14, 4), 0, '<')
+    if dib_size == 12:  # OS/2 BITMAPCOREHEADER
+        dims = read(18, 4)
+        return _u16(dims, 0, '<'), _u16(dims, 2, '<')
+    width, height = struct.unpack_from('<ii', read(18, 8))
+    return abs(width), abs(height)  # Negative height = top-down
+
+
+def _parse_webp(read):
+    chunk = read(12, 4)
+    if chunk == b'VP8X':
+        canvas = read(24, 6)
+        return (int.from_bytes(canvas[0:3], 'little') + 1,
+                int.from_bytes(canvas[3:6], 'little') + 1)
+    if chunk == b'VP8L':
+        data = read(20, 5)
+        if data[0] != 0x2F:
+            raise InvalidImageHeader("Bad VP8L signature")
+        bits = _u32(data, 1, '<')
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b'VP8 ':
+        frame = read(23, 7)
+        if frame[:3] != b'\x9d\x01\x2a':
+            raise InvalidImageHeader("Bad VP8 start code")
+        return _u16(frame, 3, '<') & 0x3FFF, _u16(frame, 5, '<') & 0x3FFF
+    raise InvalidImageHeader("Unknown WebP chunk")
+
+
+def _parse_tiff(read):
+    order = '<' if read(0, 2) == b'II' else '>'
+    ifd = _u32(read(4, 4), 0, order)
+    count = _u16(read(ifd, 2), 0, order)
+    dims = {}
+    for i in range(min(count, 4096)):
+        entry = read(ifd + 2 + 12 * i, 12)
+        tag, kind = struct.unpack_from(f'{order}HH', entry)
+        if tag in (256, 257):
+            # SHORT (3) or LONG (4), stored inline in the value field
+            dims[tag] = _u16(entry, 8, order) if kind == 3 else _u32(entry, 8, order)
+            if len(dims) == 2:
+                return dims[256], dims[257]
+        elif tag > 257:
+            break  # Entries are sorted by tag
+    raise InvalidImageHeader("TIFF has no image dimensions")
+
+
+HEADER_PARSERS = {
+    'image/jpeg': _parse_jpeg,
+    'image/png': _parse_png,
+    'image/gif': _parse_gif,
+    'image/bmp': _parse_bmp,
+    'image/webp': _parse_webp,
+    'image/tiff': _parse_tiff,
+}
+
+
+def parse_image_header(read):
+    """
+    Identify an image and read its dimensions without decoding it.
+
+    Args:
+        read: read(offset, length) -> bytes. Raise HeaderIncomplete for
+              bytes that are not available (yet).
+
+    Returns:
+        (mime, width, height)
+
+    Raises:
+        InvalidImageHeader for unknown, corrupt or truncated headers.
+    """
+    mime = sniff_mime(read(0, 16))
+    if mime not in HEADER_PARSERS:
+        raise InvalidImageHeader("Unknown image format")
+    try:
+        width, height = HEADER_PARSERS[mime](read)
+    except (struct.error, IndexError):
+        raise InvalidImageHeader("Truncated image header")
+    return mime, width, height
+
+
+def buffer_reader(data, complete=True):
+    """read() over bytes; past the end is truncation if complete, else HeaderIncomplete."""
+    def read(offset, length):
+        if offset + length > len(data):
+            if complete:
+                raise InvalidImageHeader("Truncated image header")
+            raise HeaderIncomplete(offset, length)
+        return data[offset:offset + length]
+    return read
+
+
+def file_reader(file, head):
+    """read() serving the leading window from memory and the rest by seeking."""
+    def read(offset, length):
+        if offset + length <= len(head):
+            return head[offset:offset + length]
+        file.seek(offset)
+        data = file.read(length)
+        if len(data) < length:
+            raise InvalidImageHeader("Truncated image header")
+        return data
+    return read
+
+
+def check_dimensions(width, height):
+    """Return an error message for oversized or bomb-like dimensions, or None."""
+    if width <= 0 or height <= 0:
+        return "Invalid or corrupted image file: zero dimensions"
+    if width > MAX_DIMENSION or height > MAX_DIMENSION:
+        return f"Image dimensions too large. Max: {MAX_DIMENSION}x{MAX_DIMENSION}"
+    if width * height > MAX_PIXELS:
+        return f"Image has too many pixels. Max: {MAX_PIXELS // 1000000} megapixels"
+    return None
+
 
 def validate_uploaded_file(file):
     """
@@ -36,8 +267,11 @@ def validate_uploaded_file(file):
     1. File size
     2. File extension
     3. MIME type (magic bytes)
-    4. Image validity (can be opened by PIL)
-    5. Image dimensions
+    4. Image header validity (parsed directly, no pixel decode)
+    5. Image dimensions and pixel count (decompression bombs)
+    
+    Only the leading HEADER_WINDOW bytes are read, plus small seeks for
+    headers that extend past it.
     
     Returns: (is_valid, error_message)
     """
@@ -53,36 +287,25 @@ def validate_uploaded_file(file):
     if ext not in valid_extensions:
         errors.append(f"Invalid file extension. Allowed: {', '.join(valid_extensions)}")
     
-    # 3. Check MIME type using magic bytes
+    # 3-5. Type, header and dimensions from one bounded read
     try:
         file.seek(0)
-        file_header = file.read(2048)
-        file.seek(0)
+        head = file.read(HEADER_WINDOW)
         
-        mime = magic.from_buffer(file_header, mime=True)
+        mime = sniff_mime(head)
         if mime not in ALLOWED_MIME_TYPES:
             errors.append(f"Invalid file type: {mime}. Only images are allowed.")
+        else:
+            _, width, height = parse_image_header(file_reader(file, head))
+            dimension_error = check_dimensions(width, height)
+            if dimension_error:
+                errors.append(dimension_error)
+    except InvalidImageHeader as e:
+        errors.append(f"Invalid or corrupted image file: {str(e)}")
     except Exception as e:
         errors.append(f"Could not verify file type: {str(e)}")
-    
-    # 4. Validate image can be opened by PIL
-    try:
-        file.seek(0)
-        img = Image.open(file)
-        img.verify()  # Verify it's actually an image
-        file.seek(0)
-        
-        # Reopen for dimension check (verify closes the file)
-        img = Image.open(file)
-        width, height = img.size
+    finally:
         file.seek(0)
-        
-        # 5. Check dimensions
-        if width > MAX_DIMENSION or height > MAX_DIMENSION:
-            errors.append(f"Image dimensions too large. Max: {MAX_DIMENSION}x{MAX_DIMENSION}")
-            
-    except Exception as e:
-        errors.append(f"Invalid or corrupted image file: {str(e)}")
     
     if errors:
         return False, "; ".join(errors)
@@ -128,22 +351,12 @@ def check_image_for_malware(file):
     3. Executable headers
     """
     file.seek(0)
-    content = file.read()
+    head = file.read(MALWARE_SCAN_BYTES)  # Check first 10KB
     file.seek(0)
     
     # Check for suspicious patterns
-    suspicious_patterns = [
-        b'<?php',
-        b'<?=',
-        b'<script',
-        b'javascript:',
-        b'MZ',  # Windows executable
-        b'\x7fELF',  # Linux executable
-    ]
-    
-    for pattern in suspicious_patterns:
-        if pattern in content[:10000]:  # Check first 10KB
-            return False, f"Suspicious content detected in file"
+    if has_suspicious_content(head):
+        return False, f"Suspicious content detected in file"
     
     return True, None
 
@@ -168,3 +381,132 @@ class SecureFileValidator:
         is_safe, malware_error = check_image_for_malware(file)
         if not is_safe:
             raise ValidationError(malware_error)
+
+
+class StreamingImageValidator:
+    """
+    Single-pass validator for uploads read in chunks (see ingest_upload_async).
+
+    feed() each chunk in order, then finish(). Checks magic bytes, header
+    dimensions and pixel count, the malware patterns over the leading scan
+    window, and the size limit, while computing the SHA-256 of the content.
+    Memory use is bounded by HEADER_WINDOW whatever the file size.
+
+    Usage:
+        validator = StreamingImageValidator()
+        for chunk in f.chunks():
+            validator.feed(chunk)
+        is_valid, error = validator.finish()
+    """
+
+    # Bytes kept from each later position the header parser asks for
+    CAPTURE_BYTES = 64
+
+    def __init__(self, max_size=MAX_FILE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.mime = None
+        self.width = None
+        self.height = None
+        self.errors = []
+        self._sha256 = hashlib.sha256()
+        self._head = b''
+        # Header bytes past the window, captured as the stream goes by
+        self._captured = {}
+        self._want = None  # Offset of a capture still being filled
+        self._header = None  # (mime, width, height) once parsed
+        self._header_error = None
+
+    @property
+    def content_hash(self):
+        return self._sha256.hexdigest()
+
+    def _read(self, offset, length):
+        if offset + length <= len(self._head):
+            return self._head[offset:offset + length]
+        for start, data in self._captured.items():
+            if start <= offset and offset + length <= start + len(data):
+                return data[offset - start:offset - start + length]
+        raise HeaderIncomplete(offset, length)
+
+    def _bytes_from(self, offset, chunk, start):
+        """Contiguous bytes from offset still reachable in this feed, or None."""
+        if offset >= start:
+            return chunk[offset - start:]
+        if offset < len(self._head) and len(self._head) >= start:
+            return self._head[offset:] + chunk[len(self._head) - start:]
+        return None
+
+    def feed(self, chunk):
+        start = self.size
+        self._sha256.update(chunk)
+        self.size += len(chunk)
+
+        if len(self._head) < HEADER_WINDOW:
+            self._head += chunk[:HEADER_WINDOW - len(self._head)]
+
+        # Continue a capture cut short by the previous chunk boundary
+        captured = self._captured.get(self._want)
+        if captured is not None and self._want + len(captured) == start:
+            self._captured[self._want] = captured + chunk[:self.CAPTURE_BYTES - len(captured)]
+
+        # Parse as soon as the header is available, following it forward
+        # through the stream (JPEG segments after a large EXIF block, TIFF
+        # IFDs near the end of the file)
+        while self._header is None and self._header_error is None:
+            try:
+                self._header = parse_image_header(self._read)
+                break
+            except HeaderIncomplete as e:
+                offset, length = e.offset, e.length
+            except InvalidImageHeader as e:
+                self._header_error = str(e)
+                break
+
+            if offset + length <= HEADER_WINDOW and len(self._head) < HEADER_WINDOW:
+                break  # The window is still filling
+            if offset >= self.size:
+                self._want = offset
+                break  # Not streamed yet
+            if offset in self._captured and offset + length > self.size:
+                break  # Capture in progress
+            data = self._bytes_from(offset, chunk, start)
+            if data is None:
+                self._header_error = "Image header could not be read in one pass"
+                break
+            self._want = offset
+            self._captured[offset] = data[:max(self.CAPTURE_BYTES, length)]
+            if offset + length > self.size:
+                break  # Rest arrives with the next chunk
+
+    def finish(self):
+        """Return (is_valid, error_message)."""
+        if self._header is None and self._header_error is None:
+            try:
+                self._header = parse_image_header(self._read)
+            except HeaderIncomplete:
+                self._header_error = "Truncated image header"
+            except InvalidImageHeader as e:
+                self._header_error = str(e)
+
+        errors = list(self.errors)
+        if self.size > self.max_size:
+            errors.append(f"File too large. Maximum size is {self.max_size // (1024*1024)}MB")
+
+        self.mime = sniff_mime(self._head[:16])
+        if self.mime not in ALLOWED_MIME_TYPES:
+            errors.append("Invalid file type. Only images are allowed.")
+        elif self._header is None:
+            errors.append(f"Invalid or corrupted image file: {self._header_error}")
+        else:
+            _, self.width, self.height = self._header
+            dimension_error = check_dimensions(self.width, self.height)
+            if dimension_error:
+                errors.append(dimension_error)
+
+        if has_suspicious_content(self._head):
+            errors.append("Suspicious content detected in file")
+
+        if errors:
+            return False, "; ".join(errors)
+        return True, None
@@ -53,20 +53,35 @@ class SettingsSerializer(serializers.Serializer):
 
 class ImageProjectSerializer(serializers.ModelSerializer):
     settings = SettingsSerializer(required=False)
+    derivatives = serializers.SerializerMethodField()
     
     class Meta:
         model = ImageProject
         fields = (
             'id', 'user', 'original_image', 'processed_image', 
-            'processing_type', 'settings', 'created_at', 'status',
+            'processing_type', 'settings', 'created_at', 'status', 'derivatives',
             # AI Generation fields
-            'source', 'prompt', 'gen_style', 'gen_seed', 'gen_steps'
+            'source', 'prompt', 'gen_style', 'gen_seed', 'gen_steps',
+            'batch',
         )
         read_only_fields = (
             'processed_image', 'user', 'created_at', 'status',
-            'gen_seed', 'gen_steps'
+            'gen_seed', 'gen_steps', 'batch',
         )
 
+    def get_derivatives(self, obj):
+        """{size: {url, width, height}} for the thumb/preview/full renditions."""
+        from django.core.files.storage import default_storage
+
+        request = self.context.get('request')
+        result = {}
+        for size, info in (obj.derivatives or {}).items():
+            url = default_storage.url(info['name'])
+            if request is not None:
+                url = request.build_absolute_uri(url)
+            result[size] = {'url': url, 'width': info['width'], 'height': info['height']}
+        return result
+
     def validate_settings(self, value):
         # Additional custom validation if needed
         return value
@@ -1,6 +1,9 @@
-from django.db.models.signals import post_delete
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from .models import ImageProject
+from .tiers import plan_changed, invalidate_tier, profile_relation
 from django.core.files.storage import default_storage
 
 @receiver(post_delete, sender=ImageProject)
@@ -17,9 +20,42 @@ def delete_project_files(sender, instance, **kwargs):
         except Exception:
             pass # Fail silently on cleanup
 
-    if instance.processed_image:
+    if instance.result_key:
+        # Shared cached result: drop our reference, eviction deletes the file
+        from .result_cache import release
+        try:
+            release(instance.result_key)
+        except Exception:
+            pass
+    elif instance.processed_image:
         try:
              if default_storage.exists(instance.processed_image.name):
                 default_storage.delete(instance.processed_image.name)
         except Exception:
             pass
+        from .derivatives import delete_derivatives
+        delete_derivatives(instance.processed_image.name)
+
+
+@receiver(setting_changed)
+def reset_image_cache(setting, **kwargs):
+    """Storage swapped (tests): remembered fingerprints name other files now."""
+    if setting in ('MEDIA_ROOT', 'STORAGES', 'STORAGE_PROVIDER'):
+        from .image_cache import decoded_image_cache
+        decoded_image_cache.clear()
+
+
+@receiver(plan_changed)
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_cached_tier(sender, instance=None, user_id=None, **kwargs):
+    """Drop the cached plan tier of a user whose plan (or account) changed."""
+    invalidate_tier(user_id if user_id is not None else instance.pk)
+
+
+# Plans live on user.profile; saving it is how plans normally change
+_profile_relation = profile_relation()
+if _profile_relation is not None:
+    @receiver(post_save, sender=_profile_relation.related_model, dispatch_uid='api.invalidate_profile_tier')
+    def invalidate_profile_tier(sender, instance, **kwargs):
+        """Drop the cached plan tier of a user whose profile was saved."""
+        invalidate_tier(getattr(instance, _profile_relation.field.attname))
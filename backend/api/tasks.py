@@ -22,7 +22,8 @@ except ImportError:
     class MockTask:
         """Mock Celery Task object for bind=True tasks."""
         def __init__(self):
-            self.request = type('obj', (object,), {'id': str(uuid.uuid4())})()
+            self.request = type('obj', (object,), {'id': str(uuid.uuid4()), 'retries': 0})()
+            self.max_retries = 0  # Cannot retry synchronously
         
         def retry(self, *args, **kwargs):
             """Mock retry - just raise the exception since we can't actually retry."""
@@ -49,20 +50,35 @@ except ImportError:
                     result = func(*d_args, **d_kwargs)
                 return MockAsyncResult(result)
             
+            # Mock .apply_async(); routing options (queue, priority) are ignored
+            def mock_apply_async(args=None, kwargs=None, **options):
+                return mock_delay(*(args or ()), **(kwargs or {}))
+            
             wrapper.delay = mock_delay
+            wrapper.apply_async = mock_apply_async
             return wrapper
+        
+        # Bare @shared_task (no arguments)
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return decorator(args[0])
         return decorator
 
 from django.conf import settings
 import os
 import time
 
+# Read size for streaming passes over stored uploads
+INGEST_CHUNK_SIZE = 256 * 1024
+
 @shared_task(bind=True, max_retries=3, default_retry_delay=60)
 def process_image_async(self, image_id, settings_data, mask_path_temp=None):
     """
     Async task to process an image with AI engine.
     In Vercel (no-celery), this runs Synchronously!
     
+    Publishes per-stage progress and stops at the next stage or tile once
+    the project is cancelled (see api/progress.py).
+    
     Args:
         image_id: ID of the ImageProject to process
         settings_data: Dict of processing settings
@@ -70,164 +86,343 @@ def process_image_async(self, image_id, settings_data, mask_path_temp=None):
     """
     from api.models import ImageProject
     from api.ai_engine import AIEngine
+    from api.pipeline import compile_pipeline
+    from api import result_cache, progress
+    from api.scratch import scratch_store, ScratchMissing
     from django.core.files.storage import default_storage
     
+    job = progress.JobProgress(image_id)
+    held_key = None  # Result reference taken but not yet handed to the project
     try:
         project = ImageProject.objects.get(id=image_id)
+        if progress.is_cancelled(image_id):
+            # Cancelled while queued: give the worker slot straight back
+            _cancel_project(project, mask_path_temp, job)
+            return {'status': 'cancelled', 'image_id': image_id}
+
         project.status = 'processing'
         project.save()
+        job.advance('load')
         
         if not project.original_image:
              raise ValueError("No original image found")
 
-        # Read original image (using Storage API inside AIEngine now)
-        # Pass the relative name (e.g. 'originals/photo.jpg')
-        current_img = AIEngine._read_image(project.original_image.name)
-        
         # Determine current path/ref for naming (basename)
         ref_path = project.original_image.name
         
-        # --- PIPELINE START ---
-        
-        # 1. Restoration (Scratches)
-        if settings_data.get('removeScratches', False):
-            current_img = AIEngine.remove_scratches(current_img, return_path=False)
-
-        # 2. Face Restoration
-        if settings_data.get('faceRestoration', False):
-            current_img = AIEngine.restore_faces(current_img, return_path=False)
-        
-        # 3. Colorization
-        if settings_data.get('colorize', False):
-            current_img = AIEngine.colorize_image(current_img, return_path=False)
-            
-        # 4. Adjustments
-        b = float(settings_data.get('brightness', 1.0))
-        c = float(settings_data.get('contrast', 1.0))
-        s = float(settings_data.get('saturation', 1.0))
-        if b != 1.0 or c != 1.0 or s != 1.0:
-            current_img = AIEngine.adjust_image(current_img, brightness=b, contrast=c, saturation=s, return_path=False)
-
-        # 5. Upscaling
-        upscale_x = int(settings_data.get('upscaleX', 1))
-        # Cap upscale to reasonable limit (security)
-        if upscale_x > 4: upscale_x = 4 
-        if upscale_x > 1:
-            current_img = AIEngine.upscale_image(current_img, scale=2, return_path=False)
-            if upscale_x >= 4:
-                 current_img = AIEngine.upscale_image(current_img, scale=2, return_path=False)
-
-        # 6. Auto-Enhance
-        if settings_data.get('autoEnhance', False):
-             current_img = AIEngine.auto_enhance(current_img, return_path=False)
-
-        # 7. White Balance
-        if settings_data.get('whiteBalance', False):
-             current_img = AIEngine.correct_white_balance(current_img, return_path=False)
-
-        # 8. Advanced Denoising
-        denoise_strength = int(settings_data.get('denoiseStrength', 0))
-        if denoise_strength > 0:
-             current_img = AIEngine.denoise_advanced(current_img, strength=denoise_strength, return_path=False)
-
-        # 9. Filter Preset
-        filter_preset = settings_data.get('filterPreset', '')
-        if filter_preset and filter_preset != 'none':
-             current_img = AIEngine.apply_filter_preset(current_img, filter_preset, return_path=False)
-
-        # 10. Background Removal
-        if settings_data.get('removeBackground', False):
-             try:
-                current_img = AIEngine.remove_background(current_img, return_path=False)
-             except Exception as e:
-                print(f"BG Removal Failed: {e}")
-        
-        # 11. Object Removal (Inpainting)
-        if mask_path_temp:
-            # Read mask from temp location
-            # If using cloud storage, 'mask_path_temp' should be a storage key
+        # Read inpainting mask (if any); its hash is part of the result key
+        # If using cloud storage, 'mask_path_temp' should be a storage key;
+        # same-host workers get a scratch handle to the decoded mask instead
+        mask_bytes = None
+        mask_img = None
+        mask_hash = None
+        if mask_path_temp and scratch_store.is_handle(mask_path_temp):
+            try:
+                mask_img = scratch_store.load(mask_path_temp)
+                mask_hash = result_cache.hash_array(mask_img)
+            except ScratchMissing as e:
+                print(f"Inpainting failed: {e}")
+        elif mask_path_temp:
             try:
                 if default_storage.exists(mask_path_temp):
                     with default_storage.open(mask_path_temp, 'rb') as f:
                         mask_bytes = f.read()
+                        mask_hash = result_cache.hash_bytes(mask_bytes)
+            except Exception as e:
+                print(f"Inpainting failed: {e}")
+
+        # Result cache: identical original content + settings + mask
+        result_key = result_cache.make_key(
+            result_cache.get_original_hash(project),
+            settings_data,
+            mask_hash,
+        )
+        final_rel_path = result_cache.acquire(result_key)
+        cached = final_rel_path is not None
+        if cached:
+            held_key = result_key
+
+        if not cached:
+            # Read original image (using Storage API inside AIEngine now)
+            # Pass the relative name (e.g. 'originals/photo.jpg')
+            current_img = AIEngine._read_image(project.original_image.name)
+
+            if mask_bytes:
+                try:
                     import numpy as np
                     import cv2
                     nparr = np.frombuffer(mask_bytes, np.uint8)
                     mask_img = cv2.imdecode(nparr, cv2.IMREAD_UNCHANGED)
-                    
-                    current_img = AIEngine.inpaint_object(current_img, mask_img, return_path=False)
-                    
-                    # Cleanup mask
-                    default_storage.delete(mask_path_temp)
-            except Exception as e:
-                print(f"Inpainting failed: {e}")
+                except Exception as e:
+                    print(f"Inpainting failed: {e}")
 
-        # 12. Upscaling
-        upscale_x = int(settings_data.get('upscaleX', 1))
-        if upscale_x > 1:
-             try:
-                 print(f"Upscaling {upscale_x}x")
-                 current_img = AIEngine.upscale_image(current_img, scale=upscale_x, return_path=False)
-             except Exception as e:
-                 print(f"Upscaling failed: {e}")
+            # --- PIPELINE START ---
+            # Stages run in the same order as before; neighbouring pointwise
+            # adjustments are fused into single passes (see api/pipeline.py).
+            pipeline = compile_pipeline(settings_data, mask_img=mask_img)
+            job.plan(['load', *pipeline.describe(), 'save'])
+            with job:
+                current_img = pipeline.run(current_img, progress=job)
+            # --- PIPELINE END ---
 
-        # --- PIPELINE END ---
+            # Final Save (to Storage)
+            job.advance('save')
+            final_rel_path = AIEngine._save_result(current_img, ref_path, 'edited', return_path=True)
+            if result_cache.register(result_key, final_rel_path):
+                held_key = result_key
+            else:
+                result_key = None  # Lost a race; keep this file unshared
 
-        # Final Save (to Storage)
-        final_rel_path = AIEngine._save_result(current_img, ref_path, 'edited', return_path=True)
+        # Cleanup mask
+        if mask_hash:
+            _discard_mask(mask_path_temp)
         
-        # Update project
+        # Update project, releasing the result it pointed at before
+        previous_key = project.result_key
         project.processed_image.name = final_rel_path
+        project.result_key = result_key
+        project.derivatives = {}
         project.settings = settings_data
         project.status = 'completed'
         project.save()
+        held_key = None  # The project holds it now
+        if previous_key:
+            result_cache.release(previous_key)
+        job.finish('completed')
+
+        _dispatch_derivatives(image_id)
         
+        if cached:
+            return {'status': 'success', 'image_id': image_id, 'cached': True}
         return {'status': 'success', 'image_id': image_id}
         
     except ImageProject.DoesNotExist:
         return {'status': 'error', 'message': 'Project not found'}
+    except progress.JobCancelled:
+        print(f"Processing cancelled for {image_id} after {job.percent}%")
+        if held_key:
+            result_cache.release(held_key)
+        _cancel_project(project, mask_path_temp, job)
+        return {'status': 'cancelled', 'image_id': image_id}
     except Exception as exc:
+        if held_key:
+            result_cache.release(held_key)
         # Only update project status if project was successfully fetched
         try:
             if 'project' in dir():
                 project.status = 'failed'
                 project.save()
+            job.finish('failed')
         except:
             pass
         # Re-raise to propagate the error
         raise exc
 
 
+def _cancel_project(project, mask_path_temp, job):
+    """Mark a cancelled processing run as such and drop its temporary mask."""
+    if mask_path_temp:
+        _discard_mask(mask_path_temp)
+    project.status = 'cancelled'
+    project.save(update_fields=['status'])
+    job.finish('cancelled')
+
+
+def _discard_mask(mask_path_temp):
+    """Delete a temporary inpainting mask (storage key or scratch handle)."""
+    from api.scratch import scratch_store
+    from django.core.files.storage import default_storage
+
+    if scratch_store.is_handle(mask_path_temp):
+        scratch_store.delete(mask_path_temp)
+        return
+    try:
+        default_storage.delete(mask_path_temp)
+    except Exception as e:
+        print(f"Mask cleanup failed: {e}")
+
+
+@shared_task
+def process_batch_chunk_async(batch_id, chunk_index, project_ids, settings_data):
+    """
+    Process one chunk of a batch (see api/batch.py). The chunk is counted
+    even if it fails, so the batch always gets its totals.
+    
+    Safe to deliver again (acks are late): a chunk already counted is
+    skipped, and a rerun picks up where a dead worker left off.
+    """
+    from api.batch import RUNNABLE_STATUSES, chunk_finished, finish_chunk, process_chunk
+    from api.models import ImageProject
+
+    if chunk_finished(batch_id, chunk_index):
+        return {'status': 'skipped', 'batch_id': batch_id, 'chunk': chunk_index}
+    try:
+        counts = process_chunk(batch_id, chunk_index, project_ids, settings_data)
+    except Exception as exc:
+        print(f"Batch {batch_id}: chunk {chunk_index} failed: {exc}")
+        ImageProject.objects.filter(id__in=project_ids, batch_id=batch_id, status__in=RUNNABLE_STATUSES).update(
+            status='failed'
+        )
+        counts = {'error': str(exc)}
+    finally:
+        finish_chunk(batch_id, chunk_index)
+    return {'status': 'success', 'batch_id': batch_id, 'chunk': chunk_index, **counts}
+
+
+@shared_task(bind=True, max_retries=2, default_retry_delay=30)
+def generate_derivatives_async(self, project_id):
+    """
+    Build the thumb/preview/full renditions of a project's processed image
+    (see api/derivatives.py). Runs after processing/generation completes.
+    """
+    from api.models import ImageProject
+    from api.derivatives import build_derivatives
+
+    try:
+        project = ImageProject.objects.get(id=project_id)
+    except ImageProject.DoesNotExist:
+        return {'status': 'error', 'message': 'Project not found'}
+
+    if not project.processed_image:
+        return {'status': 'skipped', 'project_id': project_id}
+
+    source_name = project.processed_image.name
+    try:
+        derivatives = build_derivatives(source_name)
+    except Exception as exc:
+        print(f"Derivatives failed for {project_id}: {exc}")
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)
+        return {'status': 'error', 'project_id': project_id}
+
+    # Only attach if the project was not re-processed meanwhile
+    ImageProject.objects.filter(id=project_id, processed_image=source_name).update(derivatives=derivatives)
+    return {'status': 'success', 'project_id': project_id, 'sizes': list(derivatives)}
+
+
+def _dispatch_derivatives(project_id):
+    """Queue derivative generation; a failure here never fails the main task."""
+    try:
+        generate_derivatives_async.delay(project_id)
+    except Exception as e:
+        print(f"Derivatives dispatch failed: {e}")
+
+
+@shared_task(bind=True, max_retries=2, default_retry_delay=30)
+def ingest_upload_async(self, project_id):
+    """
+    Validate a directly uploaded original (see api/uploads.py) in a single
+    streaming pass: magic bytes, header dimensions, malware patterns, size,
+    and the content hash used by the result cache.
+
+    Accepted uploads move to 'pending'; rejected ones are deleted from
+    storage and the project is marked 'failed'.
+    """
+    from api.models import ImageProject
+    from api.security import StreamingImageValidator
+    from django.core.files.storage import default_storage
+
+    try:
+        project = ImageProject.objects.get(id=project_id)
+    except ImageProject.DoesNotExist:
+        return {'status': 'error', 'message': 'Project not found'}
+
+    name = project.original_image.name
+    validator = StreamingImageValidator()
+    try:
+        with default_storage.open(name, 'rb') as f:
+            for chunk in f.chunks(INGEST_CHUNK_SIZE):
+                validator.feed(chunk)
+                if validator.size > validator.max_size:
+                    break  # No need to read the rest
+    except Exception as exc:
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc)
+        validator.errors.append(f"Could not read upload: {exc}")
+
+    is_valid, error = validator.finish()
+    if not is_valid:
+        print(f"Ingest rejected {project_id}: {error}")
+        try:
+            default_storage.delete(name)
+        except Exception as e:
+            print(f"Ingest cleanup failed: {e}")
+        project.original_image = None
+        project.status = 'failed'
+        project.save(update_fields=['original_image', 'status'])
+        return {'status': 'rejected', 'project_id': project_id, 'error': error}
+
+    project.original_hash = validator.content_hash
+    project.status = 'pending'
+    project.save(update_fields=['original_hash', 'status'])
+    return {
+        'status': 'success',
+        'project_id': project_id,
+        'mime': validator.mime,
+        'width': validator.width,
+        'height': validator.height,
+    }
+
+
+@shared_task
+def refresh_dashboard_stats_async():
+    """Recompute the cached admin dashboard snapshot (see api/dashboard.py)."""
+    from api.dashboard import refresh_dashboard_stats
+    
+    refresh_dashboard_stats()
+    return {'status': 'success'}
+
+
+@shared_task
+def cleanup_scratch_artifacts():
+    """
+    Delete expired scratch artifacts on this host (see api/scratch.py).
+    Schedule via Celery Beat, more often than their TTL; it is routed to
+    the scratch_sweep broadcast queue, so every worker host runs it.
+    """
+    from api.scratch import scratch_store
+    
+    removed = scratch_store.cleanup_expired()
+    return f'Removed {removed} expired scratch artifacts'
+
+
 @shared_task
 def cleanup_old_processed_images(days=7):
     """
     Periodic task to clean up old processed images (files & records).
     Run via Celery Beat scheduler.
+    
+    Works in chunks (see api/cleanup.py). With CLEANUP_MAX_SECONDS set, a
+    run stops after that long and queues a follow-up run for the rest.
     """
-    from api.models import ImageProject
+    from api import result_cache, renditions
+    from api.cleanup import cleanup_expired_projects
     from django.utils import timezone
     from datetime import timedelta
-    from django.core.files.storage import default_storage
     
     cutoff = timezone.now() - timedelta(days=days)
-    old_projects = ImageProject.objects.filter(
-        updated_at__lt=cutoff
-    )
+    max_seconds = getattr(settings, 'CLEANUP_MAX_SECONDS', 0) or None
+    
+    stats = cleanup_expired_projects(cutoff, max_seconds=max_seconds)
+    print(f"Cleanup: {stats.projects} projects and {stats.files} files in {stats.chunks} chunks, "
+          f"{stats.seconds:.1f}s ({stats.rate:.0f} projects/s)")
+    if stats.failed_files or stats.retried_files:
+        print(f"Cleanup: {stats.failed_files} file deletes failed (retried next run), "
+              f"{stats.retried_files} earlier failures deleted")
     
-    deleted_count = 0
-    for project in old_projects:
-        # Delete files from storage
-        if project.processed_image:
-             default_storage.delete(project.processed_image.name)
-        if project.original_image:
-             # Be careful deleting originals if they are shared? 
-             # Assuming projects own their original copy.
-             default_storage.delete(project.original_image.name)
-             
-        project.delete()
-        deleted_count += 1
+    if not stats.complete:
+        # Resume where this run stopped; expired rows left are picked up first
+        cleanup_old_processed_images.delay(days)
+        return f'Cleaned up {stats.projects} old projects; continuing in a new run'
+
+    # Evict cached results no project references any more
+    evicted_count = result_cache.evict_unreferenced(cutoff)
+
+    # Export renditions are re-encoded on demand, so stale ones can go
+    renditions_count = renditions.evict_stale(cutoff)
                 
-    return f'Cleaned up {deleted_count} old projects'
+    return (f'Cleaned up {stats.projects} old projects ({stats.rate:.0f}/s), evicted '
+            f'{evicted_count} cached results and {renditions_count} export renditions')
 
 
 @shared_task(bind=True, max_retries=2, time_limit=600, soft_time_limit=540)
@@ -235,8 +430,9 @@ def generate_image_async(self, project_id, prompt, style='photorealistic', seed=
     """
     Async task to generate an image using DeepFloyd IF.
     
-    This task runs on the 'generation' queue which should be handled by
-    GPU-equipped workers. In development/Vercel (no-celery), runs synchronously.
+    This task runs on the 'generation' queue (see backend/celery.py) which
+    should be handled by GPU-equipped workers. In development/Vercel
+    (no-celery), runs synchronously.
     
     Args:
         project_id: ID of the ImageProject
@@ -253,6 +449,17 @@ def generate_image_async(self, project_id, prompt, style='photorealistic', seed=
     
     try:
         project = ImageProject.objects.get(id=project_id)
+        limits = GenerationLimits(project.user)
+        
+        # The quota lease was taken by the view; restart its clock for this
+        # attempt. If it expired while queued, the slot must be reclaimed.
+        if not limits.renew(project_id):
+            reservation = limits.reserve(project_id)
+            if not reservation['allowed']:
+                project.status = 'failed'
+                project.save()
+                return {'status': 'error', 'message': reservation['reason'], 'project_id': project_id}
+        
         project.status = 'processing'
         project.save()
         
@@ -275,8 +482,8 @@ def generate_image_async(self, project_id, prompt, style='photorealistic', seed=
             project.status = 'failed'
             project.save()
             # Don't count failed generations against limit
-            limits = GenerationLimits(project.user)
             limits.record_generation(
+                project_id,
                 gpu_time_seconds=time.time() - start_time,
                 success=False
             )
@@ -290,13 +497,15 @@ def generate_image_async(self, project_id, prompt, style='photorealistic', seed=
         project.processed_image.name = result['image_path']
         project.gen_seed = result['seed']
         project.gen_steps = result['steps']
+        project.derivatives = {}
         project.status = 'completed'
         project.save()
+
+        _dispatch_derivatives(str(project_id))
         
         # Record successful generation
         gpu_time = time.time() - start_time
-        limits = GenerationLimits(project.user)
-        limits.record_generation(gpu_time_seconds=gpu_time, success=True)
+        limits.record_generation(project_id, gpu_time_seconds=gpu_time, success=True)
         
         print(f"DeepFloyd Task: Completed in {gpu_time:.1f}s")
         
@@ -314,6 +523,11 @@ def generate_image_async(self, project_id, prompt, style='photorealistic', seed=
     except Exception as exc:
         print(f"DeepFloyd Task: Error - {exc}")
         
+        # Retry on transient errors; the quota lease stays with the project
+        # and is renewed when the retry starts
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=exc, countdown=30)
+        
         # Update project status
         try:
             project = ImageProject.objects.get(id=project_id)
@@ -323,15 +537,12 @@ def generate_image_async(self, project_id, prompt, style='photorealistic', seed=
             # Record failed generation (don't count against limit)
             limits = GenerationLimits(project.user)
             limits.record_generation(
+                project_id,
                 gpu_time_seconds=time.time() - start_time,
                 success=False
             )
         except:
             pass
         
-        # Retry on transient errors
-        if self.request.retries < self.max_retries:
-            raise self.retry(exc=exc, countdown=30)
-        
         raise exc
 
@@ -1,3 +1,1444 @@
+import os
+import unittest
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from .models import ACTIVE_STATUSES, ImageProject
+
+
+def make_projects(user, count, status='completed'):
+    ImageProject.objects.bulk_create(
+        ImageProject(user=user, status=status) for _ in range(count)
+    )
+
+
+class QueryCountTests(TestCase):
+    """List endpoints must cost the same number of queries at any size."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.com', 'p')
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def count_queries(self, url, user):
+        self.client.force_authenticate(user)
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(ctx.captured_queries)
+
+    def assert_constant_queries(self, url, user, grow):
+        before = self.count_queries(url, user)
+        grow()
+        self.assertEqual(self.count_queries(url, user), before)
+
+    def test_image_list(self):
+        url = reverse('imageproject-list')
+        make_projects(self.user, 2)
+        self.assert_constant_queries(url, self.user, lambda: make_projects(self.user, 15))
+
+    def test_admin_jobs(self):
+        url = reverse('admin_jobs') + '?limit=10'
+        make_projects(self.user, 2)
+
+        def grow():
+            for i in range(12):
+                make_projects(User.objects.create_user(f'job_owner{i}'), 1)
+        self.assert_constant_queries(url, self.admin, grow)
+
+    def test_admin_users(self):
+        url = reverse('admin_users') + '?limit=10'
+
+        def grow():
+            for i in range(12):
+                make_projects(User.objects.create_user(f'user{i}'), 2)
+        self.assert_constant_queries(url, self.admin, grow)
+
+    def test_admin_pages_cover_table(self):
+        make_projects(self.user, 23)
+        self.client.force_authenticate(self.admin)
+        seen = []
+        url = reverse('admin_jobs') + '?limit=10'
+        while url:
+            response = self.client.get(url)
+            seen += [job['id'] for job in response.data]
+            url = response.get('X-Next-Cursor') and (
+                reverse('admin_jobs') + f"?limit=10&cursor={response['X-Next-Cursor']}")
+        self.assertEqual(len(seen), 23)
+        self.assertEqual(len(set(seen)), 23)
+
+    def test_admin_dashboard(self):
+        from django.core.cache import cache
+        cache.clear()
+        make_projects(self.user, 5)
+        self.assertEqual(self.count_queries(reverse('admin_dashboard'), self.admin), 3)
+
+
+class IndexUsageTests(TestCase):
+    """EXPLAIN the hot ImageProject queries and check they use their index."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+        make_projects(cls.user, 30)
+        make_projects(cls.user, 5, status='pending')
+
+    def setUp(self):
+        if connection.vendor == 'postgresql':
+            # Tiny test tables would otherwise always be scanned
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assert_uses_index(self, queryset, *index_names):
+        plan = queryset.explain()
+        self.assertTrue(any(name in plan for name in index_names), plan)
+
+    def test_user_project_list(self):
+        queryset = ImageProject.objects.filter(user=self.user).order_by('-created_at', '-id')
+        self.assert_uses_index(queryset, 'project_user_created_idx')
+
+    def test_job_monitor_by_status(self):
+        queryset = ImageProject.objects.filter(status='failed').order_by('-created_at', '-id')
+        self.assert_uses_index(queryset, 'project_status_created_idx')
+
+    def test_active_jobs(self):
+        queryset = ImageProject.objects.filter(status__in=ACTIVE_STATUSES).order_by('-created_at')
+        # Planners without table statistics may prefer the status index
+        self.assert_uses_index(queryset, 'project_active_idx', 'project_status_created_idx')
+
+    def test_cleanup_cutoff(self):
+        queryset = ImageProject.objects.filter(updated_at__lt=timezone.now() - timedelta(days=7))
+        self.assert_uses_index(queryset, 'project_updated_idx')
+
+
+class KeysetPaginatorTests(TestCase):
+
+    def paginate(self, queryset, **params):
+        from rest_framework.request import Request
+        from rest_framework.test import APIRequestFactory
+        from .pagination import KeysetPaginator
+        paginator = KeysetPaginator('created_at' if queryset.model is ImageProject else 'date_joined')
+        request = Request(APIRequestFactory().get('/', params))
+        return paginator, paginator.paginate_queryset(queryset, request)
+
+    def test_pages_follow_the_cursor(self):
+        user = User.objects.create_user('owner')
+        make_projects(user, 5)
+        paginator, first = self.paginate(ImageProject.objects.all(), limit=3)
+        _, second = self.paginate(ImageProject.objects.all(), limit=3, cursor=paginator.next_cursor)
+        self.assertEqual(len(first) + len(second), 5)
+        self.assertFalse({p.pk for p in first} & {p.pk for p in second})
+
+    def test_malformed_cursors_are_rejected(self):
+        from rest_framework.exceptions import ValidationError
+        from .pagination import KeysetPaginator
+        now = timezone.now()
+        for queryset in (User.objects.all(), ImageProject.objects.all()):
+            for cursor in ('not-a-cursor', KeysetPaginator.encode_cursor(now, 'not-a-pk')):
+                with self.subTest(model=queryset.model.__name__, cursor=cursor):
+                    with self.assertRaises(ValidationError):
+                        self.paginate(queryset, cursor=cursor)
+
+
+class UpdatedAtTests(TestCase):
+
+    def test_partial_save_bumps_updated_at(self):
+        project = ImageProject.objects.create(status='pending')
+        ImageProject.objects.filter(pk=project.pk).update(updated_at=timezone.now() - timedelta(days=30))
+        project.refresh_from_db()
+        stale = project.updated_at
+
+        project.status = 'completed'
+        project.save(update_fields=['status'])
+        project.refresh_from_db()
+        self.assertGreater(project.updated_at, stale)
+
+
+class CleanupTests(TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def make_expired(self):
+        from django.core.files.base import ContentFile
+        project = ImageProject.objects.create(status='completed')
+        project.original_image.save('old.png', ContentFile(b'png'))
+        ImageProject.objects.filter(pk=project.pk).update(updated_at=timezone.now() - timedelta(days=30))
+        return project
+
+    def test_failed_file_deletes_are_retried(self):
+        from django.core.files.storage import default_storage
+        from .cleanup import cleanup_expired_projects
+        from .models import PendingFileDelete
+
+        name = self.make_expired().original_image.name
+        cutoff = timezone.now() - timedelta(days=7)
+        with mock.patch.object(default_storage, 'delete', side_effect=OSError('storage down')):
+            with self.captureOnCommitCallbacks(execute=True):
+                stats = cleanup_expired_projects(cutoff)
+        self.assertEqual(stats.projects, 1)
+        self.assertFalse(ImageProject.objects.exists())
+        self.assertTrue(default_storage.exists(name))
+        self.assertEqual(list(PendingFileDelete.objects.values_list('name', flat=True)), [name])
+
+        stats = cleanup_expired_projects(cutoff)
+        self.assertEqual(stats.retried_files, 1)
+        self.assertFalse(default_storage.exists(name))
+        self.assertFalse(PendingFileDelete.objects.exists())
+
+    def test_files_wait_for_commit(self):
+        from django.core.files.storage import default_storage
+        from .cleanup import cleanup_expired_projects
+
+        name = self.make_expired().original_image.name
+        with self.captureOnCommitCallbacks() as callbacks:
+            cleanup_expired_projects(timezone.now() - timedelta(days=7))
+            self.assertTrue(default_storage.exists(name))
+        self.assertEqual(len(callbacks), 1)
+
+
+class DirectUploadTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=media, STORAGE_PROVIDER='local')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def request_upload(self):
+        response = self.client.post(reverse('imageproject-upload-url'), {
+            'filename': 'photo.png', 'content_type': 'image/png', 'size': 100,
+        }, format='json')
+        self.assertEqual(response.status_code, 201)
+        return response.data
+
+    def test_upload_token_is_single_use(self):
+        upload = self.request_upload()
+        response = self.client.generic('PUT', upload['upload']['url'], b'\x89PNG\r\n\x1a\n' + b'0' * 40,
+                                       content_type='image/png')
+        self.assertEqual(response.status_code, 201)
+
+        with mock.patch('api.tasks.ingest_upload_async.delay', return_value=mock.Mock(id='task')):
+            first = self.client.post(reverse('imageproject-ingest'), {'upload_token': upload['upload_token']}, format='json')
+            second = self.client.post(reverse('imageproject-ingest'), {'upload_token': upload['upload_token']}, format='json')
+        self.assertEqual(first.status_code, 202)
+        self.assertEqual(second.status_code, 409)
+        self.assertEqual(ImageProject.objects.filter(original_image=upload['key']).count(), 1)
+
+    def test_unvalidated_uploads_are_not_decoded(self):
+        from django.core.files.base import ContentFile
+        project = ImageProject.objects.create(user=self.user, status='ingesting')
+        project.original_image.save('raw.png', ContentFile(b'not validated yet'))
+        project.processed_image.save('raw_out.png', ContentFile(b'not validated yet'))
+
+        requests = [
+            ('post', 'imageproject-process-image', {'settings': {}}),
+            ('post', 'imageproject-preview', {'settings': {}}),
+            ('get', 'imageproject-download', None),
+        ]
+        for method, name, data in requests:
+            with self.subTest(action=name):
+                response = getattr(self.client, method)(reverse(name, args=[project.id]), data, format='json')
+                self.assertEqual(response.status_code, 409)
+
+    def test_malformed_content_length(self):
+        upload = self.request_upload()
+        response = self.client.generic('PUT', upload['upload']['url'], b'data',
+                                       content_type='image/png', CONTENT_LENGTH='abc')
+        self.assertEqual(response.status_code, 400)
+
+
+class ProgressTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.project = ImageProject.objects.create(user=self.user, status='pending')
+
+    def test_progress_reads_cache_only(self):
+        from . import progress
+        progress.queued(self.project.id)
+        url = reverse('imageproject-progress', args=[self.project.id])
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.client.get(url)
+        self.assertEqual(response.data['state'], 'queued')
+        self.assertEqual(len(ctx.captured_queries), 1)  # ownership check
+
+    def test_progress_answers_at_once_with_polling_hints(self):
+        from . import progress
+        progress.queued(self.project.id)
+        url = reverse('imageproject-progress', args=[self.project.id])
+        response = self.client.get(url)
+        self.assertEqual(response['Retry-After'], '2')
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        progress.mark_finished(self.project.id, 'completed')
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['state'], 'completed')
+        self.assertFalse(response.has_header('Retry-After'))
+
+    def test_cancel_queued_job(self):
+        from . import progress
+        from .tasks import process_image_async
+        progress.queued(self.project.id)
+
+        response = self.client.post(reverse('imageproject-cancel', args=[self.project.id]))
+        self.assertEqual(response.data['status'], 'cancelled')
+
+        result = process_image_async(str(self.project.id), {})
+        self.assertEqual(result['status'], 'cancelled')
+        self.project.refresh_from_db()
+        self.assertEqual(self.project.status, 'cancelled')
+        self.assertEqual(progress.get_progress(self.project.id)['state'], 'cancelled')
+
+
+class PreviewTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        import cv2
+        import numpy as np
+        from django.core.cache import cache
+        from django.core.files.base import ContentFile
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=media, STORAGE_PROVIDER='local')
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        img = np.tile(np.linspace(0, 255, 1500, dtype=np.uint8)[None, :, None], (900, 1, 3))
+        self.project = ImageProject.objects.create(user=self.user, status='completed')
+        self.project.original_image.save('photo.png', ContentFile(cv2.imencode('.png', img)[1].tobytes()))
+        self.url = reverse('imageproject-preview', args=[self.project.id])
+
+    def test_model_stages_are_left_out(self):
+        from .ai_engine import AIEngine
+        settings_data = {'colorize': True, 'removeBackground': True, 'denoiseStrength': 10, 'brightness': 1.2}
+        with mock.patch.object(AIEngine, 'colorize_image') as colorize, \
+                mock.patch.object(AIEngine, 'remove_background') as remove_background:
+            response = self.client.post(self.url, {'settings': settings_data}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Preview-Skipped'], 'colorize,denoise,remove_background')
+        self.assertEqual(response['X-Preview-Size'], '1024x614')
+        colorize.assert_not_called()
+        remove_background.assert_not_called()
+
+    def test_budget_cut_off_skips_whole_frame_stages(self):
+        from .ai_engine import AIEngine
+        with mock.patch('api.preview.PREVIEW_TIME_BUDGET', -1), \
+                mock.patch.object(AIEngine, 'auto_enhance') as auto_enhance:
+            response = self.client.post(self.url, {
+                'settings': {'autoEnhance': True, 'brightness': 1.2, 'filterPreset': 'warm'},
+            }, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Preview-Skipped'], 'auto_enhance')
+        auto_enhance.assert_not_called()
+
+    def test_proxy_is_cached_encoded(self):
+        from django.core.cache import cache
+        from .ai_engine import AIEngine
+        from .preview import PROXY_KEY, get_preview_proxy
+        first = get_preview_proxy(self.project)
+        cached = cache.get(PROXY_KEY.format(project_id=self.project.id, name=self.project.original_image.name))
+        self.assertIsInstance(cached, bytes)
+
+        with mock.patch.object(AIEngine, '_read_image') as read_image:
+            second = get_preview_proxy(self.project)
+        read_image.assert_not_called()
+        self.assertEqual(second.shape, first.shape)
+        self.assertLessEqual(abs(second.astype(int) - first).max(), 4)
+
+    def test_rejected_requests(self):
+        response = self.client.post(self.url, {'settings': ['brightness']}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+        ImageProject.objects.filter(pk=self.project.pk).update(status='ingesting')
+        response = self.client.post(self.url, {'settings': {}}, format='json')
+        self.assertEqual(response.status_code, 409)
+
+
+class RenditionTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        import cv2
+        import numpy as np
+        from django.core.cache import cache
+        from django.core.files.base import ContentFile
+        cache.clear()
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=self.media, STORAGE_PROVIDER='local')
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+        rng = np.random.default_rng(5)
+        img = rng.integers(0, 256, (64, 80, 3), dtype=np.uint8)
+        self.project = ImageProject.objects.create(user=self.user, status='completed')
+        self.project.processed_image.save('export.png', ContentFile(cv2.imencode('.png', img)[1].tobytes()))
+        self.url = reverse('imageproject-download', args=[self.project.id]) + '?format=jpg&quality=85'
+
+    def test_rendition_is_reused(self):
+        from django.core.files.storage import FileSystemStorage
+        from .renditions import _encode
+        first = self.client.get(self.url)
+        self.assertEqual(first.status_code, 200)
+        body = b''.join(first.streaming_content)
+
+        with mock.patch('api.renditions._encode', side_effect=_encode) as encode, \
+                mock.patch.object(FileSystemStorage, 'exists', autospec=True,
+                                  side_effect=FileSystemStorage.exists) as exists, \
+                mock.patch.object(FileSystemStorage, 'size', autospec=True,
+                                  side_effect=FileSystemStorage.size) as size:
+            second = self.client.get(self.url)
+        encode.assert_not_called()
+        exists.assert_not_called()
+        self.assertLessEqual(size.call_count, 1)  # Source fingerprint, unless remembered
+        self.assertEqual(second['ETag'], first['ETag'])
+        self.assertEqual(b''.join(second.streaming_content), body)
+
+    def test_conditional_and_range_requests(self):
+        response = self.client.get(self.url)
+        etag, size = response['ETag'], int(response['Content-Length'])
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 10-19/{size}')
+        self.assertEqual(len(b''.join(response.streaming_content)), 10)
+
+        response = self.client.get(self.url, HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get(self.url, HTTP_RANGE=f'bytes={size}-')
+        self.assertEqual(response.status_code, 416)
+        self.assertEqual(response['Content-Range'], f'bytes */{size}')
+
+    def test_eviction_follows_last_access(self):
+        from django.core.cache import cache
+        from django.core.files.storage import default_storage
+        from .renditions import _rendition_key, evict_stale, get_rendition
+        rendition = get_rendition(self.project.processed_image.name, 'jpg', 85)
+        week_ago = timezone.now() - timedelta(days=7)
+        # Encoded long ago, but downloaded since
+        old = (week_ago - timedelta(days=1)).timestamp()
+        os.utime(os.path.join(self.media, rendition.name), (old, old))
+        self.assertEqual(evict_stale(week_ago), 0)
+
+        key = _rendition_key(rendition.name)
+        cache.set(key, {**cache.get(key), 'accessed_at': old})
+        self.assertEqual(evict_stale(week_ago), 1)
+        self.assertFalse(default_storage.exists(rendition.name))
+        self.assertIsNone(cache.get(key))
+
+
+class BatchTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        from django.core.cache import cache
+        cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def make_project(self, shade, **fields):
+        import cv2
+        import numpy as np
+        from django.core.files.base import ContentFile
+        project = ImageProject.objects.create(user=self.user, **fields)
+        _, data = cv2.imencode('.png', np.full((32, 48, 3), shade, dtype=np.uint8))
+        project.original_image.save(f'batch{shade}.png', ContentFile(data.tobytes()))
+        return project
+
+    def test_batch_processes_projects(self):
+        from .models import ProcessingBatch
+        projects = [self.make_project(shade) for shade in (10, 20, 30)]
+        busy = self.make_project(40, status='processing')
+
+        response = self.client.post(reverse('imageproject-batch'), {
+            'project_ids': [str(p.id) for p in projects + [busy]],
+            'settings': {'brightness': 1.2},
+        }, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['skipped'], [str(busy.id)])
+
+        batch = ProcessingBatch.objects.get(pk=response.data['id'])
+        self.assertEqual((batch.status, batch.total, batch.completed), ('completed', 3, 3))
+        for project in projects:
+            project.refresh_from_db()
+            self.assertEqual(project.status, 'completed')
+            self.assertEqual(project.batch_id, batch.id)
+            self.assertTrue(project.processed_image)
+
+    def test_redelivered_chunks_are_idempotent(self):
+        from .models import ProcessingBatch
+        from .tasks import process_batch_chunk_async
+        settings_data = {'brightness': 1.2}
+        batch = ProcessingBatch.objects.create(user=self.user, settings=settings_data, total=2, chunks=2)
+        # A worker died mid-chunk and left its project 'processing'
+        stuck = self.make_project(10, status='processing', batch=batch)
+        other = self.make_project(20, status='pending', batch=batch)
+
+        process_batch_chunk_async(str(batch.id), 0, [str(stuck.id)], settings_data)
+        stuck.refresh_from_db()
+        self.assertEqual(stuck.status, 'completed')
+
+        result = process_batch_chunk_async(str(batch.id), 0, [str(stuck.id)], settings_data)
+        self.assertEqual(result['status'], 'skipped')
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.chunks_done), ('processing', 1))
+
+        process_batch_chunk_async(str(batch.id), 1, [str(other.id)], settings_data)
+        batch.refresh_from_db()
+        self.assertEqual((batch.status, batch.chunks_done, batch.completed, batch.failed), ('completed', 2, 2, 0))
+
+    def test_results_do_not_overwrite_projects_that_left_the_batch(self):
+        from .ai_engine import AIEngine
+        from .batch import process_chunk
+        from .models import ProcessedResult, ProcessingBatch
+        settings_data = {'brightness': 1.2}
+        batch = ProcessingBatch.objects.create(user=self.user, settings=settings_data, total=1, chunks=1)
+        project = self.make_project(10, status='pending', batch=batch)
+        save_result = AIEngine._save_result
+
+        def requeued_meanwhile(*args, **kwargs):
+            # process_image took the project over while the chunk ran
+            ImageProject.objects.filter(pk=project.pk).update(
+                batch=None, status='completed', processed_image='processed/own.png',
+            )
+            return save_result(*args, **kwargs)
+
+        with mock.patch.object(AIEngine, '_save_result', side_effect=requeued_meanwhile):
+            counts = process_chunk(str(batch.id), 0, [str(project.id)], settings_data)
+        self.assertEqual((counts['completed'], counts['cancelled']), (0, 1))
+        project.refresh_from_db()
+        self.assertEqual(project.processed_image.name, 'processed/own.png')
+        self.assertEqual(list(ProcessedResult.objects.values_list('ref_count', flat=True)), [0])
+
+    def test_batch_rejects_unknown_projects(self):
+        other = User.objects.create_user('other')
+        project = ImageProject.objects.create(user=other)
+        response = self.client.post(reverse('imageproject-batch'), {
+            'project_ids': [str(project.id)], 'settings': {},
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class ResultCacheTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        import cv2
+        import numpy as np
+        from django.core.cache import cache
+        from django.core.files.base import ContentFile
+        cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=media)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.project = ImageProject.objects.create(user=self.user)
+        _, data = cv2.imencode('.png', np.full((32, 48, 3), 90, dtype=np.uint8))
+        self.project.original_image.save('cached.png', ContentFile(data.tobytes()))
+
+    def ref_count(self, key):
+        from .models import ProcessedResult
+        return ProcessedResult.objects.get(key=key).ref_count
+
+    def process(self):
+        """Process the project once; the project then holds the result."""
+        from .tasks import process_image_async
+        process_image_async(str(self.project.id), {'brightness': 1.2})
+        self.project.refresh_from_db()
+        self.assertEqual(self.ref_count(self.project.result_key), 1)
+        return self.project.result_key
+
+    def test_acquire_register_release(self):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        from . import result_cache
+        name = default_storage.save('processed/result.png', ContentFile(b'png'))
+
+        self.assertIsNone(result_cache.acquire('k'))
+        self.assertTrue(result_cache.register('k', name))
+        self.assertFalse(result_cache.register('k', name))
+        self.assertEqual(result_cache.acquire('k'), name)
+        self.assertEqual(self.ref_count('k'), 2)
+        result_cache.release('k')
+        self.assertEqual(self.ref_count('k'), 1)
+        result_cache.release_many(['k', 'k', None])
+        self.assertEqual(self.ref_count('k'), 0)
+
+        default_storage.delete(name)
+        self.assertIsNone(result_cache.acquire('k'))  # Lost artifact: a miss
+
+    def test_failed_task_gives_back_its_reference(self):
+        from .tasks import process_image_async
+        key = self.process()
+        save = ImageProject.save
+
+        def failing_save(project, *args, **kwargs):
+            if project.status == 'completed':
+                raise RuntimeError('database went away')
+            return save(project, *args, **kwargs)
+
+        with mock.patch.object(ImageProject, 'save', autospec=True, side_effect=failing_save):
+            with self.assertRaises(RuntimeError):
+                process_image_async(str(self.project.id), {'brightness': 1.2})
+        self.assertEqual(self.ref_count(key), 1)
+
+    def test_cancelled_batch_project_gives_back_its_reference(self):
+        from . import progress
+        from .batch import process_chunk
+        from .models import ProcessingBatch
+        key = self.process()
+        settings_data = {'brightness': 1.2}
+        batch = ProcessingBatch.objects.create(user=self.user, settings=settings_data, total=1, chunks=1)
+        ImageProject.objects.filter(pk=self.project.pk).update(status='pending', batch=batch)
+
+        progress.request_cancel(self.project.id)
+        counts = process_chunk(str(batch.id), 0, [str(self.project.id)], settings_data)
+        self.assertEqual(counts['cancelled'], 1)
+        self.assertEqual(self.ref_count(key), 1)
+
+
+class ThrottleTests(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user('owner', password='p')
+
+    def setUp(self):
+        from django.core.cache import cache
+        from .tiers import invalidate_tier
+        cache.clear()
+        invalidate_tier()
+        self.now = 600.0
+
+    def make_request(self, user=None):
+        from django.contrib.auth.models import AnonymousUser
+        from django.test import RequestFactory
+        from rest_framework.request import Request
+        request = Request(RequestFactory().get('/', REMOTE_ADDR='10.0.0.1'))
+        request.user = user or AnonymousUser()
+        return request
+
+    def make_throttle(self, cls):
+        throttle = cls()
+        throttle.timer = lambda: self.now
+        return throttle
+
+    def allowed(self, throttle_cls, count, user=None):
+        return sum(self.make_throttle(throttle_cls).allow_request(self.make_request(user), None) for _ in range(count))
+
+    def test_sliding_window(self):
+        from .throttling import StrictAnonThrottle  # 10/minute
+        self.assertEqual(self.allowed(StrictAnonThrottle, 12), 10)
+
+        throttle = self.make_throttle(StrictAnonThrottle)
+        self.assertFalse(throttle.allow_request(self.make_request(), None))
+        self.assertEqual(throttle.wait(), 60)
+
+        # Halfway through the next window half of the previous one still counts
+        self.now += 90
+        self.assertEqual(self.allowed(StrictAnonThrottle, 10), 5)
+
+        self.now += 120
+        self.assertEqual(self.allowed(StrictAnonThrottle, 12), 10)
+
+    def test_rejected_requests_are_not_counted(self):
+        from django.core.cache import cache
+        from .throttling import StrictAnonThrottle
+        throttle = self.make_throttle(StrictAnonThrottle)
+        self.allowed(StrictAnonThrottle, 15)
+        throttle.key = throttle.get_cache_key(self.make_request(), None)
+        self.assertEqual(cache.get(throttle.window_key(int(self.now // 60))), 10)
+
+    def test_rate_follows_tier(self):
+        from django.core.cache import cache
+        from .throttling import ProcessingRateThrottle
+        for tier, expected in (('free', 5), ('pro', 30), ('enterprise', 100), ('unknown', 5)):
+            with self.subTest(tier=tier), mock.patch('api.throttling.resolve_tier', return_value=tier):
+                cache.clear()
+                self.assertEqual(self.allowed(ProcessingRateThrottle, 120, self.user), expected)
+
+    def test_tier_is_cached_until_the_plan_changes(self):
+        from .tiers import plan_changed, resolve_tier
+        with mock.patch('api.tiers._lookup_tier', return_value='pro') as lookup:
+            self.assertEqual(resolve_tier(User.objects.get(pk=self.user.pk)), 'pro')
+            self.assertEqual(resolve_tier(User.objects.get(pk=self.user.pk)), 'pro')
+            self.assertEqual(lookup.call_count, 1)
+
+            plan_changed.send(sender=User, user_id=self.user.pk)
+            resolve_tier(User.objects.get(pk=self.user.pk))
+            self.assertEqual(lookup.call_count, 2)
+
+            User.objects.get(pk=self.user.pk).save()
+            resolve_tier(User.objects.get(pk=self.user.pk))
+            self.assertEqual(lookup.call_count, 3)
+
+
+class TilingTests(TestCase):
+
+    def test_strips_match_full_frame_and_stay_bounded(self):
+        import time
+        import cv2
+        import numpy as np
+        from .tiling import run_tiled
+        rng = np.random.default_rng(3)
+        img = rng.integers(0, 256, (2100, 1100, 3), dtype=np.uint8)
+        expected = cv2.bilateralFilter(img, 9, 75, 75)
+
+        calls = []
+
+        def fn(tile):
+            calls.append(tile.shape[0])
+            return cv2.bilateralFilter(tile, 9, 75, 75)
+
+        in_flight = []
+
+        def slow_checkpoint(done, total):
+            # A slow consumer: the pool must not run ahead of it
+            in_flight.append(len(calls) - done)
+            time.sleep(0.01)
+
+        with mock.patch('api.tiling.checkpoint', side_effect=slow_checkpoint):
+            result = run_tiled(img, fn, halo=4, tile_rows=128, workers=3)
+        self.assertTrue(np.array_equal(result, expected))
+        self.assertEqual(len(in_flight), len(calls))
+        self.assertLessEqual(max(in_flight), 3)
+
+
+class DecodedImageCacheTests(TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        from .image_cache import fingerprint_memo
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media, ignore_errors=True)
+        override = self.settings(MEDIA_ROOT=self.media, STORAGE_PROVIDER='local')
+        override.enable()
+        self.addCleanup(override.disable)
+        fingerprint_memo.forget()
+
+    def store(self, name, data=b'x'):
+        from django.core.files.base import ContentFile
+        from django.core.files.storage import default_storage
+        return default_storage.save(name, ContentFile(data))
+
+    @staticmethod
+    def loader(value, nbytes=100):
+        import numpy as np
+        return lambda: np.full(nbytes, value, dtype=np.uint8)
+
+    def test_lru_eviction_by_bytes(self):
+        from .image_cache import DecodedImageCache
+        cache = DecodedImageCache(max_bytes=250)
+        names = [self.store(f'{n}.png') for n in 'abc']
+        cache.get_or_load(names[0], self.loader(1))
+        cache.get_or_load(names[1], self.loader(2))
+        cache.get_or_load(names[0], self.loader(1))  # a is now most recent
+        cache.get_or_load(names[2], self.loader(3))  # evicts b
+
+        self.assertEqual(cache.get_or_load(names[0], self.loader(9))[0], 1)
+        self.assertEqual(cache.get_or_load(names[1], self.loader(9))[0], 9)
+        cache.get_or_load('missing.png', self.loader(4))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['evictions'], stats['bypassed']), (2, 4, 2, 1))
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], 200)
+        self.assertEqual(stats['hit_rate'], round(2 / 6, 3))
+
+    def test_replaced_file_is_not_served_stale(self):
+        from .image_cache import DecodedImageCache, fingerprint_memo
+        cache = DecodedImageCache()
+        name = self.store('photo.png')
+        self.assertEqual(cache.get_or_load(name, self.loader(1))[0], 1)
+
+        path = os.path.join(self.media, name)
+        stat = os.stat(path)
+        os.utime(path, (stat.st_atime, stat.st_mtime + 5))
+        # Within the fingerprint TTL the old entry is still used...
+        self.assertEqual(cache.get_or_load(name, self.loader(2))[0], 1)
+        # ...and once it lapses the new mtime is a different key
+        fingerprint_memo.forget(name)
+        self.assertEqual(cache.get_or_load(name, self.loader(2))[0], 2)
+
+    def test_fingerprints_are_remembered(self):
+        from django.core.files.storage import FileSystemStorage
+        from .image_cache import DecodedImageCache
+        cache = DecodedImageCache()
+        name = self.store('photo.png')
+        fingerprint = DecodedImageCache.fingerprint(name)
+
+        with mock.patch.object(FileSystemStorage, 'size', autospec=True) as size:
+            self.assertEqual(DecodedImageCache.fingerprint(name), fingerprint)
+            cache.get_or_load('other.png', self.loader(1), fingerprint=('other.png', 1, 0.0))
+        size.assert_not_called()
+
+        with self.settings(IMAGE_CACHE_FINGERPRINT_SECONDS=0):
+            self.store('fresh.png')
+            with mock.patch.object(FileSystemStorage, 'size', autospec=True, return_value=1) as size:
+                DecodedImageCache.fingerprint('fresh.png')
+                DecodedImageCache.fingerprint('fresh.png')
+            self.assertEqual(size.call_count, 2)
+
+
+class ScratchStoreTests(TestCase):
+
+    def setUp(self):
+        import shutil
+        import tempfile
+        from .scratch import ScratchStore
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.store = ScratchStore(directory=directory)
+
+    def test_round_trip_is_memory_mapped(self):
+        import numpy as np
+        img = np.arange(60, dtype=np.uint8).reshape(4, 5, 3)
+        handle = self.store.put(img)
+        loaded = self.store.load(handle)
+        self.assertTrue((loaded == img).all())
+        self.assertFalse(loaded.flags.writeable)
+
+    def test_expired_and_foreign_handles(self):
+        import numpy as np
+        from .scratch import ScratchMissing
+        live = self.store.put(np.zeros((2, 2), dtype=np.uint8))  # Runs the first sweep
+        expired = self.store.put(np.zeros((2, 2), dtype=np.uint8), ttl=-1)
+        with self.assertRaises(ScratchMissing):
+            self.store.load(expired)
+        with self.assertRaises(ScratchMissing):
+            self.store.load('scratch://elsewhere/1-' + '0' * 32 + '.npy')
+
+        self.assertEqual(self.store.cleanup_expired(), 1)
+        self.assertEqual(len(os.listdir(self.store.directory)), 1)
+        self.store.load(live)
+
+
+class DeepFloydMockTests(TestCase):
+
+    def test_mock_gradient_matches_style_colours(self):
+        from .deepfloyd_service import render_mock_gradient
+        img = render_mock_gradient('photorealistic', width=8, height=4)
+        self.assertEqual(img.shape, (4, 8, 3))
+        self.assertEqual(tuple(img[0, 0]), (50, 100, 180))
+        self.assertEqual(tuple(img[3, 7]), (125, 175, 236))  # int(top + 3/4 * delta)
+
+    def test_mock_latency_model(self):
+        from django.test import override_settings
+        from .deepfloyd_service import mock_latency
+        with override_settings(DEEPFLOYD_MOCK_LATENCY=1.0, DEEPFLOYD_MOCK_STEP_LATENCY=0.1,
+                               DEEPFLOYD_MOCK_LATENCY_JITTER=0.0):
+            self.assertAlmostEqual(mock_latency(seed=1, steps=50), 6.0)
+        with override_settings(DEEPFLOYD_MOCK_LATENCY=1.0, DEEPFLOYD_MOCK_STEP_LATENCY=0.0,
+                               DEEPFLOYD_MOCK_LATENCY_JITTER=0.5):
+            seconds = mock_latency(seed=7, steps=50)
+            self.assertTrue(0.5 <= seconds <= 1.5)
+            self.assertEqual(mock_latency(seed=7, steps=50), seconds)
+
+
+try:
+    import fakeredis
+    import lupa  # noqa: F401 (fakeredis needs it to run Lua scripts)
+except ImportError:
+    fakeredis = None
+
+
+@unittest.skipUnless(fakeredis, 'fakeredis[lua] is not installed')
+class RedisQuotaStoreTests(TestCase):
+    """Runs the production Lua scripts against an in-process fake Redis."""
+
+    START = 1_700_000_000_000
+
+    def setUp(self):
+        from .quota import RedisQuotaStore
+        self.server = fakeredis.FakeServer()
+        self.store = RedisQuotaStore(fakeredis.FakeRedis(server=self.server))
+        self.now = self.START
+        patcher = mock.patch('api.quota._now_ms', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_concurrent_reserves_respect_max_concurrent(self):
+        import threading
+        from .quota import RedisQuotaStore
+
+        results = []
+        barrier = threading.Barrier(8)
+
+        def reserve(n):
+            store = RedisQuotaStore(fakeredis.FakeRedis(server=self.server))
+            barrier.wait()
+            results.append(store.reserve(1, f'gen-{n}', daily_limit=10, max_concurrent=2))
+
+        threads = [threading.Thread(target=reserve, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sum(r.allowed for r in results), 2)
+        self.assertEqual({r.outcome for r in results if not r.allowed}, {'concurrent_limit'})
+        self.assertEqual(self.store.status(1).active, 2)
+        self.assertEqual(self.store.status(1).used, 2)
+
+    def test_expired_lease_is_refunded(self):
+        self.assertTrue(self.store.reserve(1, 'crashed', daily_limit=5, max_concurrent=1,
+                                           lease_seconds=60).allowed)
+        self.assertEqual(self.store.reserve(1, 'next', daily_limit=5, max_concurrent=1).outcome,
+                         'concurrent_limit')
+
+        self.now += 61 * 1000
+        self.assertFalse(self.store.renew(1, 'missing'))
+        result = self.store.reserve(1, 'next', daily_limit=5, max_concurrent=1)
+        self.assertTrue(result.allowed)
+        self.assertEqual((result.used, result.active), (1, 1))  # 'crashed' no longer counts
+
+    def test_retry_after_daily_limit(self):
+        from .quota import DAILY_WINDOW
+        for n in range(2):
+            self.assertTrue(self.store.reserve(1, f'gen-{n}', daily_limit=2, max_concurrent=5).allowed)
+            self.store.finish(1, f'gen-{n}')
+            self.now += 1000
+
+        self.now = self.START + 5500
+        result = self.store.reserve(1, 'gen-2', daily_limit=2, max_concurrent=5)
+        self.assertEqual(result.outcome, 'daily_limit')
+        self.assertEqual(result.retry_after, DAILY_WINDOW - 5)  # Rounded up
+
+        # The oldest generation leaves the window
+        self.now = self.START + DAILY_WINDOW * 1000 + 1
+        self.assertTrue(self.store.reserve(1, 'gen-2', daily_limit=2, max_concurrent=5).allowed)
+
+    def test_zero_daily_limit_with_no_generations(self):
+        from .quota import DAILY_WINDOW
+        result = self.store.reserve(1, 'gen', daily_limit=0, max_concurrent=1)
+        self.assertEqual((result.outcome, result.used, result.retry_after), ('daily_limit', 0, DAILY_WINDOW))
+
+    def test_finish_refunds_failures_and_records_gpu_seconds(self):
+        self.store.reserve(1, 'ok', daily_limit=5, max_concurrent=2)
+        self.store.reserve(1, 'bad', daily_limit=5, max_concurrent=2)
+        self.assertTrue(self.store.renew(1, 'ok'))
+
+        self.assertTrue(self.store.finish(1, 'ok', success=True, gpu_seconds=12.5))
+        self.assertTrue(self.store.finish(1, 'bad', success=False, gpu_seconds=2.0))
+        self.assertFalse(self.store.finish(1, 'bad', success=False))  # Already released
+
+        status = self.store.status(1)
+        self.assertEqual((status.used, status.active), (1, 0))
+        self.assertAlmostEqual(status.gpu_seconds, 14.5)
+
+
+class RoutingTests(TestCase):
+
+    def test_estimate_cost(self):
+        from .routing import estimate_cost
+        cases = [
+            # stages, megapixels, fast_nlm, expected
+            ([], 1.0, False, 0.2),                                  # I/O only
+            (['denoise'], 2.0, False, 12.4),
+            (['denoise'], 2.0, True, 6.4),                          # fast NLM at half cost
+            (['fused(brightness,contrast)'], 10.0, False, 2.5),
+            (['upscale_2x'], 1.0, False, 4.8),                      # 4 output MP, I/O on the result
+            (['upscale_2x', 'denoise'], 1.0, False, 28.8),          # later stages see 4 MP
+            (['unknown_stage'], 1.0, False, 0.2),
+        ]
+        for stages, megapixels, fast_nlm, expected in cases:
+            with self.subTest(stages=stages, fast_nlm=fast_nlm):
+                self.assertAlmostEqual(estimate_cost(stages, megapixels, fast_nlm), expected)
+
+    def test_tier_priority(self):
+        from .routing import tier_priority
+        cases = [
+            # tier, cost, light, expected
+            ('free', 1.0, True, 4),
+            ('free', 10.0, False, 3),
+            ('free', 100.0, False, 2),                              # batch-sized penalty
+            ('pro', 1.0, True, 7),
+            ('enterprise', 1.0, True, 9),
+            ('enterprise', 100.0, False, 7),
+            ('unknown', 10.0, False, 3),                            # falls back to the default tier
+        ]
+        for tier, cost, light, expected in cases:
+            with self.subTest(tier=tier, cost=cost, light=light):
+                with mock.patch('api.tiers.resolve_tier', return_value=tier):
+                    self.assertEqual(tier_priority(object(), cost, light), expected)
+        self.assertEqual(tier_priority(None), 3)
+
+    def test_broker_priority(self):
+        from .routing import broker_priority
+        cases = [
+            ('redis://localhost:6379/0', 8, 1),                     # Redis serves 0 first
+            ('rediss://cache:6380/0', 2, 7),
+            ('amqp://guest@localhost//', 8, 8),
+            ('', 5, 5),
+        ]
+        for broker, urgency, expected in cases:
+            with self.subTest(broker=broker, urgency=urgency):
+                with self.settings(CELERY_BROKER_URL=broker):
+                    self.assertEqual(broker_priority(urgency), expected)
+
+
+class PresetLUTTests(TestCase):
+
+    def test_lut_matches_direct_chain_within_tolerance(self):
+        import numpy as np
+        from .ai_presets import LUT_MAX_ERROR, PRESETS, apply_preset
+        rng = np.random.default_rng(0)
+        ramp = np.linspace(0, 255, 256).astype(np.uint8)
+        images = {
+            'random': rng.integers(0, 256, (256, 256, 3), dtype=np.uint8),
+            'gradient': np.dstack(np.meshgrid(ramp, ramp) + [np.meshgrid(ramp, ramp)[0][::-1]]),
+        }
+        for preset in PRESETS:
+            for kind, img in images.items():
+                with self.subTest(preset=preset, image=kind):
+                    diff = np.abs(apply_preset(img, preset).astype(int) - apply_preset(img, preset, lut_size=None))
+                    self.assertLessEqual(diff.max(), LUT_MAX_ERROR)
+                    self.assertLess(diff.mean(), 1.0)
+
+
+class ImageHeaderTests(TestCase):
+    """Header parsing and single-pass validation (api/security.py)."""
+
+    WIDTH, HEIGHT = 123, 45
+
+    @classmethod
+    def encode(cls, format, size=None, **options):
+        import io
+        from PIL import Image
+        buffer = io.BytesIO()
+        Image.new('RGB', size or (cls.WIDTH, cls.HEIGHT), (90, 120, 150)).save(buffer, format, **options)
+        return buffer.getvalue()
+
+    @classmethod
+    def samples(cls):
+        return {
+            'jpeg': ('image/jpeg', cls.encode('JPEG')),
+            'jpeg_progressive': ('image/jpeg', cls.encode('JPEG', progressive=True)),
+            'png': ('image/png', cls.encode('PNG')),
+            'gif': ('image/gif', cls.encode('GIF')),
+            'bmp': ('image/bmp', cls.encode('BMP')),
+            'tiff_le': ('image/tiff', cls.encode('TIFF')),
+            'tiff_be': ('image/tiff', cls.tiff(cls.WIDTH, cls.HEIGHT, order='>')),
+            'webp_lossy': ('image/webp', cls.encode('WEBP', quality=80)),
+            'webp_lossless': ('image/webp', cls.encode('WEBP', lossless=True)),
+            'webp_extended': ('image/webp', cls.encode('WEBP', exif=b'Exif\x00\x00II*\x00\x08\x00\x00\x00\x00\x00')),
+        }
+
+    @staticmethod
+    def tiff(width, height, order='<', padding=0):
+        """Minimal TIFF whose only IFD comes after `padding` bytes of data."""
+        import struct
+        ifd_offset = 8 + padding
+        entries = [(256, 4, width), (257, 4, height)]
+        data = (b'II*\x00' if order == '<' else b'MM\x00*') + struct.pack(f'{order}I', ifd_offset)
+        data += b'\x00' * padding + struct.pack(f'{order}H', len(entries))
+        for tag, kind, value in entries:
+            data += struct.pack(f'{order}HHII', tag, kind, 1, value)
+        return data + b'\x00' * 4
+
+    @classmethod
+    def jpeg_with_large_metadata(cls):
+        """JPEG whose frame header sits past HEADER_WINDOW, behind EXIF and ICC segments."""
+        import struct
+        data = cls.encode('JPEG')
+        segments = b''
+        for marker in (b'\xff\xe1', b'\xff\xe2', b'\xff\xe2'):  # APP1 (EXIF), APP2 (ICC) x2
+            payload = b'\x00' * 40000
+            segments += marker + struct.pack('>H', len(payload) + 2) + payload
+        return data[:2] + segments + data[2:]
+
+    def parse(self, data):
+        from .security import buffer_reader, parse_image_header
+        return parse_image_header(buffer_reader(data))
+
+    def test_formats(self):
+        for name, (mime, data) in self.samples().items():
+            with self.subTest(format=name):
+                self.assertEqual(self.parse(data), (mime, self.WIDTH, self.HEIGHT))
+
+    def test_truncated_headers_are_rejected(self):
+        from .security import InvalidImageHeader
+        for name, (mime, data) in self.samples().items():
+            for length in range(min(len(data), 400)):
+                with self.subTest(format=name, length=length):
+                    try:
+                        result = self.parse(data[:length])
+                    except InvalidImageHeader:
+                        continue
+                    # Only possible once the whole header is present
+                    self.assertEqual(result, (mime, self.WIDTH, self.HEIGHT))
+
+    def test_corrupt_headers_are_rejected(self):
+        import random
+        from .security import InvalidImageHeader
+        rng = random.Random(0)
+        for name, (_, data) in self.samples().items():
+            for _ in range(200):
+                corrupt = bytearray(data[:400])
+                for _ in range(rng.randint(1, 4)):
+                    corrupt[rng.randrange(min(len(corrupt), 64))] = rng.randrange(256)
+                try:
+                    self.parse(bytes(corrupt))
+                except InvalidImageHeader:
+                    pass  # Anything else escaping is a bug
+
+    def test_bomb_sized_dimensions(self):
+        import struct
+        import zlib
+        from .security import StreamingImageValidator, check_dimensions
+        # PNG declaring 100000 x 100000 pixels in a few dozen bytes
+        ihdr = struct.pack('>IIBBBBB', 100000, 100000, 8, 2, 0, 0, 0)
+        png = (b'\x89PNG\r\n\x1a\n' + struct.pack('>I', len(ihdr)) + b'IHDR' + ihdr
+               + struct.pack('>I', zlib.crc32(b'IHDR' + ihdr)))
+        self.assertEqual(self.parse(png), ('image/png', 100000, 100000))
+        self.assertIsNotNone(check_dimensions(100000, 100000))
+        self.assertIsNotNone(check_dimensions(8000, 8000))  # Within MAX_DIMENSION, over MAX_PIXELS
+
+        validator = StreamingImageValidator()
+        validator.feed(png)
+        is_valid, error = validator.finish()
+        self.assertFalse(is_valid)
+        self.assertIn('too large', error)
+
+    def test_streaming_validator_chunk_sizes(self):
+        import hashlib
+        from .security import HEADER_WINDOW, StreamingImageValidator
+        cases = {
+            'jpeg_large_metadata': (self.jpeg_with_large_metadata(), 'image/jpeg', self.WIDTH, self.HEIGHT),
+            'tiff_ifd_at_end': (self.tiff(640, 480, padding=200000), 'image/tiff', 640, 480),
+            'tiff_be_ifd_at_end': (self.tiff(640, 480, order='>', padding=200000), 'image/tiff', 640, 480),
+            'png': (self.encode('PNG'), 'image/png', self.WIDTH, self.HEIGHT),
+        }
+        for name, (data, mime, width, height) in cases.items():
+            if name != 'png':
+                self.assertGreater(len(data), HEADER_WINDOW)
+            for chunk_size in (7, 1000, 4096, 65536, 10 * 1024 * 1024):
+                with self.subTest(file=name, chunk_size=chunk_size):
+                    validator = StreamingImageValidator()
+                    for i in range(0, len(data), chunk_size):
+                        validator.feed(data[i:i + chunk_size])
+                    self.assertEqual(validator.finish(), (True, None))
+                    self.assertEqual((validator.mime, validator.width, validator.height), (mime, width, height))
+                    self.assertEqual(validator.content_hash, hashlib.sha256(data).hexdigest())
+
+    def test_streaming_validator_rejects_truncated_and_foreign_files(self):
+        from .security import StreamingImageValidator
+        for data in (self.jpeg_with_large_metadata()[:50000], b'<?php echo 1; ?>' + b'\x00' * 100):
+            with self.subTest(head=data[:8]):
+                validator = StreamingImageValidator()
+                for i in range(0, len(data), 4096):
+                    validator.feed(data[i:i + 4096])
+                is_valid, error = validator.finish()
+                self.assertFalse(is_valid)
+                self.assertTrue(error)
+
+
+class FaceDetectionTests(TestCase):
+
+    def setUp(self):
+        from django.core.cache import cache
+        from .face_detection import FaceDetector
+        cache.clear()
+        self.detector = FaceDetector()
+        self.face_cascade = mock.Mock()
+        self.eye_cascade = mock.Mock()
+        self.eye_cascade.detectMultiScale.return_value = [(10, 10, 20, 20)]
+        cascades = {'face': self.face_cascade, 'eye': self.eye_cascade}
+        patcher = mock.patch.object(self.detector, '_cascade', side_effect=cascades.__getitem__)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_boxes_map_back_to_full_resolution(self):
+        import numpy as np
+        img = np.zeros((2400, 3200, 3), dtype=np.uint8)  # Detected at 1200x1600
+        self.face_cascade.detectMultiScale.return_value = [(100, 50, 40, 40), (1580, 1180, 40, 40), (0, 0, 256, 256)]
+
+        faces = self.detector.detect(img, with_eyes=True)
+        self.assertEqual(self.face_cascade.detectMultiScale.call_args[0][0].shape, (1200, 1600))
+        self.assertEqual([face['box'] for face in faces], [
+            (200, 100, 80, 80),
+            (3160, 2360, 40, 40),  # Clipped to the frame
+            (0, 0, 512, 512),
+        ])
+        # Eyes are found on faces at most 256 px wide and mapped back too
+        self.assertEqual([face['eyes'] for face in faces], [[(10, 10, 20, 20)], [(10, 10, 20, 20)], [(20, 20, 40, 40)]])
+        self.assertEqual(self.eye_cascade.detectMultiScale.call_args[0][0].shape, (256, 256))
+
+    def test_small_images_are_detected_as_is(self):
+        import numpy as np
+        gray = np.random.default_rng(2).integers(0, 256, (600, 800), dtype=np.uint8)
+        self.face_cascade.detectMultiScale.return_value = [(30, 40, 50, 60)]
+        self.assertEqual(self.detector.detect(gray), [{'box': (30, 40, 50, 60), 'eyes': []}])
+        self.assertIs(self.face_cascade.detectMultiScale.call_args[0][0], gray)
+
+    def test_detections_are_cached(self):
+        import numpy as np
+        img = np.full((300, 400, 3), 128, dtype=np.uint8)
+        self.face_cascade.detectMultiScale.return_value = [(30, 40, 50, 60)]
+        first = self.detector.detect(img)
+        self.assertEqual(self.detector.detect(img.copy()), first)
+        self.assertEqual(self.face_cascade.detectMultiScale.call_count, 1)
+
+        self.detector.detect(img, with_eyes=True)  # Different entry
+        self.detector.detect(img, use_cache=False)
+        self.assertEqual(self.face_cascade.detectMultiScale.call_count, 3)
+
+
+class CompositingEquivalenceTests(TestCase):
+    """api/compositing.py against the loops it replaced in AIEngine."""
+
+    @staticmethod
+    def old_gradient(shape, bg_color):
+        import numpy as np
+        background = np.zeros(shape, dtype=np.uint8)
+        h = shape[0]
+        for y in range(h):
+            ratio = y / h
+            color = [int(bg_color[2] * (1 - ratio)), int(bg_color[1] * (1 - ratio) + 128 * ratio),
+                     int(bg_color[0] * (1 - ratio) + 255 * ratio)]
+            background[y, :] = color
+        return background
+
+    @staticmethod
+    def old_blend(foreground, background, mask):
+        import numpy as np
+        fg_mask_3ch = np.expand_dims(mask.astype(np.float32) / 255.0, axis=2)
+        return (foreground * fg_mask_3ch + background * (1 - fg_mask_3ch)).astype(np.uint8)
+
+    def setUp(self):
+        import cv2
+        import numpy as np
+        rng = np.random.default_rng(4)
+        self.img = rng.integers(0, 256, (97, 130, 3), dtype=np.uint8)
+        self.foreground = rng.integers(0, 256, (97, 130, 3), dtype=np.uint8)
+        # Soft-edged mask with every level from 0 to 255
+        mask = np.zeros((97, 130), dtype=np.uint8)
+        cv2.circle(mask, (65, 48), 35, 255, -1)
+        self.mask = cv2.GaussianBlur(mask, (31, 31), 0)
+
+    def assertClose(self, result, expected, tolerance):
+        import numpy as np
+        self.assertEqual(result.shape, expected.shape)
+        self.assertEqual(result.dtype, expected.dtype)
+        self.assertLessEqual(np.abs(result.astype(int) - expected).max(), tolerance)
+
+    def test_gradient_matches_row_loop(self):
+        import numpy as np
+        from .compositing import gradient_background
+        for shape, color in (((97, 130, 3), (255, 255, 255)), ((1, 5, 3), (10, 200, 30)), ((480, 7, 3), (0, 0, 0))):
+            with self.subTest(shape=shape, color=color):
+                self.assertTrue(np.array_equal(gradient_background(shape, color), self.old_gradient(shape, color)))
+
+    def test_blend_within_one_level_of_float_path(self):
+        import numpy as np
+        from .compositing import blend
+        self.assertClose(blend(self.foreground, self.img, self.mask),
+                         self.old_blend(self.foreground, self.img, self.mask), 1)
+        weights = self.mask.astype(np.float32) / 255
+        self.assertClose(blend(self.foreground, self.img, weights),
+                         self.old_blend(self.foreground, self.img, self.mask), 1)
+
+    def test_replace_background_modes(self):
+        import cv2
+        import numpy as np
+        from .compositing import premultiply, replace_background
+        backgrounds = {
+            'blur': cv2.GaussianBlur(self.img, (25, 25), 0),  # Even strengths are rounded up
+            'solid': np.full(self.img.shape, (30, 20, 10), dtype=np.uint8),
+            'gradient': self.old_gradient(self.img.shape, (10, 20, 30)),
+        }
+        for mode, background in backgrounds.items():
+            with self.subTest(mode=mode):
+                result = replace_background(self.img, self.foreground, self.mask, mode=mode,
+                                            bg_color=(10, 20, 30), blur_strength=24)
+                self.assertClose(result, self.old_blend(self.foreground, background, self.mask), 1)
+
+        expected = cv2.cvtColor(self.foreground, cv2.COLOR_BGR2BGRA)
+        expected[:, :, 3] = self.mask
+        self.assertTrue(np.array_equal(replace_background(self.img, self.foreground, self.mask, mode='transparent'),
+                                       expected))
+
+        old = self.img.copy()
+        for i in range(3):
+            old[:, :, i] = (old[:, :, i] * (self.mask.astype(np.float32) / 255.0)).astype(np.uint8)
+        self.assertClose(premultiply(self.img, self.mask), old, 1)
+
+
+class BackgroundMaskTests(TestCase):
+
+    def setUp(self):
+        import numpy as np
+        from django.core.cache import cache
+        from .background_mask import BackgroundMaskService
+        cache.clear()
+        self.service = BackgroundMaskService()
+        rng = np.random.default_rng(6)
+        self.img = rng.integers(0, 256, (40, 60, 3), dtype=np.uint8)
+        self.mask = rng.integers(0, 256, (40, 60), dtype=np.uint8)
+
+    def patch_rembg(self, **remove_kwargs):
+        remove = mock.patch('api.background_mask.remove', **remove_kwargs).start()
+        new_session = mock.patch('api.background_mask.new_session').start()
+        self.addCleanup(mock.patch.stopall)
+        return remove, new_session
+
+    def test_mask_cache_hit(self):
+        import numpy as np
+        remove, new_session = self.patch_rembg(return_value=self.mask)
+        first = self.service.get_mask(self.img)
+        second = self.service.get_mask(self.img.copy())
+        self.assertEqual(remove.call_count, 1)
+        self.assertTrue(np.array_equal(first, self.mask))
+        self.assertTrue(np.array_equal(second, self.mask))  # PNG round trip is lossless
+        # rembg gets RGB, with the shared session
+        self.assertTrue(np.array_equal(remove.call_args[0][0], self.img[:, :, ::-1]))
+        self.assertIs(remove.call_args[1]['session'], new_session.return_value)
+
+        self.service.get_mask(self.img[::-1].copy())  # Different content: a miss
+        self.service.get_mask(self.img, use_cache=False)
+        self.assertEqual(remove.call_count, 3)
+        self.assertEqual(new_session.call_count, 1)
+
+    def test_failures_fall_back(self):
+        remove, _ = self.patch_rembg(side_effect=RuntimeError('model missing'))
+        self.assertIsNone(self.service.get_mask(self.img))
+        self.assertIsNone(self.service.get_mask(self.img))
+        self.assertEqual(remove.call_count, 2)  # Failures are not cached
+
+        with mock.patch('api.background_mask.remove', None):
+            self.assertFalse(self.service.available)
+            self.assertIsNone(self.service.get_mask(self.img))
+
+
+class PipelineEquivalenceTests(TestCase):
+    """compile_pipeline must match the stage-by-stage AIEngine path bit for bit."""
+
+    @staticmethod
+    def sequential(img, settings_data):
+        """The original process_image_async sequence (model-free stages)."""
+        from .ai_engine import AIEngine
+        b = float(settings_data.get('brightness', 1.0))
+        c = float(settings_data.get('contrast', 1.0))
+        s = float(settings_data.get('saturation', 1.0))
+        if b != 1.0 or c != 1.0 or s != 1.0:
+            img = AIEngine.adjust_image(img, brightness=b, contrast=c, saturation=s, return_path=False)
+        upscale_x = min(int(settings_data.get('upscaleX', 1)), 4)
+        if upscale_x > 1:
+            img = AIEngine.upscale_image(img, scale=2, return_path=False)
+            if upscale_x >= 4:
+                img = AIEngine.upscale_image(img, scale=2, return_path=False)
+        if settings_data.get('autoEnhance', False):
+            img = AIEngine.auto_enhance(img, return_path=False)
+        if settings_data.get('whiteBalance', False):
+            img = AIEngine.correct_white_balance(img, return_path=False)
+        if int(settings_data.get('denoiseStrength', 0)) > 0:
+            img = AIEngine.denoise_advanced(img, strength=int(settings_data['denoiseStrength']), return_path=False)
+        preset = settings_data.get('filterPreset', '')
+        if preset and preset != 'none':
+            img = AIEngine.apply_filter_preset(img, preset, return_path=False)
+        if upscale_x > 1:
+            img = AIEngine.upscale_image(img, scale=upscale_x, return_path=False)
+        return img
+
+    def test_fused_pipeline_matches_sequential_path(self):
+        import numpy as np
+        from .pipeline import compile_pipeline
+        from .pipeline import BAND_ROWS
+        rng = np.random.default_rng(1)
+        # Several bands with a partial last one, so banded passes and the
+        # vignette's per-band row offsets are exercised
+        height, width = 3 * BAND_ROWS + 91, 120
+        ramp = np.linspace(20, 230, width).astype(np.float32)
+        img = np.clip(ramp[None, :, None] * [0.6, 0.9, 1.1] + rng.normal(0, 12, (height, width, 3)),
+                      0, 255).astype(np.uint8)
 
-# Create your tests here.
+        cases = [
+            {'brightness': 1.1, 'contrast': 1.2, 'saturation': 1.3},
+            {'brightness': 0.9, 'whiteBalance': True, 'filterPreset': 'vintage'},
+            {'contrast': 1.1, 'saturation': 0.8, 'whiteBalance': True, 'filterPreset': 'cinematic',
+             'autoEnhance': True, 'upscaleX': 2},
+            {'saturation': 1.2, 'denoiseStrength': 10, 'filterPreset': 'bw_noir'},
+            {'whiteBalance': True, 'filterPreset': 'fade'},
+            {'brightness': 1.05, 'filterPreset': 'warm'},
+        ]
+        for settings_data in cases:
+            with self.subTest(settings=settings_data):
+                expected = self.sequential(img.copy(), settings_data)
+                result = compile_pipeline(settings_data).run(img.copy())
+                self.assertEqual(result.shape, expected.shape)
+                self.assertTrue(np.array_equal(result, expected),
+                                f"max difference {np.abs(result.astype(int) - expected).max()}")
@@ -2,110 +2,154 @@
 Dynamic Rate Limiting for FixPix
 
 User-tier based rate limiting with Redis caching.
+
+Tiers come from the shared resolver (api/tiers.py), so stacking several
+throttles on a view costs one tier lookup. Each throttle keeps a
+sliding-window counter per user (current and previous fixed-window counts,
+weighted by overlap) instead of DRF's list of request timestamps, which
+grows with the rate. Counts live in one cache key per window and are bumped
+with cache.add + cache.incr, so concurrent requests on other workers are
+never lost the way a get/set of shared state would lose them.
 """
 
 from rest_framework.throttling import UserRateThrottle, AnonRateThrottle
 
+from .tiers import resolve_tier
+
+
+class SlidingWindowMixin:
+    """
+    Approximate sliding-window limit over per-window counters.
 
-class TieredUserRateThrottle(UserRateThrottle):
+    The request count over the last `duration` seconds is estimated as
+    previous * (unexpired share of the previous window) + current.
+    """
+
+    def window_key(self, window):
+        return f'{self.key}:{window}'
+
+    def throttle_window(self):
+        now = self.timer()
+        window = int(now // self.duration)
+        elapsed = now - window * self.duration
+        weight = 1 - elapsed / self.duration
+
+        previous = self.cache.get(self.window_key(window - 1), 0)
+        if previous * weight >= self.num_requests:
+            return self.throttle_failure_after(previous, self.cache.get(self.window_key(window), 0), elapsed)
+
+        # Count this request first, then check: the increment is atomic,
+        # so concurrent requests each see their own position in the window
+        key = self.window_key(window)
+        self.cache.add(key, 0, 2 * self.duration)
+        try:
+            current = self.cache.incr(key)
+        except ValueError:  # Expired between add and incr
+            self.cache.set(key, 1, 2 * self.duration)
+            current = 1
+
+        if previous * weight + current > self.num_requests:
+            try:
+                self.cache.decr(key)  # Rejected requests do not count
+            except ValueError:
+                pass
+            return self.throttle_failure_after(previous, current - 1, elapsed)
+        return True
+
+    def throttle_failure_after(self, previous, current, elapsed):
+        """Record how long until a request would fit again, and refuse this one."""
+        if previous and current < self.num_requests:
+            # Time until the previous window's share has decayed enough
+            self._wait = max(0.0, self.duration * (1 - (self.num_requests - current) / previous) - elapsed)
+        else:
+            self._wait = self.duration - elapsed
+        return False
+
+    def allow_request(self, request, view):
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        return self.throttle_window()
+
+    def wait(self):
+        return getattr(self, '_wait', None)
+
+
+class TieredRateThrottle(SlidingWindowMixin, UserRateThrottle):
+    """Base for throttles whose rate depends on the user's plan tier."""
+
+    TIER_RATES = {
+        'free': '20/minute',
+    }
+
+    def __init__(self):
+        # Rate is per request (tier), resolved in allow_request
+        self.rate = None
+
+    def get_rate(self):
+        tier = resolve_tier(self.request.user)
+        return self.TIER_RATES.get(tier, self.TIER_RATES['free'])
+
+    def allow_request(self, request, view):
+        """Check if request is allowed based on tier."""
+        self.request = request
+        self.rate = self.get_rate()
+        self.num_requests, self.duration = self.parse_rate(self.rate)
+        return super().allow_request(request, view)
+
+
+class TieredUserRateThrottle(TieredRateThrottle):
     """
     Dynamic rate limiting based on user subscription tier.
-    
+
     Free users: 20 requests/minute
     Pro users: 100 requests/minute
     Enterprise: 500 requests/minute
     """
-    
+    scope = 'tiered_user'
+
     # Default rates by tier
     TIER_RATES = {
         'free': '20/minute',
         'pro': '100/minute',
         'enterprise': '500/minute',
     }
-    
-    def get_rate(self):
-        """Override to return tier-based rate."""
-        if self.request.user.is_authenticated:
-            # Try to get user's plan from profile
-            try:
-                plan = getattr(self.request.user, 'profile', None)
-                if plan:
-                    tier = getattr(plan, 'plan', 'free')
-                    return self.TIER_RATES.get(tier, self.TIER_RATES['free'])
-            except Exception:
-                pass
-        
-        return self.TIER_RATES['free']
-    
-    def allow_request(self, request, view):
-        """Check if request is allowed based on tier."""
-        self.rate = self.get_rate()
-        self.num_requests, self.duration = self.parse_rate(self.rate)
-        return super().allow_request(request, view)
 
 
-class ProcessingRateThrottle(UserRateThrottle):
+class ProcessingRateThrottle(TieredRateThrottle):
     """
     Separate rate limit for heavy image processing operations.
-    
+
     More restrictive to prevent abuse.
     """
     scope = 'processing'
-    
+
     TIER_RATES = {
         'free': '5/minute',      # Free: 5 processes/minute
         'pro': '30/minute',      # Pro: 30 processes/minute
         'enterprise': '100/minute',
     }
-    
-    def get_rate(self):
-        if self.request.user.is_authenticated:
-            try:
-                plan = getattr(self.request.user, 'profile', None)
-                if plan:
-                    tier = getattr(plan, 'plan', 'free')
-                    return self.TIER_RATES.get(tier, self.TIER_RATES['free'])
-            except Exception:
-                pass
-        return self.TIER_RATES['free']
-    
-    def allow_request(self, request, view):
-        self.rate = self.get_rate()
-        self.num_requests, self.duration = self.parse_rate(self.rate)
-        return super().allow_request(request, view)
 
 
-class UploadRateThrottle(UserRateThrottle):
+class UploadRateThrottle(TieredRateThrottle):
     """
     Rate limit for file uploads.
     """
     scope = 'uploads'
-    
+
     TIER_RATES = {
         'free': '10/minute',
         'pro': '50/minute',
         'enterprise': '200/minute',
     }
-    
-    def get_rate(self):
-        if self.request.user.is_authenticated:
-            try:
-                plan = getattr(self.request.user, 'profile', None)
-                if plan:
-                    tier = getattr(plan, 'plan', 'free')
-                    return self.TIER_RATES.get(tier, self.TIER_RATES['free'])
-            except Exception:
-                pass
-        return self.TIER_RATES['free']
-    
-    def allow_request(self, request, view):
-        self.rate = self.get_rate()
-        self.num_requests, self.duration = self.parse_rate(self.rate)
-        return super().allow_request(request, view)
 
 
-class StrictAnonThrottle(AnonRateThrottle):
+class StrictAnonThrottle(SlidingWindowMixin, AnonRateThrottle):
     """
     Strict rate limiting for anonymous users.
     """
+    scope = 'strict_anon'
     rate = '10/minute'
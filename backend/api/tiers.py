@@ -0,0 +1,133 @@
+"""
+Subscription Tier Resolution for FixPix
+
+Single place that maps a user to a plan tier ('free', 'pro', 'enterprise'),
+shared by the rate throttles and GenerationLimits.
+
+Lookups are cached at two levels so stacked throttles and quota checks cost
+at most one profile query per user per TTL:
+- per request: memoized on the user instance
+- per process: TTL cache keyed by user id (TIER_CACHE_SECONDS)
+
+Plan changes invalidate the process cache on any save of the user or of
+the model behind user.profile (connected in api/signals.py when one is
+installed). Code that changes a plan without saving the profile (e.g. a
+queryset update) sends plan_changed instead. Other processes pick up the
+change when their entry expires.
+
+Usage:
+    from api.tiers import resolve_tier
+
+    tier = resolve_tier(request.user)
+
+    # Billing code that updates plans without Profile.save():
+    plan_changed.send(sender=Profile, user_id=user.pk)
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.dispatch import Signal
+
+TIERS = ('free', 'pro', 'enterprise')
+DEFAULT_TIER = 'free'
+
+# Process-level cache lifetime (seconds)
+TIER_CACHE_SECONDS = 60
+
+# Sent with user_id=... when a user's plan changes without a profile save
+plan_changed = Signal()
+
+_MEMO_ATTR = '_fixpix_tier'
+
+
+class TierCache:
+    """Thread-safe {user_id: (tier, expires_at)} with a TTL."""
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'TIER_CACHE_SECONDS', TIER_CACHE_SECONDS)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[1] <= time.monotonic():
+            return None
+        return entry[0]
+
+    def set(self, user_id, tier):
+        with self._lock:
+            self._entries[user_id] = (tier, time.monotonic() + self.ttl)
+            # Bound memory: drop expired entries once the map grows
+            if len(self._entries) > 10000:
+                now = time.monotonic()
+                self._entries = {k: v for k, v in self._entries.items() if v[1] > now}
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+tier_cache = TierCache()
+
+
+def _lookup_tier(user):
+    """Read the tier from the user's profile (may query the database)."""
+    try:
+        profile = getattr(user, 'profile', None)
+    except Exception:
+        profile = None  # RelatedObjectDoesNotExist
+    if profile is None:
+        return DEFAULT_TIER
+
+    plan = getattr(profile, 'plan', None)
+    if plan in TIERS:
+        return plan
+    if getattr(profile, 'is_premium', False):
+        return 'pro'
+    return DEFAULT_TIER
+
+
+def resolve_tier(user):
+    """Return the plan tier of a user; anonymous users are 'free'."""
+    if user is None or not getattr(user, 'is_authenticated', False):
+        return DEFAULT_TIER
+
+    tier = getattr(user, _MEMO_ATTR, None)
+    if tier is not None:
+        return tier
+
+    tier = tier_cache.get(user.pk)
+    if tier is None:
+        tier = _lookup_tier(user)
+        tier_cache.set(user.pk, tier)
+
+    setattr(user, _MEMO_ATTR, tier)
+    return tier
+
+
+def profile_relation():
+    """
+    The reverse one-to-one behind user.profile, or None if no installed
+    model provides one.
+    """
+    from django.contrib.auth import get_user_model
+    from django.core.exceptions import FieldDoesNotExist
+
+    try:
+        relation = get_user_model()._meta.get_field('profile')
+    except FieldDoesNotExist:
+        return None
+    return relation if relation.one_to_one else None
+
+
+def invalidate_tier(user_id=None):
+    """Forget cached tiers (one user, or everyone) in this process."""
+    tier_cache.invalidate(user_id)
@@ -0,0 +1,153 @@
+"""
+Tiled Execution for FixPix
+
+Runs neighbourhood filters (NLM denoise, bilateral, Lanczos upscale...) over
+horizontal strips of an image instead of the whole frame at once. Each strip
+is read with a halo of extra rows so that, as long as the halo covers the
+filter chain's radius, the result is identical to the full-frame call.
+
+Strips are written into one preallocated output, so peak memory is the
+input + output + (workers x one strip's intermediates) rather than every
+intermediate of the whole frame. OpenCV releases the GIL, so strips can
+run on a thread pool.
+
+Each finished strip is a progress checkpoint (see api/progress.py): a
+cancelled job stops after the strips already in flight.
+
+Usage:
+    from api.tiling import run_tiled
+
+    out = run_tiled(img, lambda tile: cv2.bilateralFilter(tile, 9, 75, 75), halo=4)
+"""
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from django.conf import settings
+
+from .progress import checkpoint
+
+# Source rows per strip (before halo)
+DEFAULT_TILE_ROWS = 512
+
+# Frames smaller than this run in one call; strips would only add overhead
+MIN_TILED_PIXELS = 2 * 1024 * 1024
+
+
+def available_cores():
+    """CPU cores this process may run on (respects affinity/cgroup cpusets)."""
+    try:
+        return len(os.sched_getaffinity(0)) or 1
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def default_workers():
+    """
+    Thread count for tiled ops.
+
+    AI_TILE_WORKERS if set; otherwise the cores left per task once every
+    Celery prefork child is busy (cores // CELERY_WORKER_CONCURRENCY), so a
+    fully loaded worker does not oversubscribe the machine.
+
+    With CELERY_WORKER_CONCURRENCY unset Celery starts one child per core,
+    so this is 1: strips then run one after another and tiling only bounds
+    memory. Heavy-lane workers run fewer children than cores and should set
+    CELERY_WORKER_CONCURRENCY (rather than only `-c`) to get parallel strips.
+    """
+    workers = getattr(settings, 'AI_TILE_WORKERS', 0)
+    if workers and workers > 0:
+        return workers
+
+    cores = available_cores()
+    concurrency = getattr(settings, 'CELERY_WORKER_CONCURRENCY', None) or cores
+    return max(1, cores // concurrency)
+
+
+def strip_bounds(height, tile_rows, halo):
+    """
+    Yield (y0, y1, read0, read1) for each strip: rows [y0, y1) are kept,
+    rows [read0, read1) are read (the strip plus its halo, clipped).
+    """
+    for y0 in range(0, height, tile_rows):
+        y1 = min(height, y0 + tile_rows)
+        yield y0, y1, max(0, y0 - halo), min(height, y1 + halo)
+
+
+def run_tiled(img, fn, halo, scale=1, tile_rows=DEFAULT_TILE_ROWS, workers=None):
+    """
+    Apply fn to overlapping horizontal strips of img.
+
+    Args:
+        img: Input image (H x W or H x W x C)
+        fn: Function mapping a strip to its processed strip. It may resize by
+            an integer `scale` and change the channel count, but must be
+            otherwise shape-preserving.
+        halo: Rows of context needed on each side, in input pixels. Must be
+            at least the radius of fn's filter chain for an exact result.
+        scale: Integer output/input size ratio of fn
+        tile_rows: Source rows per strip
+        workers: Thread count (default: default_workers())
+
+    Returns:
+        The processed image, equal to fn(img)
+    """
+    height = img.shape[0]
+    if img.shape[0] * img.shape[1] < MIN_TILED_PIXELS or height <= tile_rows:
+        return fn(img)
+
+    if workers is None:
+        workers = default_workers()
+
+    bounds = list(strip_bounds(height, tile_rows, halo))
+    out = None
+
+    def process(bound):
+        y0, y1, read0, read1 = bound
+        result = fn(img[read0:read1])
+        top = (y0 - read0) * scale
+        return result[top:top + (y1 - y0) * scale]
+
+    def store(bound, strip):
+        nonlocal out
+        if out is None:
+            out = np.empty((height * scale,) + strip.shape[1:], dtype=strip.dtype)
+        y0 = bound[0] * scale
+        out[y0:y0 + strip.shape[0]] = strip
+
+    if workers <= 1:
+        for done, bound in enumerate(bounds, 1):
+            store(bound, process(bound))
+            checkpoint(done, len(bounds))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # At most `workers` strips submitted at a time, the next one as
+            # each finished strip is stored, so results waiting to be stored
+            # never pile up and a cancel has little queued work to drop
+            remaining = iter(bounds)
+            pending = deque()
+
+            def submit_next():
+                bound = next(remaining, None)
+                if bound is not None:
+                    pending.append((bound, pool.submit(process, bound)))
+
+            for _ in range(workers):
+                submit_next()
+            try:
+                done = 0
+                while pending:
+                    bound, future = pending.popleft()
+                    store(bound, future.result())
+                    done += 1
+                    checkpoint(done, len(bounds))
+                    submit_next()
+            except BaseException:
+                # Cancelled or failed: drop the strips not started yet
+                for _, future in pending:
+                    future.cancel()
+                raise
+
+    return out
@@ -0,0 +1,195 @@
+"""
+Direct Uploads for FixPix
+
+Lets clients upload originals straight to storage instead of streaming them
+through a Django web worker:
+
+1. POST /api/images/upload_url/  -> presigned target + upload_token
+2. Client uploads the file to the target
+3. POST /api/images/ingest/      -> project created (status 'ingesting') and
+   ingest_upload_async validates, hashes and releases it (status 'pending')
+
+With STORAGE_PROVIDER=s3 the target is an S3 presigned POST. Otherwise a
+local stand-in is used: a signed, single-use PUT URL served by
+direct_upload_view that streams the body into default_storage. It behaves
+like a MinIO/S3 presigned URL, so clients and tests use the same flow.
+
+Usage:
+    from api.uploads import create_upload
+
+    upload = create_upload(request, user, 'photo.jpg', 'image/jpeg', size)
+"""
+
+import os
+import uuid
+
+from django.conf import settings
+from django.core import signing
+from django.core.files.storage import default_storage
+
+from .security import ALLOWED_MIME_TYPES, MAX_FILE_SIZE, sanitize_filename
+
+# Lifetime of presigned URLs and upload tokens (seconds)
+UPLOAD_URL_EXPIRY = 15 * 60
+
+UPLOAD_PREFIX = 'originals/'
+
+UPLOAD_SALT = 'fixpix.uploads'
+TARGET_SALT = 'fixpix.uploads.target'
+
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+class UploadError(ValueError):
+    """Raised for upload requests that cannot be accepted."""
+
+
+def _expiry():
+    return getattr(settings, 'UPLOAD_URL_EXPIRY', UPLOAD_URL_EXPIRY)
+
+
+def validate_request(filename, content_type, size):
+    """Check the declared file before handing out an upload URL."""
+    ext = os.path.splitext(filename or '')[1].lower()
+    allowed_exts = ALLOWED_MIME_TYPES.get(content_type)
+    if not allowed_exts:
+        raise UploadError(f"Invalid file type: {content_type}. Only images are allowed.")
+    if ext not in allowed_exts:
+        raise UploadError(f"Extension {ext or '(none)'} does not match {content_type}")
+    try:
+        size = int(size)
+    except (TypeError, ValueError):
+        raise UploadError("size is required")
+    if size <= 0 or size > MAX_FILE_SIZE:
+        raise UploadError(f"File too large. Maximum size is {MAX_FILE_SIZE // (1024*1024)}MB")
+    return size
+
+
+def create_upload(request, user, filename, content_type, size):
+    """
+    Reserve a storage key for a new original and presign an upload to it.
+
+    Returns:
+        {'key', 'upload_token', 'expires_in', 'upload': {method, url, fields, headers}}
+    """
+    size = validate_request(filename, content_type, size)
+    key = f"{UPLOAD_PREFIX}{uuid.uuid4().hex[:12]}_{sanitize_filename(filename)}"
+
+    if getattr(settings, 'STORAGE_PROVIDER', 'local') == 's3':
+        upload = _presign_s3(key, content_type)
+    else:
+        upload = _presign_local(request, key, content_type)
+
+    token = signing.dumps({'key': key, 'user': user.pk, 'type': content_type}, salt=UPLOAD_SALT)
+    return {
+        'key': key,
+        'upload_token': token,
+        'expires_in': _expiry(),
+        'upload': upload,
+    }
+
+
+def resolve_token(upload_token, user):
+    """Return the storage key of a finished upload, or raise UploadError."""
+    try:
+        data = signing.loads(upload_token, salt=UPLOAD_SALT, max_age=_expiry() * 2)
+    except signing.SignatureExpired:
+        raise UploadError("Upload token expired")
+    except signing.BadSignature:
+        raise UploadError("Invalid upload token")
+
+    if data.get('user') != user.pk:
+        raise UploadError("Invalid upload token")
+    if not default_storage.exists(data['key']):
+        raise UploadError("File has not been uploaded yet")
+    return data['key']
+
+
+# ---- S3 presigned POST ----
+
+def _presign_s3(key, content_type):
+    # S3Boto3Storage exposes its configured boto3 bucket
+    bucket = default_storage.bucket
+    location = getattr(default_storage, 'location', '')
+    object_key = f"{location.rstrip('/')}/{key}" if location else key
+
+    post = bucket.meta.client.generate_presigned_post(
+        Bucket=bucket.name,
+        Key=object_key,
+        Fields={'Content-Type': content_type},
+        Conditions=[
+            {'Content-Type': content_type},
+            ['content-length-range', 1, MAX_FILE_SIZE],
+        ],
+        ExpiresIn=_expiry(),
+    )
+    return {'method': 'POST', 'url': post['url'], 'fields': post['fields'], 'headers': {}}
+
+
+# ---- Local stand-in (signed PUT to this server) ----
+
+def _presign_local(request, key, content_type):
+    from django.urls import reverse
+
+    target = signing.dumps({'key': key, 'type': content_type}, salt=TARGET_SALT)
+    url = reverse('direct_upload', args=[target])
+    if request is not None:
+        url = request.build_absolute_uri(url)
+    return {'method': 'PUT', 'url': url, 'fields': {}, 'headers': {'Content-Type': content_type}}
+
+
+class _LimitedStream:
+    """Read-only stream over a request body that refuses more than max_bytes."""
+
+    def __init__(self, stream, max_bytes):
+        self._stream = stream
+        self._max_bytes = max_bytes
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self._stream.read(STREAM_CHUNK_SIZE if size is None or size < 0 else size)
+        self.size += len(chunk)
+        if self.size > self._max_bytes:
+            raise UploadError("File too large")
+        return chunk
+
+
+def receive_local_upload(target, request):
+    """
+    Stream a PUT body into default_storage for a signed local target.
+
+    Returns the stored key; raises UploadError if the target is invalid,
+    expired, already used or the body is too large.
+    """
+    from django.core.files import File
+
+    try:
+        data = signing.loads(target, salt=TARGET_SALT, max_age=_expiry())
+    except signing.BadSignature:
+        raise UploadError("Invalid or expired upload URL")
+
+    key = data['key']
+    if default_storage.exists(key):
+        raise UploadError("Upload URL already used")
+
+    declared = request.META.get('CONTENT_LENGTH')
+    if declared:
+        try:
+            declared = int(declared)
+        except ValueError:
+            raise UploadError("Invalid Content-Length")
+        if declared > MAX_FILE_SIZE:
+            raise UploadError("File too large")
+
+    body = _LimitedStream(request, MAX_FILE_SIZE)
+    try:
+        saved = default_storage.save(key, File(body, name=os.path.basename(key)))
+    except UploadError:
+        if default_storage.exists(key):
+            default_storage.delete(key)
+        raise
+    if saved != key:
+        # Concurrent PUT with the same URL won the race
+        default_storage.delete(saved)
+        raise UploadError("Upload URL already used")
+    return key
@@ -1,6 +1,6 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import ImageViewSet, RegisterView, MyTokenObtainPairView
+from .views import ImageViewSet, RegisterView, MyTokenObtainPairView, direct_upload_view
 from rest_framework_simplejwt.views import (
     TokenRefreshView,
 )
@@ -13,6 +13,8 @@ urlpatterns = [
     path('register/', RegisterView.as_view(), name='auth_register'),
     path('token/', MyTokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('token/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
+    # Local stand-in for presigned storage uploads
+    path('uploads/<str:target>/', direct_upload_view, name='direct_upload'),
     # Admin API
     path('admin/', include('api.admin_urls')),
 ]
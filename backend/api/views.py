@@ -2,10 +2,15 @@ from rest_framework import viewsets, status, generics
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.negotiation import DefaultContentNegotiation
+from django.core.exceptions import ValidationError
 from django.core.files.base import ContentFile
+from django.db import IntegrityError, transaction
+from django.views.decorators.csrf import csrf_exempt
 import time
 import os
 import base64
+import uuid
 from .models import ImageProject
 from .serializers import ImageProjectSerializer, RegisterSerializer, UserSerializer, MyTokenObtainPairSerializer
 from rest_framework_simplejwt.views import TokenObtainPairView
@@ -18,19 +23,132 @@ class RegisterView(generics.CreateAPIView):
     permission_classes = (AllowAny,)
     serializer_class = RegisterSerializer
 
+# Internal bookkeeping columns not shown by ImageProjectSerializer
+LIST_DEFERRED_FIELDS = ('original_hash', 'result_key', 'storage_bytes', 'updated_at')
+
+class ExportContentNegotiation(DefaultContentNegotiation):
+    """
+    Leave ?format= to the export (png/jpg/webp) instead of DRF's renderer
+    override, and accept any Accept header.
+    """
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
 class ImageViewSet(viewsets.ModelViewSet):
     serializer_class = ImageProjectSerializer
     permission_classes = [IsAuthenticated]
 
     def get_queryset(self):
-        return ImageProject.objects.filter(user=self.request.user).order_by('-created_at')
+        # (user, -created_at, -id) index order; list pages skip the columns
+        # only workers use
+        queryset = ImageProject.objects.filter(user=self.request.user).order_by('-created_at', '-id')
+        if self.action == 'list':
+            queryset = queryset.defer(*LIST_DEFERRED_FIELDS)
+        elif self.action == 'progress':
+            queryset = queryset.only('id', 'status')
+        return queryset
 
     def perform_create(self, serializer):
-        serializer.save(user=self.request.user)
+        # Hash the upload while it is still in memory/temp (result cache key)
+        from .result_cache import hash_file
+        original = serializer.validated_data.get('original_image')
+        original_hash = hash_file(original) if original else None
+        serializer.save(user=self.request.user, original_hash=original_hash)
+
+    @action(detail=False, methods=['post'])
+    def upload_url(self, request):
+        """
+        Get a presigned URL to upload an original directly to storage.
+
+        Request Body:
+        - filename: str (required)
+        - content_type: str (required) - e.g. 'image/jpeg'
+        - size: int (required) - file size in bytes
+
+        Upload the file as described by `upload`, then call `ingest` with
+        the returned upload_token.
+        """
+        from .uploads import create_upload, UploadError
+
+        try:
+            upload = create_upload(
+                request, request.user,
+                request.data.get('filename', ''),
+                request.data.get('content_type', ''),
+                request.data.get('size'),
+            )
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(upload, status=status.HTTP_201_CREATED)
+
+    @action(detail=False, methods=['post'])
+    def ingest(self, request):
+        """
+        Register a directly uploaded original and validate it in the background.
+
+        Request Body:
+        - upload_token: str (required) - from upload_url
+        - processing_type: str (optional)
+
+        Returns 202 with the project in status 'ingesting'; it moves to
+        'pending' once validated, or 'failed' if rejected.
+        """
+        from .uploads import resolve_token, UploadError
+
+        try:
+            key = resolve_token(request.data.get('upload_token', ''), request.user)
+        except UploadError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        processing_type = request.data.get('processing_type', 'restore')
+        if processing_type not in dict(ImageProject.PROCESSING_TYPES):
+            processing_type = 'restore'
+
+        # The token is single use: the unique original_image constraint lets
+        # exactly one of any concurrent calls create the project
+        try:
+            with transaction.atomic():
+                project = ImageProject.objects.create(
+                    user=request.user,
+                    original_image=key,
+                    processing_type=processing_type,
+                    status='ingesting',
+                )
+        except IntegrityError:
+            return Response({'error': 'Upload already ingested'}, status=status.HTTP_409_CONFLICT)
+
+        try:
+            from .tasks import ingest_upload_async
+            task = ingest_upload_async.delay(str(project.id))
+        except Exception as e:
+            print(f"Celery Error (ingest): {e}")
+            project.status = 'failed'
+            project.save()
+            return Response({
+                'error': 'Upload service is currently unavailable. Please try again later.',
+                'detail': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        project.refresh_from_db()
+        data = self.get_serializer(project).data
+        data['task_id'] = task.id
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+    @staticmethod
+    def _ingesting_conflict(project):
+        """409 for a direct upload that ingest_upload_async has not validated yet."""
+        if project.status == 'ingesting':
+            return Response({'error': 'Upload is still being validated'}, status=status.HTTP_409_CONFLICT)
+        return None
 
     @action(detail=True, methods=['post'])
     def process_image(self, request, pk=None):
+        from . import progress
+
         project = self.get_object()
+        conflict = self._ingesting_conflict(project)
+        if conflict:
+            return conflict
         
         # Determine settings from request body
         settings_data = request.data.get('settings', {})
@@ -58,6 +176,7 @@ class ImageViewSet(viewsets.ModelViewSet):
         if mask_data:
              try:
                 # Store mask in temp storage (needs to be accessible by worker)
+                from django.conf import settings
                 from django.core.files.storage import default_storage
                 from django.core.files.base import ContentFile
                 import time
@@ -66,26 +185,46 @@ class ImageViewSet(viewsets.ModelViewSet):
                     mask_data = mask_data.split('base64,')[1]
                 
                 mask_content = base64.b64decode(mask_data)
-                mask_filename = f"temp/mask_{pk}_{int(time.time())}.png"
-                
-                # Save to storage
-                mask_temp_path = default_storage.save(mask_filename, ContentFile(mask_content))
+
+                if getattr(settings, 'SCRATCH_SHARED', False):
+                    # Workers share this host: hand over the decoded mask by
+                    # reference (see api/scratch.py)
+                    import cv2
+                    import numpy as np
+                    from .scratch import scratch_store
+                    mask_img = cv2.imdecode(np.frombuffer(mask_content, np.uint8), cv2.IMREAD_UNCHANGED)
+                    if mask_img is None:
+                        raise ValueError("Invalid mask image")
+                    mask_temp_path = scratch_store.put(mask_img)
+                else:
+                    mask_filename = f"temp/mask_{pk}_{int(time.time())}.png"
+                    
+                    # Save to storage
+                    mask_temp_path = default_storage.save(mask_filename, ContentFile(mask_content))
              except Exception as e:
                  print(f"Mask upload failed: {e}")
 
-        # Update status to pending
+        # Update status to pending; a project processed on its own leaves
+        # its batch, so a redelivered batch chunk does not take it over
         project.status = 'pending'
+        project.batch = None
         project.save()
+        progress.queued(project.id)
 
-        # Dispatch Async Task
+        # Dispatch Async Task on the lane its estimated cost calls for
         try:
             from .tasks import process_image_async
-            task = process_image_async.delay(project.id, settings_data, mask_temp_path)
+            from .routing import route_processing
+            route = route_processing(project, settings_data, has_mask=bool(mask_temp_path))
+            task = process_image_async.apply_async(
+                (project.id, settings_data, mask_temp_path), **route.options
+            )
         except Exception as e:
             # Fallback if Broker is down
             print(f"Celery Error: {e}")
             project.status = 'failed'
             project.save()
+            progress.mark_finished(project.id, 'failed')
             return Response({
                 'error': 'Processing service is currently unavailable. Please try again later.',
                 'detail': str(e)
@@ -97,7 +236,166 @@ class ImageViewSet(viewsets.ModelViewSet):
             'message': 'Image processing started in background.'
         }, status=status.HTTP_202_ACCEPTED)
 
-    @action(detail=True, methods=['get'], permission_classes=[AllowAny])
+    @action(detail=False, methods=['post'])
+    def batch(self, request):
+        """
+        Apply one settings profile to many projects in the background.
+
+        Request Body:
+        - project_ids: list of project ids (max 500)
+        - settings: dict (same keys as process_image)
+
+        Returns 202 with the batch id; follow it with `batch/<id>/`, and
+        each project with `progress`. Projects already queued or running,
+        or without an original, are skipped (listed in `skipped`).
+        """
+        from .batch import start_batch, batch_progress, BatchError
+
+        try:
+            batch, skipped = start_batch(
+                request.user, request.data.get('project_ids'), request.data.get('settings', {})
+            )
+        except BatchError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        except Exception as e:
+            print(f"Celery Error (batch): {e}")
+            return Response({
+                'error': 'Processing service is currently unavailable. Please try again later.',
+                'detail': str(e)
+            }, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+
+        batch.refresh_from_db()
+        return Response({**batch_progress(batch), 'skipped': skipped}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=False, methods=['get'], url_path=r'batch/(?P<batch_id>[0-9a-f-]+)')
+    def batch_status(self, request, batch_id=None):
+        """Aggregate progress of a batch: counts of completed, failed and cancelled projects."""
+        from .batch import batch_progress
+        from .models import ProcessingBatch
+
+        try:
+            batch = ProcessingBatch.objects.get(pk=batch_id, user=request.user)
+        except (ProcessingBatch.DoesNotExist, ValueError, ValidationError):
+            return Response({'error': 'Batch not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(batch_progress(batch))
+
+    @action(detail=True, methods=['get'])
+    def progress(self, request, pk=None):
+        """
+        Progress of the project's latest processing run (see api/progress.py).
+        Served from the cache; replaces polling the project itself.
+
+        Answers at once. While the job is queued or running the response
+        carries Retry-After (seconds until the next poll is worthwhile). The
+        ETag is the record's version: send it back in If-None-Match to get
+        304 when nothing changed.
+        """
+        from .progress import current_progress, retry_after
+
+        project = self.get_object()
+        record = current_progress(project)
+
+        etag = f'"{record["version"]}"'
+        headers = {'Cache-Control': 'no-store', 'ETag': etag}
+        wait = retry_after(record)
+        if wait:
+            headers['Retry-After'] = str(wait)
+        if etag in request.headers.get('If-None-Match', ''):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+        return Response(record, headers=headers)
+
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """
+        Cancel the project's queued or running processing job.
+
+        A queued job is cancelled at once; a running one stops at its next
+        stage or tile and moves to 'cancelled' (follow it with `progress`).
+        Returns 409 if there is no processing job to cancel.
+        """
+        from django.utils import timezone
+        from . import progress
+        from .models import ACTIVE_STATUSES
+
+        project = self.get_object()
+        if project.source == 'generated' or project.status not in ACTIVE_STATUSES:
+            return Response({'error': 'No processing job to cancel'}, status=status.HTTP_409_CONFLICT)
+
+        # Flag first: a task starting now sees it before doing any work
+        progress.request_cancel(project.id)
+        queued = ImageProject.objects.filter(pk=project.pk, status='pending').update(
+            status='cancelled', updated_at=timezone.now()
+        )
+        if queued:
+            progress.mark_finished(project.id, 'cancelled')
+            return Response({'status': 'cancelled'})
+        return Response({'status': 'cancelling'}, status=status.HTTP_202_ACCEPTED)
+
+    @action(detail=True, methods=['post'])
+    def preview(self, request, pk=None):
+        """
+        Render a low-resolution live preview of the given settings.
+        Runs synchronously on a cached downscaled proxy; nothing is saved.
+
+        Request Body:
+        - settings: dict (same keys as process_image)
+        - mask: str (optional) - base64 inpainting mask
+        - format: 'jpeg' or 'webp' (default: jpeg)
+        - quality: 1-100 (default: 80)
+
+        Returns the encoded image. X-Preview-Skipped lists stages left out
+        of previews (model-backed, NLM denoise) or dropped to stay within
+        the latency budget.
+        """
+        from django.http import HttpResponse
+        from .preview import render_preview, decode_mask, PREVIEW_FORMATS
+
+        project = self.get_object()
+        if not project.original_image:
+            return Response({'error': 'No original image available'}, status=status.HTTP_404_NOT_FOUND)
+        conflict = self._ingesting_conflict(project)
+        if conflict:
+            return conflict
+
+        settings_data = request.data.get('settings', {})
+        if not isinstance(settings_data, dict):
+            return Response({'error': 'settings must be an object'}, status=status.HTTP_400_BAD_REQUEST)
+
+        target_format = str(request.data.get('format', 'jpeg')).lower()
+        if target_format == 'jpg': target_format = 'jpeg'
+        if target_format not in PREVIEW_FORMATS:
+            target_format = 'jpeg'
+
+        try:
+            quality = max(1, min(100, int(request.data.get('quality', 80))))
+        except (ValueError, TypeError):
+            quality = 80
+
+        mask_img = None
+        mask_data = request.data.get('mask')
+        if mask_data:
+            try:
+                mask_img = decode_mask(mask_data)
+            except Exception as e:
+                print(f"Preview mask decode failed: {e}")
+
+        try:
+            content, content_type, info = render_preview(
+                project, settings_data, mask_img=mask_img, fmt=target_format, quality=quality
+            )
+        except (ValueError, TypeError) as e:
+            return Response({'error': f'Invalid preview request: {e}'}, status=status.HTTP_400_BAD_REQUEST)
+
+        response = HttpResponse(content, content_type=content_type)
+        response['Cache-Control'] = 'no-store'
+        response['X-Preview-Size'] = f"{info['width']}x{info['height']}"
+        response['X-Preview-Elapsed-Ms'] = str(info['elapsed_ms'])
+        if info['skipped']:
+            response['X-Preview-Skipped'] = ','.join(info['skipped'])
+        return response
+
+    @action(detail=True, methods=['get'], permission_classes=[AllowAny],
+            content_negotiation_class=ExportContentNegotiation)
     def download(self, request, pk=None):
         """
         Serve the processed image as a downloadable attachment.
@@ -105,24 +403,29 @@ class ImageViewSet(viewsets.ModelViewSet):
         Query Params:
         - format: 'png', 'jpg', 'jpeg', 'webp' (default: original ext or png)
         - quality: 1-100 (default: 90)
+
+        Encoded exports are cached in storage (see api/renditions.py) and
+        streamed with a strong ETag, Last-Modified (304 on revalidation)
+        and single-range HTTP Range support.
         """
-        from django.http import FileResponse, HttpResponse
-        import mimetypes
-        from PIL import Image
-        import io
+        from django.http import StreamingHttpResponse, HttpResponse
+        from django.utils.cache import get_conditional_response
+        from django.utils.http import http_date
+        from .renditions import get_rendition, parse_range, stream_file, source_format, EXPORT_FORMATS
         
         try:
             # Bypass get_object() which filters by user (since we are AllowAny now)
             project = ImageProject.objects.get(pk=pk)
         except ImageProject.DoesNotExist:
             return Response({'error': 'Project not found'}, status=status.HTTP_404_NOT_FOUND)
+        conflict = self._ingesting_conflict(project)
+        if conflict:
+            return conflict
         
         if not project.processed_image:
              return Response({'error': 'No processed image available'}, status=status.HTTP_404_NOT_FOUND)
              
-        file_path = project.processed_image.path
-        if not os.path.exists(file_path):
-            return Response({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
+        source_name = project.processed_image.name
 
         # Parse Query Params
         target_format = request.query_params.get('format', '').lower()
@@ -134,54 +437,60 @@ class ImageViewSet(viewsets.ModelViewSet):
         except ValueError:
             quality = 90
 
-        # If no specific format requested, serve raw file (fastest) unless resizing/re-encoding needed?
-        # Actually, let's always use PIL if format/quality is specified to ensure it applies.
-        # But if format is empty and quality is default, serve raw.
-        original_ext = os.path.splitext(file_path)[1].lower().replace('.', '')
-        if original_ext == 'jpeg': original_ext = 'jpg'
-        
         if not target_format:
-            target_format = original_ext
+            target_format = source_format(source_name) or 'png'
         if target_format == 'jpeg': target_format = 'jpg'
+        if target_format not in EXPORT_FORMATS:
+            return Response({'error': f'Unsupported format: {target_format}'}, status=status.HTTP_400_BAD_REQUEST)
 
-        # Optimize: If requested format matches original AND quality is high/default, serve distinct file
-        # But user might want to Compress (quality 50) same format.
-        # Simple Logic: Open, Convert, Save to Buffer.
-        
         try:
-            with Image.open(file_path) as img:
-                # Convert RGBA to RGB if saving as JPEG
-                if target_format == 'jpg' and img.mode == 'RGBA':
-                    img = img.convert('RGB')
-                
-                # Buffer
-                buffer = io.BytesIO()
-                
-                # Save mapping
-                pil_format = target_format.upper()
-                if pil_format == 'JPG': pil_format = 'JPEG'
-                
-                # Save parameters
-                save_params = {'format': pil_format}
-                if target_format in ['jpg', 'jpeg', 'webp']:
-                    save_params['quality'] = quality
-                    # Optimize for webp
-                    if target_format == 'webp':
-                        save_params['method'] = 6
-                
-                img.save(buffer, **save_params)
-                buffer.seek(0)
-                
-                # Generate filename
-                timestamp = int(time.time())
-                filename = f"fixpix_export_{timestamp}.{target_format}"
-                content_type = mimetypes.guess_type(filename)[0] or f'image/{target_format}'
-                
-                return FileResponse(buffer, as_attachment=True, filename=filename, content_type=content_type)
+            rendition = get_rendition(source_name, target_format, quality)
+        except FileNotFoundError:
+            return Response({'error': 'File not found on server'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             print(f"Export Error: {e}")
             return Response({'error': 'Error generating export'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+        # Revalidation: 304 Not Modified / 412 Precondition Failed
+        last_modified = int(rendition.last_modified) if rendition.last_modified else None
+        conditional = get_conditional_response(request, etag=rendition.etag, last_modified=last_modified)
+        if conditional is not None:
+            return conditional
+
+        byte_range = parse_range(request.headers.get('Range'), rendition.size)
+        if_range = request.headers.get('If-Range')
+        if byte_range and if_range and if_range != rendition.etag:
+            byte_range = None  # Representation changed: send it whole
+        
+        if byte_range is False:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response['Content-Range'] = f'bytes */{rendition.size}'
+            return response
+
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            response = StreamingHttpResponse(
+                stream_file(rendition.name, start, length),
+                status=status.HTTP_206_PARTIAL_CONTENT,
+                content_type=rendition.content_type,
+            )
+            response['Content-Range'] = f'bytes {start}-{end}/{rendition.size}'
+        else:
+            length = rendition.size
+            response = StreamingHttpResponse(stream_file(rendition.name), content_type=rendition.content_type)
+
+        # Generate filename
+        timestamp = int(time.time())
+        filename = f"fixpix_export_{timestamp}.{target_format}"
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
+        response['Content-Length'] = str(length)
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = rendition.etag
+        if last_modified:
+            response['Last-Modified'] = http_date(last_modified)
+        return response
+
     @action(detail=False, methods=['post'])
     def generate(self, request):
         """
@@ -208,16 +517,7 @@ class ImageViewSet(viewsets.ModelViewSet):
             except (ValueError, TypeError):
                 seed = None
         
-        # Check rate limits
         limits = GenerationLimits(request.user)
-        limit_check = limits.can_generate()
-        
-        if not limit_check['allowed']:
-            return Response({
-                'error': limit_check['reason'],
-                'remaining': limit_check['remaining'],
-                'daily_limit': limit_check['daily_limit'],
-            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
         
         # Validate prompt
         prompt_check = limits.validate_prompt(prompt)
@@ -233,32 +533,47 @@ class ImageViewSet(viewsets.ModelViewSet):
         if style not in valid_styles:
             style = 'photorealistic'
         
-        # Create project with source='generated'
-        project = ImageProject.objects.create(
-            user=request.user,
-            source='generated',
-            prompt=sanitized_prompt,
-            gen_style=style,
-            gen_seed=seed,
-            status='pending',
-            processing_type='restore',  # Required field, but not used for generation
-        )
+        # Check and reserve quota in one step; the project id is the lease id
+        project_id = uuid.uuid4()
+        limit_check = limits.reserve(str(project_id))
+        
+        if not limit_check['allowed']:
+            response = Response({
+                'error': limit_check['reason'],
+                'remaining': limit_check['remaining'],
+                'daily_limit': limit_check['daily_limit'],
+            }, status=status.HTTP_429_TOO_MANY_REQUESTS)
+            if limit_check['retry_after']:
+                response['Retry-After'] = str(limit_check['retry_after'])
+            return response
         
-        # Increment concurrent count
-        limits.increment_concurrent()
+        # Create project with source='generated'
+        try:
+            project = ImageProject.objects.create(
+                id=project_id,
+                user=request.user,
+                source='generated',
+                prompt=sanitized_prompt,
+                gen_style=style,
+                gen_seed=seed,
+                status='pending',
+                processing_type='restore',  # Required field, but not used for generation
+            )
+        except Exception:
+            limits.release(str(project_id))
+            raise
         
         # Dispatch async generation task
         try:
             from .tasks import generate_image_async
-            task = generate_image_async.delay(
-                str(project.id),
-                sanitized_prompt,
-                style,
-                seed
+            from .routing import route_generation
+            task = generate_image_async.apply_async(
+                (str(project.id), sanitized_prompt, style, seed),
+                **route_generation(request.user).options
             )
         except Exception as e:
             print(f"Celery Error (generation): {e}")
-            limits.decrement_concurrent()
+            limits.release(str(project.id))
             project.status = 'failed'
             project.save()
             return Response({
@@ -271,7 +586,7 @@ class ImageViewSet(viewsets.ModelViewSet):
             'project_id': str(project.id),
             'task_id': task.id,
             'message': 'Image generation started. This may take 2-3 minutes.',
-            'remaining': limit_check['remaining'] - 1,
+            'remaining': limit_check['remaining'],
         }, status=status.HTTP_202_ACCEPTED)
 
     @action(detail=False, methods=['get'])
@@ -286,3 +601,21 @@ class ImageViewSet(viewsets.ModelViewSet):
         limits = GenerationLimits(request.user)
         return Response(limits.get_status())
 
+
+
+@csrf_exempt
+def direct_upload_view(request, target):
+    """
+    Local stand-in for an S3 presigned PUT (see api/uploads.py).
+    Authorised by the signed target in the URL; streams the body to storage.
+    """
+    from django.http import JsonResponse
+    from .uploads import receive_local_upload, UploadError
+
+    if request.method != 'PUT':
+        return JsonResponse({'error': 'Method not allowed'}, status=405)
+    try:
+        key = receive_local_upload(target, request)
+    except UploadError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+    return JsonResponse({'key': key}, status=201)
@@ -3,10 +3,35 @@ Celery Configuration for FixPix
 
 This enables asynchronous background processing for heavy AI tasks.
 Images are processed in background workers instead of blocking the main web server.
+
+Tasks are routed to three queues (lanes) so quick edits never wait behind
+heavy jobs:
+
+- light:      cheap processing jobs, derivatives, ingest, housekeeping
+- heavy:      processing jobs whose estimated cost is high (NLM denoise,
+              scratch removal, background removal, big upscales)
+- generation: DeepFloyd IF text-to-image (GPU workers)
+
+process_image_async picks its lane per job from a cost estimate, and every
+job gets a priority from its cost and the user's plan (see api/routing.py).
+
+scratch_sweep is a broadcast (fanout) queue: every worker consuming it gets
+its own copy of each cleanup_scratch_artifacts run, so host-local scratch
+directories (api/scratch.py) are swept on every host.
+
+Run one worker pool per lane, each also consuming scratch_sweep, e.g.:
+    celery -A backend worker -Q light,scratch_sweep -c 8
+    celery -A backend worker -Q heavy,scratch_sweep -c 2
+    celery -A backend worker -Q generation,scratch_sweep -c 1 --pool solo
+
+Prefer CELERY_WORKER_CONCURRENCY to -c for the heavy lane: it also sizes the
+thread pool of tiled AI ops (see api/tiling.py).
 """
 
 import os
 from celery import Celery
+from kombu import Exchange, Queue
+from kombu.common import Broadcast
 
 # Set the default Django settings module
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'backend.settings')
@@ -17,6 +42,48 @@ app = Celery('fixpix')
 # Load config from Django settings, using CELERY_ namespace
 app.config_from_object('django.conf:settings', namespace='CELERY')
 
+# Priorities run 0-9 (see api/routing.py for which end is urgent on each
+# broker); RabbitMQ needs the queue argument, Redis emulates them with one
+# list per priority step
+MAX_PRIORITY = 9
+
+default_exchange = Exchange('fixpix', type='direct')
+
+app.conf.update(
+    task_queues=[
+        *[
+            Queue(name, default_exchange, routing_key=name, queue_arguments={'x-max-priority': MAX_PRIORITY})
+            for name in ('light', 'heavy', 'generation')
+        ],
+        Broadcast('scratch_sweep'),
+    ],
+    task_default_queue='light',
+    task_default_exchange='fixpix',
+    task_default_routing_key='light',
+    task_queue_max_priority=MAX_PRIORITY,
+    task_default_priority=MAX_PRIORITY // 2,
+    broker_transport_options={
+        'queue_order_strategy': 'priority',
+        'priority_steps': list(range(MAX_PRIORITY + 1)),
+    },
+    # Static lanes; process_image_async is routed per call (apply_async)
+    task_routes={
+        'api.tasks.process_image_async': {'queue': 'light'},
+        'api.tasks.process_batch_chunk_async': {'queue': 'heavy'},
+        'api.tasks.generate_image_async': {'queue': 'generation'},
+        'api.tasks.generate_derivatives_async': {'queue': 'light'},
+        'api.tasks.ingest_upload_async': {'queue': 'light'},
+        'api.tasks.refresh_dashboard_stats_async': {'queue': 'light'},
+        'api.tasks.cleanup_old_processed_images': {'queue': 'light'},
+        # Host-local work: a copy for every worker (see above)
+        'api.tasks.cleanup_scratch_artifacts': {'queue': 'scratch_sweep', 'exchange': 'scratch_sweep'},
+    },
+    # Reserve one job at a time so priorities and lanes apply to what runs
+    # next, and a heavy job is never stuck behind another in a prefetch
+    worker_prefetch_multiplier=1,
+    task_acks_late=True,
+)
+
 # Auto-discover tasks in all installed apps
 app.autodiscover_tasks()
 
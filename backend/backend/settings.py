@@ -140,6 +140,8 @@ else:
             'NAME': BASE_DIR / 'db.sqlite3',
         }
     }
+    # INCLUDE columns of covering indexes only apply on PostgreSQL
+    SILENCED_SYSTEM_CHECKS = ['models.W040']
 
 
 # Password validation
@@ -264,8 +266,77 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+# Prefork children per worker (None = one per core). Also sizes the thread
+# pool of tiled AI ops, so keep it in sync with `celery worker -c`.
+CELERY_WORKER_CONCURRENCY = int(os.environ.get('CELERY_WORKER_CONCURRENCY', '0')) or None
+
+# Decoded Image Cache (per worker process, see api/image_cache.py)
+# Set IMAGE_CACHE_SPILL_DIR to a local directory to share decoded images
+# between Celery prefork children through memory-mapped .npy files.
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_MB', '256')) * 1024 * 1024
+IMAGE_CACHE_SPILL_DIR = os.environ.get('IMAGE_CACHE_SPILL_DIR', '')
+IMAGE_CACHE_SPILL_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_SPILL_MAX_MB', '2048')) * 1024 * 1024
+# How long a file's (size, mtime) fingerprint is reused before storage is asked again
+IMAGE_CACHE_FINGERPRINT_SECONDS = int(os.environ.get('IMAGE_CACHE_FINGERPRINT_SECONDS', '10'))
+
+# Tiled AI ops (denoise, scratch removal, upscale): threads per task.
+# 0 = cores / CELERY_WORKER_CONCURRENCY.
+AI_TILE_WORKERS = int(os.environ.get('AI_TILE_WORKERS', '0'))
+
+# rembg segmentation model for background removal (one session per worker)
+REMBG_MODEL = os.environ.get('REMBG_MODEL', 'u2net')
+
+# Encoding of thumb/preview/full derivatives: 'webp' or 'jpeg'
+DERIVATIVE_FORMAT = os.environ.get('DERIVATIVE_FORMAT', 'webp')
+
+# Lifetime of presigned direct-upload URLs (seconds)
+UPLOAD_URL_EXPIRY = int(os.environ.get('UPLOAD_URL_EXPIRY', '900'))
+
+# Per-process cache of user plan tiers used by throttles and generation
+# limits (see api/tiers.py). Plan changes invalidate it in-process.
+TIER_CACHE_SECONDS = int(os.environ.get('TIER_CACHE_SECONDS', '60'))
+
+# Expired-project cleanup (see api/cleanup.py): rows per chunk, and the
+# time budget of one run in seconds (0 = until done)
+CLEANUP_CHUNK_SIZE = int(os.environ.get('CLEANUP_CHUNK_SIZE', '500'))
+CLEANUP_MAX_SECONDS = int(os.environ.get('CLEANUP_MAX_SECONDS', '0'))
+
+# Admin dashboard stats snapshot age before a background refresh (seconds)
+DASHBOARD_STATS_TTL = int(os.environ.get('DASHBOARD_STATS_TTL', '30'))
+
+# Generation quota engine (see api/quota.py). Defaults to the Celery Redis
+# broker; without Redis quotas are tracked per process.
+QUOTA_REDIS_URL = os.environ.get(
+    'QUOTA_REDIS_URL',
+    CELERY_BROKER_URL if CELERY_BROKER_URL.startswith(('redis://', 'rediss://')) else '',
+)
+# Concurrency lease of a generation; released early if its worker dies
+GENERATION_LEASE_SECONDS = int(os.environ.get('GENERATION_LEASE_SECONDS', '900'))
+
+# Simulated DeepFloyd time in mock mode (DEEPFLOYD_MOCK, see
+# api/deepfloyd_service.py): base seconds, seconds per inference step, and
+# random spread as a fraction (0.2 = +-20%, drawn from the seed). Load tests
+# set these to a real GPU's timings to exercise queueing and limits.
+DEEPFLOYD_MOCK_LATENCY = float(os.environ.get('DEEPFLOYD_MOCK_LATENCY', '2'))
+DEEPFLOYD_MOCK_STEP_LATENCY = float(os.environ.get('DEEPFLOYD_MOCK_STEP_LATENCY', '0'))
+DEEPFLOYD_MOCK_LATENCY_JITTER = float(os.environ.get('DEEPFLOYD_MOCK_LATENCY_JITTER', '0'))
+
+# Task lanes (see backend/celery.py, api/routing.py): estimated cost above
+# which processing jobs go to the heavy queue, and above which they count as
+# batch work and lose one priority step
+ROUTING_LIGHT_MAX_COST = float(os.environ.get('ROUTING_LIGHT_MAX_COST', '4'))
+ROUTING_BATCH_COST = float(os.environ.get('ROUTING_BATCH_COST', '60'))
 
 # Local Development: Run tasks synchronously (no Redis needed)
 if DEBUG or not CELERY_BROKER_URL:
     CELERY_TASK_ALWAYS_EAGER = True
     CELERY_TASK_EAGER_PROPAGATES = True
+
+# Scratch artifacts (see api/scratch.py): host-local directory for decoded
+# intermediates passed between tasks by handle (default: /dev/shm when
+# available) and their lifetime in seconds. SCRATCH_SHARED=True means web
+# processes and workers run on the same host (default: when tasks run
+# eagerly); requests then hand masks to workers this way, not via storage.
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR', '')
+SCRATCH_TTL = int(os.environ.get('SCRATCH_TTL', '3600'))
+SCRATCH_SHARED = os.environ.get('SCRATCH_SHARED', str(DEBUG or not CELERY_BROKER_URL)) == 'True'